@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""
+Micro-benchmark of sequence encoding/decoding throughput (MB/s): LUT codec
+versus the former dictionary based functions of h5node_prototype.
+
+usage: python bench_codec.py [seq_len] [repeats]
+"""
+import sys
+
+from time           import time
+from random         import choices
+
+import numpy as np
+
+from codec          import seq2num_nt, num2seq_nt, seq2num_aa, num2seq_aa
+from codec          import NT_CODES, AA_CODES
+
+
+def legacy_seq2num_nt(seq):
+    # former implementation: dictionary rebuilt on each call, one symbol at
+    # a time (as uint8 as numpy >= 2 refuses out of bound int8 values)
+    conv = dict(NT_CODES)
+    return np.array([conv[n] for n in seq], dtype='uint8').view('int8')
+
+
+def legacy_print_sequence_nt(sequence):
+    rev_conv = {v: k for k, v in NT_CODES.items()}
+    return ''.join(rev_conv[s] for s in sequence.view('uint8'))
+
+
+def legacy_seq2num_aa(seq):
+    conv = dict(AA_CODES)
+    return np.array([conv[n] for n in seq], dtype='uint8').view('int8')
+
+
+def legacy_print_sequence_aa(sequence):
+    rev_conv = {v: k for k, v in AA_CODES.items()}
+    return ''.join(rev_conv.get(s, 'X') for s in sequence.view('uint8'))
+
+
+def throughput(func, arg, size, repeats):
+    """
+    :returns: best throughput in MB/s over repeats
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time()
+        func(arg)
+        best = min(best, time() - t0)
+    return size / best / 1e6
+
+
+seq_len = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+nt_seq = ''.join(choices('ACGTN-', k=seq_len))
+aa_seq = ''.join(choices('ACDEFGHIKLMNPQRSTVWY-', k=seq_len))
+nt_num = seq2num_nt(nt_seq)
+aa_num = seq2num_aa(aa_seq)
+
+assert (legacy_seq2num_nt(nt_seq) == nt_num).all()
+assert legacy_print_sequence_nt(nt_num) == num2seq_nt(nt_num) == nt_seq
+assert (legacy_seq2num_aa(aa_seq) == aa_num).all()
+assert legacy_print_sequence_aa(aa_num) == num2seq_aa(aa_num) == aa_seq
+
+print(f'{"function":<20}{"legacy MB/s":>15}{"LUT MB/s":>15}{"speedup":>10}')
+for name, legacy, lut, arg in [
+        ('seq2num_nt', legacy_seq2num_nt, seq2num_nt, nt_seq),
+        ('_print_sequence_nt', legacy_print_sequence_nt, num2seq_nt, nt_num),
+        ('seq2num_aa', legacy_seq2num_aa, seq2num_aa, aa_seq),
+        ('_print_sequence_aa', legacy_print_sequence_aa, num2seq_aa, aa_num)]:
+    old = throughput(legacy, arg, seq_len, repeats)
+    new = throughput(lut, arg, seq_len, repeats)
+    print(f'{name:<20}{old:>15.1f}{new:>15.1f}{new / old:>9.0f}x')
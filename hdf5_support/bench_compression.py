@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""
+Benchmark of compression filters for the alignment dataset: for each filter
+and chunk shape, reports file size, write time (dump_h5tree from FASTA),
+random row read time and column window read time.
+
+The alignment is generated from a random reference with a small rate of
+substitutions per sequence, close to the redundancy of viral alignments.
+
+usage: python bench_compression.py tree_len seq_len [mutation_rate] [repeats]
+"""
+import sys
+import os
+
+from time           import time
+
+import h5py
+import numpy as np
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree
+from query          import H5Alignment
+from simulate       import write_fasta
+from h5bench.timing import measure
+
+
+FILTERS = [
+    ('none', dict()),
+    ('lzf', dict(compression='lzf')),
+    ('lzf+shuffle', dict(compression='lzf', shuffle=True)),
+    ('gzip1', dict(compression='gzip', compression_opts=1)),
+    ('gzip4', dict(compression='gzip', compression_opts=4)),
+    ('gzip9', dict(compression='gzip', compression_opts=9)),
+    ('gzip4+shuffle', dict(compression='gzip', compression_opts=4, shuffle=True)),
+]
+
+CHUNK_SIZES = [(100, 10_000), (1000, 1000), (1000, 100_000)]
+
+
+tree_len, seq_len = int(sys.argv[1]), int(sys.argv[2])
+mutation_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+
+printime(f'Generating tree of {tree_len} leaves and alignment of length {seq_len}')
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+fasta = f'h5test_compression_{tree_len}x{seq_len}.fa'
+write_fasta(t, seq_len, fasta, overwrite=True, seed=0, mutation_rate=mutation_rate)
+
+rng = np.random.default_rng(0)
+rows = rng.integers(0, tree_len, min(tree_len, 100))
+window = slice(seq_len // 3, seq_len // 3 + min(seq_len, 1000))
+
+log = open('h5test_compression.log', 'w')
+log.write('tree size\tseq length\tfilter\tchunk rows\tchunk cols\tfile size'
+          '\twrite time\trandom rows\tcolumn window\n')
+for chunk_size in CHUNK_SIZES:
+    for name, filters in FILTERS:
+        h5out = f'h5test_compression_{name}.hdf5'
+        printime(f'Dump with {name} filter and chunks of {chunk_size}')
+        t0 = time()
+        dump_h5tree(t, h5out, fasta=fasta, overwrite=True, chunk_size=chunk_size,
+                    layout='arrays', **filters)
+        write_time = time() - t0
+        size = os.path.getsize(h5out)
+        # reopened for each read, so that no chunk is left in the cache
+        def _read(columns):
+            with h5py.File(h5out, 'r') as h5f:
+                H5Alignment(h5f).read_rows(rows, columns)
+        rows_time = min(measure(lambda: _read(slice(None)), repeats, warmup=0))
+        window_time = min(measure(lambda: _read(window), repeats, warmup=0))
+        log.write(f'{tree_len}\t{seq_len}\t{name}\t{chunk_size[0]}\t'
+                  f'{chunk_size[1]}\t{size}\t{write_time}\t{rows_time}\t'
+                  f'{window_time}\n')
+        print(f'{name:>15}: {size / 1e6:10.2f} MB {write_time:10.3f} s write'
+              f'{rows_time:10.4f} s rows{window_time:10.4f} s window')
+        os.remove(h5out)
+log.close()
+os.remove(fasta)
+
+printime('Done.')
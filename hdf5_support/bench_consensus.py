@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+"""
+Scaling of the out-of-core consensus (see clade_data.iter_consensus) with
+the number of worker processes and the alignment length, for all the rows
+of the alignment and for the rows of a clade (the largest child of the
+root), compared with reading the rows in memory and reducing them with
+consensus().
+
+Each measure is run in a new process, to report its peak memory (largest
+resident set size of the process and of its workers).
+
+usage: python bench_consensus.py tree_len max_workers seq_len [seq_len ...]
+"""
+import sys
+import os
+
+from time           import time
+
+import h5py
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, consensus
+from clade_data     import clade_consensus
+from h5bench.timing import peak_memory
+
+# bytes of alignment read at once by each worker
+BUFFER_SIZE = 2**26
+# larger alignments are not read in memory
+MAX_IN_MEMORY = 2**31
+
+
+def run(fname, method, rows, workers):
+    """
+    :returns: time and consensus (as bytes, to be compared)
+    """
+    h5f = h5py.File(fname, 'r')
+    alignment = h5f['leaf_data']['alignment']
+    t0 = time()
+    if method == 'in memory':
+        value = consensus(alignment[rows])
+    else:
+        value = clade_consensus(alignment, rows, workers=workers,
+                                buffer_size=BUFFER_SIZE)
+    elapsed = time() - t0
+    h5f.close()
+    return elapsed, value.tobytes()
+
+
+tree_len, max_workers = int(sys.argv[1]), int(sys.argv[2])
+seq_lens = [int(v) for v in sys.argv[3:]]
+
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+clade = max(t.children, key=len)
+
+log = open('h5test_consensus.log', 'w')
+log.write('tree size\tseq length\trows\tmethod\tworkers\ttime\tpeak memory\n')
+for seq_len in seq_lens:
+    fname = 'h5test_consensus.hdf5'
+    printime(f'Dump h5tree of {tree_len} x {seq_len}')
+    dump_h5tree(t, fname, overwrite=True, layout='arrays', chunk_size=(1000, 10_000),
+                simulate=dict(seq_len=seq_len, seed=0, mutation_rate=0.01))
+    # leaf rows follow the preorder, the clade spans contiguous rows
+    leaves = [n.name for n in t.traverse('preorder') if not n.children]
+    start = leaves.index(next(clade.leaves()).name)
+    for name, rows in (('all', slice(None)),
+                       ('clade', slice(start, start + len(clade)))):
+        nrows = len(range(*rows.indices(tree_len)))
+        cases = [('out of core', w) for w in range(1, max_workers + 1)]
+        if nrows * seq_len <= MAX_IN_MEMORY:
+            cases.insert(0, ('in memory', 1))
+        expected = None
+        for method, workers in cases:
+            (elapsed, value), memory = peak_memory(run, fname, method, rows, workers)
+            if expected is None:
+                expected = value
+            elif value != expected:
+                raise Exception(f'ERROR: {method} consensus with {workers} workers differs.')
+            log.write(f'{tree_len}\t{seq_len}\t{name}\t{method}\t{workers}\t'
+                      f'{elapsed}\t{memory}\n')
+            print(f'{name:>6} rows, {method:>12}, {workers:2} workers: {elapsed:9.3f} s, '
+                  f'peak memory {memory / 2**20:9.1f} MiB')
+    os.remove(fname)
+log.close()
+
+printime('Done.')
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+"""
+Scaling of the pairwise distances (see distance.py) with the number of
+sequences and worker processes, storing either the condensed matrix or the
+10 nearest neighbours of each sequence.
+
+Each measure is run in a new process, to report its peak memory (largest
+resident set size of the process and of its workers), bounded by the tiles
+whatever the number of sequences (as long as the nearest neighbours fit in
+memory).
+
+usage: python bench_distances.py seq_len max_workers tree_len [tree_len ...]
+"""
+import sys
+import os
+
+from time           import time
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree
+from distance       import dump_distances
+from h5bench.timing import peak_memory
+
+# bytes used for a pair of tiles by each worker
+BUFFER_SIZE = 2**27
+
+
+def run(fname, k, workers):
+    """
+    :returns: time to compute and store the distances
+    """
+    t0 = time()
+    dump_distances(fname, k=k, workers=workers, buffer_size=BUFFER_SIZE)
+    return time() - t0
+
+
+seq_len, max_workers = int(sys.argv[1]), int(sys.argv[2])
+tree_lens = [int(v) for v in sys.argv[3:]]
+
+log = open('h5test_distances.log', 'w')
+log.write('tree size\tseq length\toutput\tworkers\ttime\tpeak memory\tfile size\n')
+for tree_len in tree_lens:
+    fname = 'h5test_distances.hdf5'
+    t = Tree()
+    t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+    printime(f'Dump h5tree of {tree_len} x {seq_len}')
+    dump_h5tree(t, fname, overwrite=True, layout='arrays', chunk_size=(1000, 10_000),
+                simulate=dict(seq_len=seq_len, seed=0, mutation_rate=0.01))
+    for output, k in (('condensed', None), ('10 nearest', 10)):
+        for workers in range(1, max_workers + 1):
+            elapsed, memory = peak_memory(run, fname, k, workers)
+            size = os.path.getsize(fname)
+            # pairs of sites compared per second
+            speed = tree_len * (tree_len - 1) / 2 * seq_len / elapsed
+            log.write(f'{tree_len}\t{seq_len}\t{output}\t{workers}\t{elapsed}\t{memory}\t{size}\n')
+            print(f'{output:>10}, {workers:2} workers: {elapsed:9.3f} s ({speed:.3g} sites/s), '
+                  f'peak memory {memory / 2**20:9.1f} MiB')
+    os.remove(fname)
+log.close()
+
+printime('Done.')
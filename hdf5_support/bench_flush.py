@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+"""
+Benchmark of writing tree edits back to an h5tree (see flush.py), after N
+random rearrangements (prune and regraft of a random subtree):
+
+  - on the fly: save_h5tree after each move, given the nodes touched
+  - on the fly, compare all: same, comparing all nodes with their records
+  - batched: a single save_h5tree after all moves
+  - rewrite: full rewrite of the h5tree (alignment included) after all moves
+
+usage: python bench_flush.py tree_len seq_len [nmoves] [repeats]
+"""
+import sys
+import os
+import shutil
+import random
+
+from time           import time
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, load_h5tree, save_h5tree
+
+
+def random_spr(tree, rng):
+    """
+    Prunes a random subtree and regrafts it on a random branch, removing its
+    former parent if left with a single child.
+
+    :returns: the nodes touched (see flush.flush)
+    """
+    nodes = list(tree.traverse())[1:]
+    while True:
+        prune, target = rng.choice(nodes), rng.choice(nodes)
+        if prune.up is tree and len(tree.children) < 3 or target is prune.up:
+            continue
+        node = target
+        while node is not None and node is not prune:
+            node = node.up
+        if node is None:  # target not within the pruned subtree
+            break
+    parent = prune.up
+    parent.remove_child(prune)
+    touched = [prune, parent]
+    if len(parent.children) == 1 and parent.up is not None:
+        child, grandparent = parent.children[0], parent.up
+        parent.remove_child(child)
+        grandparent.remove_child(parent)
+        grandparent.add_child(child)
+        touched += [child, grandparent]
+    graft = target.up
+    graft.remove_child(target)
+    new = graft.add_child()
+    new.add_child(target)
+    new.add_child(prune)
+    return touched + [target, graft, new]
+
+
+def run(strategy, base, h5out, nmoves, seed):
+    shutil.copy(base, h5out)
+    tree = load_h5tree(h5out, mode='r+')
+    h5f = tree.props['h5node'].file
+    rng = random.Random(seed)
+    elapsed = 0
+    for _ in range(nmoves):
+        touched = random_spr(tree, rng)
+        t0 = time()
+        if strategy == 'on the fly':
+            save_h5tree(tree, touched=touched)
+        elif strategy == 'on the fly, compare all':
+            save_h5tree(tree)
+        elapsed += time() - t0
+    t0 = time()
+    if strategy == 'batched':
+        save_h5tree(tree)
+    elif strategy == 'rewrite':
+        save_h5tree(tree, h5out + '.rewrite')
+        tree.props['h5node'].file.close()
+        os.replace(h5out + '.rewrite', h5out)
+    elapsed += time() - t0
+    h5f.close()
+    return elapsed
+
+
+tree_len, seq_len = int(sys.argv[1]), int(sys.argv[2])
+nmoves = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+
+log = open('h5test_flush.log', 'w')
+log.write('tree size\tseq length\tlayout\tmoves\tstrategy\ttime\tfile size\n')
+for layout in ('groups', 'arrays'):
+    base = f'h5test_flush_{layout}.hdf5'
+    printime(f'Dump h5tree with {layout} layout')
+    dump_h5tree(t, base, overwrite=True, layout=layout, consensus=True,
+                simulate=dict(seq_len=seq_len, seed=0, mutation_rate=0.01))
+    if layout == 'groups':  # groups of the nodes keep the file open
+        t.props.pop('h5node').file.close()
+    for strategy in ('on the fly', 'on the fly, compare all', 'batched', 'rewrite'):
+        h5out = f'h5test_flush_{layout}_edited.hdf5'
+        # same moves for all strategies and repeats
+        elapsed = min(run(strategy, base, h5out, nmoves, seed=0)
+                      for _ in range(repeats))
+        size = os.path.getsize(h5out)
+        log.write(f'{tree_len}\t{seq_len}\t{layout}\t{nmoves}\t{strategy}\t'
+                  f'{elapsed}\t{size}\n')
+        print(f'{layout:>7} {strategy:>24}: {elapsed:10.4f} s {size / 1e6:10.2f} MB')
+        os.remove(h5out)
+    os.remove(base)
+log.close()
+
+printime('Done.')
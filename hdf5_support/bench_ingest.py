@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+"""
+Scaling benchmark of FASTA to hdf5 alignment ingestion: serial streaming
+path versus the process-parallel path with 1, 2, 4, 8 and 16 workers.
+
+usage: python bench_ingest.py nseqs seq_len chunk_rows chunk_cols
+"""
+import sys
+import os
+
+from time           import time
+
+import h5py
+import numpy as np
+
+from h5node_prototype import printime
+from ingest           import fasta_reader, write_alignment, write_alignment_parallel
+
+
+def random_fasta(fname, nseqs, seq_len, line_len=60):
+    rng = np.random.default_rng(0)
+    with open(fname, 'wb') as out:
+        for i in range(nseqs):
+            seq = np.frombuffer(b'ACGT', dtype='uint8')[
+                rng.integers(0, 4, seq_len)].tobytes()
+            out.write(f'>{i}\n'.encode())
+            out.write(b'\n'.join(seq[p:p + line_len]
+                                 for p in range(0, seq_len, line_len)) + b'\n')
+
+
+def ingest(fasta, h5out, nseqs, seq_len, chunk_size, workers=None):
+    rows = {str(i): i for i in range(nseqs)}
+    with h5py.File(h5out, 'w', libver='latest') as h5f:
+        alignment = h5f.create_dataset(
+            'alignment', (nseqs, seq_len), dtype='int8',
+            chunks=(min(nseqs, chunk_size[0]), min(seq_len, chunk_size[1])))
+        t0 = time()
+        if workers is None:
+            write_alignment(alignment, fasta_reader(fasta), rows)
+        else:
+            write_alignment_parallel(alignment, fasta, rows, workers=workers)
+        return time() - t0
+
+
+nseqs = int(sys.argv[1])
+seq_len = int(sys.argv[2])
+chunk_size = int(sys.argv[3]), int(sys.argv[4])
+
+base_name = f'{nseqs}seqs_{int(seq_len / 1_000)}Kbp_chunks{chunk_size[0]}-{chunk_size[1]}'
+fasta = f'alignment_{nseqs}seqs_{int(seq_len / 1_000)}Kbp.fasta'
+if not os.path.exists(fasta):
+    printime('Generate random alignment')
+    random_fasta(fasta, nseqs, seq_len)
+size = os.path.getsize(fasta) / 1e6
+
+printime('Serial ingestion')
+times = {'serial': ingest(fasta, f'ingest_{base_name}_serial.hdf5',
+                          nseqs, seq_len, chunk_size)}
+with h5py.File(f'ingest_{base_name}_serial.hdf5') as h5f:
+    reference = h5f['alignment'][:]
+
+for workers in (1, 2, 4, 8, 16):
+    printime(f'Parallel ingestion with {workers} workers')
+    h5out = f'ingest_{base_name}_{workers}workers.hdf5'
+    times[f'{workers} workers'] = ingest(fasta, h5out, nseqs, seq_len,
+                                         chunk_size, workers)
+    with h5py.File(h5out) as h5f:
+        if not np.array_equal(h5f['alignment'][:], reference):
+            raise Exception(f'ERROR: {workers} workers output differs from serial')
+    os.remove(h5out)
+
+log = open(f'ingest_{base_name}.log', 'w')
+for k, v in times.items():
+    print(f'{k:<15}{v:>10.3f} s{size / v:>10.1f} MB/s')
+    log.write(f'{k}\t{v}\n')
+log.close()
+
+printime('Done.')
@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+"""
+Stress test of the live mode (see live.py): a writer process appends
+batches of new leaves to an h5tree, spread over a given duration, while
+reader processes keep refreshing their view of it and reading:
+
+  - refresh: refreshing the datasets
+  - read rows: refresh and read 100 random rows of the alignment
+  - load tree: refresh and load the whole tree with its properties
+
+Reports the latency of each operation with and without the writer
+appending, and the time taken by the appends. Readers check that the
+sequences of the new leaves (generated from their row) are complete, and
+that they never see fewer leaves than before.
+
+hdf5 SWMR allows a single writer, the readers being as many as wanted.
+
+usage: python bench_live.py tree_len seq_len [batches batch_size] [duration]
+"""
+import sys
+import os
+import shutil
+
+from time           import time, sleep
+from multiprocessing import Process, Queue, Event
+
+import h5py
+import numpy as np
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree
+from codec          import num2seq_nt
+from live           import LiveWriter, LiveReader
+
+
+def new_sequence(j, seq_len):
+    return np.frombuffer(b'ACGT', dtype='uint8')[
+        np.random.default_rng(j).integers(0, 4, seq_len)].tobytes().decode()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def writer(fname, parents, batches, batch_size, seq_len, duration, append,
+           ready, done, closed, results):
+    live = LiveWriter(fname, columns={'country': str, 'date': str})
+    ready.set()
+    base = len(live.alignment)
+    rng = np.random.default_rng(0)
+    times = []
+    t0 = time()
+    for b in range(batches):
+        sleep(max(0, t0 + b * duration / batches - time()))
+        if not append:
+            continue
+        rows = range(base + b * batch_size, base + (b + 1) * batch_size)
+        t1 = time()
+        live.append([f'live{r}' for r in rows],
+                     [new_sequence(r, seq_len) for r in rows],
+                     parent=rng.choice(parents, batch_size).tolist(),
+                     props=[{'country': 'fr', 'date': f'2024-01-{b % 28 + 1:02}'}] * batch_size)
+        times.append(time() - t1)
+    sleep(max(0, t0 + duration - time()))
+    done.set()
+    results.put(('append', times))
+    closed.wait()  # the file is reopened to write the names of the new leaves
+    live.close()
+
+
+def reader(fname, base, seq_len, ready, done, results, seed):
+    try:
+        results.put(('read', _reader(fname, base, seq_len, ready, done, seed)))
+    except Exception as e:
+        results.put(('error', repr(e)))
+
+
+def _reader(fname, base, seq_len, ready, done, seed):
+    ready.wait()
+    live = LiveReader(fname)
+    rng = np.random.default_rng(seed)
+    times = {'refresh': [], 'read rows': [], 'load tree': []}
+    seen = 0
+    while not done.is_set():
+        t0 = time()
+        live.refresh()
+        times['refresh'].append(time() - t0)
+        t0 = time()
+        live.refresh()
+        nrows = len(live.alignment.dataset)
+        rows = rng.integers(0, nrows, 100)
+        sequences = live.alignment.read_rows(rows)
+        times['read rows'].append(time() - t0)
+        for row, seq in zip(rows, sequences):
+            if row >= base and num2seq_nt(seq) != new_sequence(row, seq_len):
+                raise Exception(f'ERROR: incomplete row {row}')
+        if len(times['read rows']) % 10 == 1:
+            t0 = time()
+            live.refresh()
+            nleaves = len(live.load_tree())
+            times['load tree'].append(time() - t0)
+            if nleaves < seen:
+                raise Exception(f'ERROR: {nleaves} leaves seen after {seen}')
+            seen = nleaves
+    live.close()
+    return times
+
+
+def run(base_file, fname, nreaders, append, batches, batch_size, seq_len, duration):
+    shutil.copy(base_file, fname)
+    with h5py.File(fname, 'r') as h5f:
+        base = len(h5f['leaf_data']['alignment'])
+        parents = np.flatnonzero(h5f['topology']['leaf_row'][:] < 0)
+    ready, done, closed, results = Event(), Event(), Event(), Queue()
+    procs = [Process(target=writer, args=(fname, parents, batches, batch_size, seq_len,
+                                          duration, append, ready, done, closed, results))]
+    procs += [Process(target=reader, args=(fname, base, seq_len, ready, done, results, i))
+              for i in range(nreaders)]
+    for proc in procs:
+        proc.start()
+    times = {}
+    for _ in range(1 + nreaders):  # readers send their times once closed
+        kind, values = results.get()
+        if kind == 'error':
+            for proc in procs:
+                proc.terminate()
+            raise Exception(f'ERROR: reader failed, {values}')
+        for op, values in (values.items() if kind == 'read' else [(kind, values)]):
+            times.setdefault(op, []).extend(values)
+    closed.set()
+    for proc in procs:
+        proc.join()
+    os.remove(fname)
+    return times
+
+
+tree_len, seq_len = int(sys.argv[1]), int(sys.argv[2])
+batches = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+duration = float(sys.argv[5]) if len(sys.argv) > 5 else 10
+
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+for leaf in t.leaves():
+    leaf.add_prop('country', 'es')
+
+base_file = 'h5test_live.hdf5'
+printime('Dump h5tree')
+dump_h5tree(t, base_file, overwrite=True, layout='arrays', consensus=True,
+            simulate=dict(seq_len=seq_len, seed=0, mutation_rate=0.01))
+
+log = open('h5test_live.log', 'w')
+log.write('tree size\tseq length\treaders\twriting\toperation\tcount\tmedian'
+          '\tp95\tmax\n')
+for nreaders in (1, 2, 4):
+    for append in (False, True):
+        printime(f'{nreaders} readers, {"with" if append else "without"} writes')
+        times = run(base_file, 'h5test_live_run.hdf5', nreaders, append, batches,
+                    batch_size, seq_len, duration)
+        for op, values in times.items():
+            if not values:
+                continue
+            stats = [percentile(values, q) for q in (50, 95, 100)]
+            log.write(f'{tree_len}\t{seq_len}\t{nreaders}\t{append}\t{op}\t{len(values)}\t'
+                      + '\t'.join(map(str, stats)) + '\n')
+            print(f'{op:>10}: {len(values):6} times, median {stats[0] * 1000:9.3f} ms, '
+                  f'p95 {stats[1] * 1000:9.3f} ms, max {stats[2] * 1000:9.3f} ms')
+log.close()
+os.remove(base_file)
+
+printime('Done.')
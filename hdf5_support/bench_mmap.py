@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+"""
+Benchmark of memory mapped access to a contiguous alignment versus h5py
+reads (chunked and contiguous datasets), for whole columns (all rows) and
+clade blocks (contiguous rows, all columns) with their consensus, and for a
+consensus over all rows split by columns among worker processes sharing
+the mapping.
+
+usage: python bench_mmap.py tree_len seq_len [chunk_rows chunk_cols] [repeats]
+"""
+import sys
+import os
+
+from multiprocessing import Pool
+
+import h5py
+import numpy as np
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, consensus
+from query          import H5Alignment, MappedAlignment
+from h5bench.timing import measure
+
+
+def _block_consensus(h5a, nrows, beg, end):
+    return consensus(h5a.read_rows(np.arange(nrows), slice(beg, end)))
+
+
+tree_len, seq_len = int(sys.argv[1]), int(sys.argv[2])
+chunk_size = (int(sys.argv[3]) if len(sys.argv) > 3 else 1000,
+              int(sys.argv[4]) if len(sys.argv) > 4 else 100_000)
+repeats = int(sys.argv[5]) if len(sys.argv) > 5 else 5
+
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+simulate = dict(seq_len=seq_len, seed=0, mutation_rate=0.01)
+printime('Dump chunked and contiguous h5trees')
+dump_h5tree(t, 'h5test_mmap_chunked.hdf5', overwrite=True, chunk_size=chunk_size,
+            layout='arrays', simulate=simulate)
+dump_h5tree(t, 'h5test_mmap_contiguous.hdf5', overwrite=True, chunk_size=chunk_size,
+            layout='arrays', simulate=simulate, contiguous=True)
+
+chunked = h5py.File('h5test_mmap_chunked.hdf5', 'r')
+contiguous = h5py.File('h5test_mmap_contiguous.hdf5', 'r')
+accesses = {'h5py chunked': H5Alignment(chunked),
+            'h5py contiguous': H5Alignment(contiguous),
+            'memmap': MappedAlignment(contiguous)}
+
+rows = np.arange(tree_len)
+clade = np.arange(tree_len // 4, tree_len // 2)
+column = seq_len // 2
+patterns = {
+    # column scans, the consensus touches all values (memmap slices are lazy)
+    'whole column': lambda h5a: consensus(h5a.read_rows(rows, slice(column, column + 1))),
+    'whole columns (100)': lambda h5a: consensus(h5a.read_rows(rows, slice(column, column + 100))),
+    'clade block': lambda h5a: h5a.read_rows(clade),
+    'clade consensus': lambda h5a: consensus(h5a.read_rows(clade)),
+}
+
+log = open('h5test_mmap.log', 'w')
+log.write('tree size\tseq length\taccess\tpattern\tworkers\ttime\n')
+expected = {}
+for name, h5a in accesses.items():
+    for pattern, func in patterns.items():
+        value = np.asarray(func(h5a))
+        if expected.setdefault(pattern, value).tobytes() != value.tobytes():
+            raise Exception(f'ERROR: {name} {pattern} differs')
+        elapsed = min(measure(lambda: func(h5a), repeats, warmup=0))
+        log.write(f'{tree_len}\t{seq_len}\t{name}\t{pattern}\t1\t{elapsed}\n')
+        print(f'{name:>16} {pattern:>20}: {elapsed:10.5f} s')
+
+# consensus of all rows, blocks of columns being computed by the workers
+# from the shared mapping
+mapped = accesses['memmap']
+blocks = [(beg, min(seq_len, beg + chunk_size[1]))
+          for beg in range(0, seq_len, chunk_size[1])]
+for workers in (1, 2, 4):
+    with Pool(workers) as pool:
+        tasks = [(mapped, tree_len, beg, end) for beg, end in blocks]
+        pool.starmap(_block_consensus, tasks)  # warm up
+        elapsed = min(measure(lambda: pool.starmap(_block_consensus, tasks), repeats, warmup=0))
+    log.write(f'{tree_len}\t{seq_len}\tmemmap\tfull consensus\t{workers}\t{elapsed}\n')
+    print(f'{"memmap":>16} {"full consensus":>20}: {elapsed:10.5f} s ({workers} workers)')
+log.close()
+
+chunked.close()
+contiguous.close()
+os.remove('h5test_mmap_chunked.hdf5')
+os.remove('h5test_mmap_contiguous.hdf5')
+
+printime('Done.')
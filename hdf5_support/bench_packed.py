@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+"""
+Benchmark of packed (4 bits per base) versus int8 alignments: file size,
+retrieval of random rows and of a window of columns, and consensus of a
+block of rows (computed directly on the packed bytes).
+
+usage: python bench_packed.py nseqs seq_len [chunk_rows chunk_cols] [repeats]
+"""
+import sys
+import os
+
+import h5py
+import numpy as np
+
+from codec          import NT_CODES, pack_nt, unpack_nt, packed_length
+from query          import H5Alignment
+from h5node_prototype import printime, consensus
+from h5bench.timing import measure
+
+
+def write_file(h5out, alignment, chunks, packed):
+    with h5py.File(h5out, 'w', libver='latest') as h5f:
+        lg = h5f.create_group('leaf_data')
+        for row in range(len(alignment)):
+            lg.attrs[str(row)] = row
+        if packed:
+            data = lg.create_dataset(
+                'alignment', data=pack_nt(alignment),
+                chunks=(chunks[0], packed_length(chunks[1])))
+            data.attrs['encoding'] = 'nt4'
+            data.attrs['length'] = alignment.shape[1]
+        else:
+            lg.create_dataset('alignment', data=alignment, chunks=chunks)
+
+
+nseqs, seq_len = int(sys.argv[1]), int(sys.argv[2])
+chunks = (min(nseqs, int(sys.argv[3]) if len(sys.argv) > 3 else 1000),
+          min(seq_len, int(sys.argv[4]) if len(sys.argv) > 4 else 100_000))
+repeats = int(sys.argv[5]) if len(sys.argv) > 5 else 5
+
+printime(f'Generating random alignment of {nseqs} x {seq_len}')
+rng = np.random.default_rng(0)
+codes = np.array([NT_CODES[n] for n in 'ACGTACGTACGTN-'], dtype='uint8')
+alignment = codes[rng.integers(0, len(codes), (nseqs, seq_len))].view('int8')
+
+printime('Packing / unpacking')
+pack_time = min(measure(lambda: pack_nt(alignment), repeats, warmup=0))
+packed = pack_nt(alignment)
+unpack_time = min(measure(lambda: unpack_nt(packed, seq_len), repeats, warmup=0))
+if not (unpack_nt(packed, seq_len) == alignment).all():
+    raise Exception('ERROR: unpacked alignment differs from the original')
+print(f'pack: {alignment.nbytes / pack_time / 1e6:.1f} MB/s, '
+      f'unpack: {alignment.nbytes / unpack_time / 1e6:.1f} MB/s')
+
+rows = rng.integers(0, nseqs, min(nseqs, 100))
+window = slice(seq_len // 3, seq_len // 3 + min(seq_len, 1000))
+block = np.arange(nseqs // 4, nseqs // 2)
+
+log = open('h5test_packed.log', 'w')
+log.write('nseqs\tseq length\tformat\tfile size\trandom rows\tcolumn window'
+          '\tconsensus\tconsensus in memory\n')
+results = {}
+for fmt in ('int8', 'packed', 'packed raw'):
+    h5out = f'h5test_packed_{fmt.split()[0]}.hdf5'
+    if fmt != 'packed raw':
+        printime(f'Writing {fmt} alignment')
+        write_file(h5out, alignment, chunks, fmt == 'packed')
+    raw = fmt == 'packed raw'
+    in_memory = packed if fmt != 'int8' else alignment
+    with h5py.File(h5out, 'r') as h5f:
+        h5a = H5Alignment(h5f)
+        times = [
+            min(measure(lambda: h5a.read_rows(rows, raw=raw), repeats, warmup=0)),
+            min(measure(lambda: h5a.read_rows(rows, window, raw=raw), repeats, warmup=0)),
+            min(measure(lambda: consensus(h5a.read_rows(block, raw=True)), repeats, warmup=0)),
+            min(measure(lambda: consensus(in_memory[block]), repeats, warmup=0))]
+        results[fmt] = consensus(h5a.read_rows(block, raw=True))
+    size = os.path.getsize(h5out)
+    log.write(f'{nseqs}\t{seq_len}\t{fmt}\t{size}\t' +
+              '\t'.join(map(str, times)) + '\n')
+    print(f'{fmt:>10}: {size / 1e6:10.2f} MB' +
+          ''.join(f'{t:10.4f} s' for t in times))
+log.close()
+
+if not (unpack_nt(results['packed'], seq_len) == results['int8']).all():
+    raise Exception('ERROR: packed consensus differs from the int8 one')
+for fmt in ('int8', 'packed'):
+    os.remove(f'h5test_packed_{fmt}.hdf5')
+
+printime('Done.')
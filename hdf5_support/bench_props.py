@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+"""
+Benchmark of the storage of node properties (metadata of the leaves, as in
+annotated outbreak trees): one hdf5 attribute per property and node versus
+one dataset per property (see node_props.py). Reports file size, dump time,
+and load time of all the properties or of a few of them.
+
+usage: python bench_props.py tree_len [nfields]
+"""
+import sys
+import os
+import random
+
+from time           import time
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, load_h5tree
+
+
+def annotate(tree, nfields, seed=0):
+    """
+    Adds nfields properties to each leaf: strings from small vocabularies
+    (e.g. country, lineage), dates, integers and floats, some missing.
+    """
+    rng = random.Random(seed)
+    vocabularies = [[f'value{i}_{j}' for j in range(rng.randint(5, 500))]
+                    for i in range(nfields)]
+    for leaf in tree.traverse():
+        if leaf.children:
+            continue
+        for i in range(nfields):
+            kind = i % 4
+            if kind == 0:
+                leaf.add_prop(f'field{i}', rng.choice(vocabularies[i]))
+            elif kind == 1:
+                leaf.add_prop(f'field{i}', f'2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}')
+            elif kind == 2:
+                leaf.add_prop(f'field{i}', rng.randint(0, 100))
+            elif rng.random() < 0.8:  # sometimes missing
+                leaf.add_prop(f'field{i}', rng.random())
+
+
+def as_attributes(tree, fname):
+    """
+    Rewrites the properties of the leaves of a group-per-node h5tree as
+    attributes of their groups (instead of columns).
+    """
+    h5tree = load_h5tree(fname, mode='r+')
+    h5f = h5tree.props['h5node'].file
+    del h5f['node_props']
+    leaves = {n.name: n for n in tree.traverse() if not n.children}
+    for node in h5tree.traverse():
+        if not node.children:
+            group = node.props['h5node']
+            for k, v in leaves[node.name].props.items():
+                if k.startswith('field'):
+                    group.attrs[k] = v
+    h5f.close()
+
+
+tree_len = int(sys.argv[1])
+nfields = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+t = Tree()
+t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+annotate(t, nfields)
+selected = ['field0', 'field2']
+
+log = open('h5test_props.log', 'w')
+log.write('tree size\tfields\tlayout\tstorage\tfile size\tdump time\tload time'
+          '\tload time (2 fields)\n')
+for layout, storage in (('groups', 'attributes'), ('groups', 'columns'),
+                        ('arrays', 'columns')):
+    h5out = f'h5test_props_{layout}_{storage}.hdf5'
+    printime(f'Dump {tree_len} leaves annotated tree, {layout} layout, {storage}')
+    t0 = time()
+    dump_h5tree(t, h5out, overwrite=True, layout=layout)
+    if layout == 'groups':  # groups of the nodes keep the file open
+        t.props.pop('h5node').file.close()
+    if storage == 'attributes':
+        as_attributes(t, h5out)
+    dump_time = time() - t0
+    times = []
+    for props in (None, selected):
+        t0 = time()
+        h5tree = load_h5tree(h5out, props=props)
+        times.append(time() - t0)
+        leaf = next(n for n in h5tree.traverse() if not n.children)
+        if props is None and not all(f'field{i}' in leaf.props for i in range(0, nfields, 4)):
+            raise Exception('ERROR: properties not loaded')
+        h5tree.props['h5node'].file.close()
+    if storage == 'attributes':  # no way to load only some attributes
+        times[1] = times[0]
+    size = os.path.getsize(h5out)
+    log.write(f'{tree_len}\t{nfields}\t{layout}\t{storage}\t{size}\t{dump_time}'
+              f'\t{times[0]}\t{times[1]}\n')
+    print(f'{layout:>7} {storage:>11}: {size / 1e6:10.2f} MB {dump_time:10.3f} s dump'
+          f'{times[0]:10.3f} s load{times[1]:10.3f} s load {len(selected)} fields')
+    os.remove(h5out)
+log.close()
+
+printime('Done.')
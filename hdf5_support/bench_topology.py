@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+"""
+Benchmark of tree topology storage: one hdf5 group per node versus flat
+arrays indexed by node. Reports file size, dump time and load time.
+
+usage: python bench_topology.py tree_len [tree_len ...]
+"""
+import sys
+import os
+
+from time           import time
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, load_h5tree
+
+
+log = open('h5test_topology.log', 'w')
+log.write('tree size\tlayout\tfile size\tdump time\tload time\n')
+for tree_len in map(int, sys.argv[1:]):
+    t = Tree()
+    t.populate(tree_len, names=[str(i) for i in range(tree_len)])
+    for layout in ('groups', 'arrays'):
+        h5out = f'h5tree_{tree_len}leaves_{layout}.hdf5'
+        printime(f'Dump {tree_len} leaves tree with {layout} layout')
+        t0 = time()
+        dump_h5tree(t, h5out, overwrite=True, layout=layout)
+        dump_time = time() - t0
+        t0 = time()
+        h5tree = load_h5tree(h5out)
+        load_time = time() - t0
+        if len(h5tree) != tree_len:
+            raise Exception(f'ERROR: loaded tree has {len(h5tree)} leaves')
+        h5tree.props['h5node'].file.close()
+        size = os.path.getsize(h5out)
+        log.write(f'{tree_len}\t{layout}\t{size}\t{dump_time}\t{load_time}\n')
+        print(f'{layout:>8}: {size / 1e6:10.2f} MB {dump_time:10.3f} s dump'
+              f'{load_time:10.3f} s load')
+        os.remove(h5out)
+log.close()
+
+printime('Done.')
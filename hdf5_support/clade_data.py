@@ -0,0 +1,510 @@
+"""
+Per-clade data precomputed from the leaf alignment and stored in the
+node_data group of h5trees, one row per internal node.
+
+As for leaf_data, the row of each internal node is stored as an attribute
+of its group (group-per-node layout) or in the node_row dataset (array
+layout), named after the node_data dataset.
+
+The consensus and profile of any set of rows (e.g. a clade) can also be
+computed out of core, by blocks of columns (see iter_consensus and
+iter_profile), the consensus blocks being optionally reduced in parallel by
+worker processes.
+"""
+from multiprocessing import get_context
+
+import h5py
+import numpy as np
+
+from codec          import NT_PROFILE_INDEX, PROFILE_SYMBOLS
+from codec          import unpack_nt, packed_length, is_packed
+from query          import H5Alignment
+
+
+# profile columns of each code, one-hot (padded to 8 bytes viewed as one
+# uint64, to be looked up with np.take)
+_ONE_HOT = np.eye(len(PROFILE_SYMBOLS), 8, dtype='uint8')[NT_PROFILE_INDEX].view('uint64')[:, 0]
+# ... and as 10 bits fields of a uint64, so that a sum over up to 1023 rows
+# counts all the symbols of a column at once
+_FIELD_BITS = 10
+_FIELD_MAX = 2**_FIELD_BITS - 1
+_FIELD_SHIFTS = np.arange(len(PROFILE_SYMBOLS), dtype='uint64') * _FIELD_BITS
+_FIELD_ONE_HOT = np.left_shift(np.uint64(1), _FIELD_SHIFTS[NT_PROFILE_INDEX])
+
+
+def heavy_first_postorder(tree):
+    """
+    Postorder traversal visiting the children with more leaves first, so that
+    at any time only O(log(number of leaves)) visited nodes have a parent not
+    yet visited (instead of O(number of leaves) for unbalanced trees).
+
+    :param tree: ete4 Tree object
+
+    :returns: list of nodes
+    """
+    size = {}
+    for node in tree.traverse('postorder'):
+        size[id(node)] = sum(size[id(c)] for c in node.children) or 1
+    order = []
+    todo = [(tree, False)]
+    while todo:
+        node, visited = todo.pop()
+        if visited or not node.children:
+            order.append(node)
+            continue
+        todo.append((node, True))
+        todo.extend((c, False) for c in sorted(node.children,
+                                               key=lambda c: size[id(c)]))
+    return order
+
+
+def row_ranges(tree, leaf_rows):
+    """
+    Computes the range of leaf_data rows spanned by each node, with leaf rows
+    in preorder (as in dump_h5tree) each clade spanning contiguous rows.
+
+    :param tree: ete4 Tree object
+    :param leaf_rows: dictionary mapping leaf names to their row
+
+    :returns: dictionary mapping id(node) to (row_start, row_end), row_end
+       being excluded
+    """
+    ranges = {}
+    for node in tree.traverse('postorder'):
+        if node.children:
+            ranges[id(node)] = (ranges[id(node.children[0])][0],
+                                ranges[id(node.children[-1])][1])
+        else:
+            row = leaf_rows[node.name]
+            ranges[id(node)] = (row, row + 1)
+    return ranges
+
+
+class _RowBlockReader:
+    """
+    Reads rows of a column window of a dataset, keeping the last row blocks
+    (of the size of the dataset chunks) read in memory.
+    """
+    def __init__(self, dataset, beg, end, keep=2):
+        self.dataset = dataset
+        self.beg, self.end = beg, end
+        # unchunked datasets are read by blocks of about 1 MiB
+        self.rows = (dataset.chunks[0] if dataset.chunks else
+                     max(1, 2**20 // max(1, end - beg)))
+        self.keep = keep
+        self.blocks = {}
+
+    def __getitem__(self, row):
+        num = row // self.rows
+        if num not in self.blocks:
+            if len(self.blocks) >= self.keep:
+                del self.blocks[next(iter(self.blocks))]
+            self.blocks[num] = self.dataset[num * self.rows:(num + 1) * self.rows,
+                                            self.beg:self.end]
+        return self.blocks[num][row - num * self.rows]
+
+
+def _node_rows(order):
+    """
+    :returns: dictionary mapping id(node) to its row in node_data datasets,
+       for internal nodes in the given order
+    """
+    node_rows = {}
+    for node in order:
+        if node.children:
+            node_rows[id(node)] = len(node_rows)
+    return node_rows
+
+
+def dump_consensus(tree, alignment, node_data, leaf_rows, block_cols=None):
+    """
+    Computes, in one bottom-up pass, the consensus (bitwise AND) of every
+    internal node from the consensus of its children, and stores them in
+    node_data/consensus.
+
+    The alignment is processed by blocks of columns (defaults to the column
+    chunks of the alignment), and for each of them memory holds two blocks
+    of leaf rows, one block of consensus rows, and the consensus of the
+    visited nodes whose parent is not yet computed.
+
+    :param tree: ete4 Tree object
+    :param alignment: hdf5 alignment dataset (one row per leaf), int8 or
+       packed (the consensus is then packed too), its compression filters
+       are used for the consensus dataset
+    :param node_data: hdf5 group where to create the consensus dataset
+    :param leaf_rows: dictionary mapping leaf names to alignment rows
+    :param None block_cols: number of columns processed at once (needed
+       for unchunked alignments of long sequences)
+
+    :returns: dictionary mapping id(node) to its row in node_data/consensus,
+       for internal nodes
+    """
+    order = heavy_first_postorder(tree)
+    node_rows = _node_rows(order)
+    ncols = alignment.shape[1]
+    chunk_rows, chunk_cols = alignment.chunks or (1000, block_cols or ncols)
+    block_cols = min(ncols, block_cols or chunk_cols)
+    consensus = node_data.create_dataset(
+        'consensus', (len(node_rows), ncols), dtype=alignment.dtype,
+        maxshape=(None, ncols),  # new nodes (see flush.py)
+        chunks=(max(1, min(len(node_rows), chunk_rows)), min(ncols, chunk_cols)),
+        compression=alignment.compression,
+        compression_opts=alignment.compression_opts, shuffle=alignment.shuffle)
+    consensus.attrs.update(alignment.attrs)
+    block_rows = consensus.chunks[0]
+    for beg in range(0, ncols, block_cols):
+        end = min(ncols, beg + block_cols)
+        leaves = _RowBlockReader(alignment, beg, end)
+        out = np.empty((block_rows, end - beg), dtype=alignment.dtype)
+        done = {}  # id(node) -> consensus of nodes with parent not computed
+        row = 0
+        for node in order:
+            if not node.children:
+                done[id(node)] = leaves[leaf_rows[node.name]].copy()
+                continue
+            children = iter(node.children)
+            value = done.pop(id(next(children)))
+            for child in children:
+                np.bitwise_and(value, done.pop(id(child)), out=value)
+            done[id(node)] = value
+            out[row % block_rows] = value
+            row += 1
+            if row % block_rows == 0 or row == len(node_rows):
+                start = (row - 1) // block_rows * block_rows
+                consensus[start:row, beg:end] = out[:row - start]
+    return node_rows
+
+
+def _block_steps(alignment, rows, block_cols, buffer_size):
+    """
+    :returns: number of columns (bases) of the blocks, even for packed
+       alignments and defaulting to the column chunks, and number of rows
+       read at once, at most buffer_size bytes (multiple of the row chunks
+       when possible)
+    """
+    packed = is_packed(alignment)
+    if not block_cols:
+        block_cols = ((alignment.chunks[1] * (2 if packed else 1))
+                      if alignment.chunks else 2**20)
+    if packed:  # blocks of whole bytes
+        block_cols += block_cols % 2
+    width = packed_length(block_cols) if packed else block_cols
+    read_rows = max(1, buffer_size // (width * alignment.dtype.itemsize))
+    if alignment.chunks and read_rows > alignment.chunks[0]:
+        read_rows -= read_rows % alignment.chunks[0]
+    return block_cols, min(read_rows, max(1, len(rows)))
+
+
+def _reduce_block(h5a, rows, beg, end, read_rows):
+    """
+    :returns: consensus (bitwise AND) of rows of an alignment, from column
+       beg to end (excluded), read by blocks of read_rows rows (packed bytes
+       for packed alignments, see H5Alignment.read_rows)
+    """
+    value = None
+    for i in range(0, len(rows), read_rows):
+        block = np.bitwise_and.reduce(h5a.read_rows(rows[i:i + read_rows],
+                                                    slice(beg, end), raw=True))
+        value = block if value is None else np.bitwise_and(value, block, out=value)
+    return value
+
+
+def _init_reader(fname, name, rows, read_rows):
+    global _h5a, _rows, _read_rows
+    # one chunk in cache: each chunk is read once per column block
+    _h5a = H5Alignment(h5py.File(fname, 'r'), name, chunk_cache=1)
+    _rows, _read_rows = rows, read_rows
+
+
+def _reduce_task(task):
+    beg, end = task
+    return _reduce_block(_h5a, _rows, beg, end, _read_rows)
+
+
+def iter_consensus(alignment, rows=slice(None), columns=slice(None), block_cols=None,
+                   buffer_size=2**28, workers=1, raw=False):
+    """
+    Computes the consensus (bitwise AND) of a set of alignment rows (e.g. the
+    leaves of a clade), out of core: the alignment is read by blocks of
+    columns (aligned on its chunks), each reduced by blocks of rows of at
+    most buffer_size bytes.
+
+    With several workers, column blocks are reduced in parallel by a pool of
+    processes, each opening the file read-only (the file should then not be
+    open for writing). Memory used is about buffer_size and one chunk of the
+    alignment per worker.
+
+    :param alignment: hdf5 alignment dataset of the leaf_data group, int8 or
+       packed
+    :param slice(None) rows: slice of rows (e.g. the row range of a clade)
+       or list of rows (any order)
+    :param slice(None) columns: slice of columns (bases)
+    :param None block_cols: number of columns per block (defaults to the
+       column chunks of the alignment, in bases)
+    :param 2**28 buffer_size: bytes of alignment read at once (by each
+       worker)
+    :param 1 workers: number of worker processes
+    :param False raw: for packed alignments, yield the consensus as packed
+       bytes (holding the columns of the block, starting at an even column)
+
+    :yields: the first column of each block (in order), and its consensus
+       (int8 codes, or packed bytes)
+    """
+    packed = is_packed(alignment)
+    length = int(alignment.attrs['length']) if packed else alignment.shape[1]
+    if isinstance(rows, slice):
+        rows = range(*rows.indices(alignment.shape[0]))
+    rows = np.unique(np.asarray(rows, dtype='int64'))  # sorted reads
+    if not len(rows):
+        raise Exception('ERROR: consensus of no rows.')
+    first, last, _ = columns.indices(length)
+    block_cols, read_rows = _block_steps(alignment, rows, block_cols, buffer_size)
+    # blocks aligned on the chunks (and bytes of packed alignments)
+    starts = [first] + list(range((first // block_cols + 1) * block_cols, last, block_cols))
+    tasks = [(beg, min(last, end)) for beg, end in zip(starts, starts[1:] + [last])
+             if beg < last]
+    name = alignment.name.split('/')[-1]
+    if workers > 1:
+        if alignment.file.mode != 'r':
+            raise Exception('ERROR: the alignment file must be opened read-only '
+                            'to be read by worker processes.')
+        pool = get_context().Pool(workers, _init_reader,
+                                  (alignment.file.filename, name, rows, read_rows))
+        blocks = pool.imap(_reduce_task, tasks)
+    else:
+        pool = None
+        h5a = H5Alignment(alignment.file, name, chunk_cache=1)
+        blocks = (_reduce_block(h5a, rows, beg, end, read_rows) for beg, end in tasks)
+    try:
+        for (beg, end), value in zip(tasks, blocks):
+            yield beg, (value if raw or not packed else
+                        unpack_nt(value)[beg % 2:beg % 2 + end - beg])
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def clade_consensus(alignment, rows=slice(None), columns=slice(None), out=None,
+                    **kwargs):
+    """
+    Computes the consensus of a set of alignment rows (see iter_consensus,
+    kwargs being its block_cols, buffer_size and workers arguments).
+
+    :param None out: numpy array or one dimensional hdf5 dataset (e.g. in
+       another file, as the alignment file is read by the workers) of the
+       length of the columns, where each block is written once computed,
+       instead of assembling them in memory
+
+    :returns: the consensus (int8 codes), or out
+    """
+    first = columns.indices(int(alignment.attrs['length']) if is_packed(alignment)
+                            else alignment.shape[1])[0]
+    blocks = []
+    for beg, value in iter_consensus(alignment, rows, columns, **kwargs):
+        if out is None:
+            blocks.append(value)
+        else:
+            out[beg - first:beg - first + len(value)] = value
+    if out is not None:
+        return out
+    if not blocks:
+        return np.zeros(0, dtype=alignment.dtype)
+    return np.concatenate(blocks)
+
+
+def one_hot_profile(codes):
+    """
+    :param codes: numpy array of seq2num_nt codes (int8)
+
+    :returns: array of uint8 with an extra last dimension, of size
+       len(PROFILE_SYMBOLS), set to 1 for the symbol of each code
+    """
+    return _word_counts(np.take(_ONE_HOT, np.asarray(codes).view('uint8')))
+
+
+def _word_counts(words):
+    """
+    :returns: view as counts (uint8, last dimension of size
+       len(PROFILE_SYMBOLS)) of counts packed as the bytes of uint64 words
+    """
+    return words.view('uint8').reshape(words.shape + (8,))[..., :len(PROFILE_SYMBOLS)]
+
+
+def count_profile(codes, out=None, buffer_size=2**19):
+    """
+    Counts the symbols (A, C, G, T, gap, and any ambiguity as N, see
+    codec.PROFILE_SYMBOLS) of each column of a block of rows.
+
+    The code of each cell is looked up as one-hot 10 bits fields of a
+    uint64, so that the counts of all symbols are summed at once over up to
+    1023 rows.
+
+    :param codes: 2D numpy array of seq2num_nt codes (rows x columns)
+    :param None out: int64 array (columns x symbols) to which counts are
+       added
+    :param 2**19 buffer_size: bytes of the intermediate uint64 arrays (best
+       if they fit in the CPU cache)
+
+    :returns: int64 array of counts, columns x symbols
+    """
+    codes = np.asarray(codes).view('uint8')
+    if out is None:
+        out = np.zeros((codes.shape[1], len(PROFILE_SYMBOLS)), dtype='int64')
+    step = max(1, buffer_size // (8 * max(1, codes.shape[1])))
+    sums = np.zeros(codes.shape[1], dtype='uint64')
+    for beg in range(0, len(codes), _FIELD_MAX):
+        block = codes[beg:beg + _FIELD_MAX]
+        sums[:] = 0
+        if step == 1:  # wide rows
+            for row in block:
+                sums += np.take(_FIELD_ONE_HOT, row)
+        else:
+            for i in range(0, len(block), step):
+                sums += np.take(_FIELD_ONE_HOT, block[i:i + step]).sum(axis=0)
+        out += ((sums[:, None] >> _FIELD_SHIFTS) & np.uint64(_FIELD_MAX)).view('int64')
+    return out
+
+
+def iter_profile(alignment, rows=slice(None), columns=slice(None),
+                 block_cols=None, buffer_size=2**28):
+    """
+    Counts the symbols of each column of a set of alignment rows (e.g. the
+    leaves of a clade), out of core: the alignment is read by blocks of
+    columns, and of rows of at most buffer_size bytes.
+
+    :param alignment: hdf5 alignment dataset, int8 or packed
+    :param slice(None) rows: slice of rows (e.g. the row range of a clade)
+       or increasing list of rows
+    :param slice(None) columns: slice of columns (bases)
+    :param None block_cols: number of columns per block (defaults to the
+       column chunks of the alignment, in bases)
+    :param 2**28 buffer_size: bytes of alignment read at once
+
+    :yields: the first column of each block, and its counts (int64, columns
+       x symbols, see count_profile)
+    """
+    packed = is_packed(alignment)
+    length = int(alignment.attrs['length']) if packed else alignment.shape[1]
+    if isinstance(rows, slice):
+        rows = range(*rows.indices(alignment.shape[0]))
+    first, last, _ = columns.indices(length)
+    if not block_cols:
+        block_cols = ((alignment.chunks[1] * (2 if packed else 1))
+                      if alignment.chunks else 2**20)
+    for beg in range(first, last, block_cols):
+        end = min(last, beg + block_cols)
+        counts = np.zeros((end - beg, len(PROFILE_SYMBOLS)), dtype='int64')
+        read_rows = max(1, buffer_size // (end - beg))
+        for i in range(0, len(rows), read_rows):
+            sub = rows[i:i + read_rows]
+            sub = (slice(sub.start, sub.stop, sub.step) if isinstance(sub, range)
+                   else list(sub))
+            if packed:
+                block = unpack_nt(alignment[sub, beg // 2:packed_length(end)])
+                block = block[:, beg % 2:beg % 2 + end - beg]
+            else:
+                block = alignment[sub, beg:end]
+            count_profile(block, out=counts)
+        yield beg, counts
+
+
+def clade_profile(alignment, rows=slice(None), columns=slice(None), **kwargs):
+    """
+    Counts the symbols of each column of a set of alignment rows (see
+    iter_profile, holding the whole profile in memory: 48 bytes per column).
+
+    :returns: int64 array of counts, columns x symbols (see
+       codec.PROFILE_SYMBOLS)
+    """
+    blocks = [counts for _, counts in iter_profile(alignment, rows, columns, **kwargs)]
+    if not blocks:
+        return np.zeros((0, len(PROFILE_SYMBOLS)), dtype='int64')
+    return np.concatenate(blocks)
+
+
+def variable_sites(profile, min_count=1):
+    """
+    :param profile: array of counts, columns x symbols (see count_profile)
+    :param 1 min_count: minimum count of a base to be considered present
+
+    :returns: indices of the columns with more than one base (A, C, G, T)
+    """
+    return np.flatnonzero((profile[:, :4] >= min_count).sum(axis=1) > 1)
+
+
+def dump_profiles(tree, alignment, node_data, leaf_rows, block_cols=None,
+                  node_rows=None):
+    """
+    Computes, in one bottom-up pass, the allele count profile of every
+    internal node (see count_profile) as the sum of the profiles of its
+    children, and stores them in node_data/profile (internal nodes x columns
+    x symbols).
+
+    As for dump_consensus, the alignment is processed by blocks of columns,
+    memory holding two blocks of leaf rows and the profiles of the nodes
+    with a parent not yet computed. Profiles of clades of less than 256
+    leaves are summed as one uint64 word per column, one byte per symbol.
+
+    :param tree: ete4 Tree object
+    :param alignment: hdf5 alignment dataset (one row per leaf), int8 or
+       packed, its compression filters are used for the profile dataset
+    :param node_data: hdf5 group where to create the profile dataset
+    :param leaf_rows: dictionary mapping leaf names to alignment rows
+    :param None block_cols: number of columns (bases) processed at once
+       (defaults to the column chunks of the alignment)
+    :param None node_rows: dictionary mapping id(node) to its row in the
+       node_data datasets, as returned by dump_consensus (by default the
+       same rows are computed)
+
+    :returns: dictionary mapping id(node) to its row in node_data/profile,
+       for internal nodes
+    """
+    order = heavy_first_postorder(tree)
+    node_rows = node_rows or _node_rows(order)
+    nleaves = {}
+    for node in order:
+        nleaves[id(node)] = sum(nleaves[id(c)] for c in node.children) or 1
+    packed = is_packed(alignment)
+    length = int(alignment.attrs['length']) if packed else alignment.shape[1]
+    if not block_cols:
+        block_cols = ((alignment.chunks[1] * (2 if packed else 1))
+                      if alignment.chunks else 2**20)
+    if packed:  # blocks of whole bytes
+        block_cols += block_cols % 2
+    block_cols = min(length, block_cols)
+    dtype = np.dtype('uint16' if len(leaf_rows) < 2**16 else 'uint32')
+    nsym = len(PROFILE_SYMBOLS)
+    profile = node_data.create_dataset(
+        'profile', (len(node_rows), length, nsym), dtype=dtype,
+        maxshape=(None, length, nsym),  # new nodes (see flush.py)
+        chunks=(1, block_cols, nsym), compression=alignment.compression,
+        compression_opts=alignment.compression_opts, shuffle=alignment.shuffle)
+    profile.attrs['symbols'] = PROFILE_SYMBOLS
+    for beg in range(0, length, block_cols):
+        end = min(length, beg + block_cols)
+        if packed:
+            leaves = _RowBlockReader(alignment, beg // 2, packed_length(end))
+        else:
+            leaves = _RowBlockReader(alignment, beg, end)
+        done = {}  # id(node) -> profile of nodes with parent not computed
+        for node in order:
+            if not node.children:
+                codes = leaves[leaf_rows[node.name]]
+                if packed:
+                    codes = unpack_nt(codes, end - beg)
+                done[id(node)] = np.take(_ONE_HOT, codes.view('uint8'))
+                continue
+            values = [done.pop(id(child)) for child in node.children]
+            if nleaves[id(node)] < 256:  # counts fit in the bytes of words
+                value = values[0].copy()
+                for other in values[1:]:
+                    value += other
+                counts = _word_counts(value).astype(dtype)
+            else:
+                value = np.zeros((end - beg, nsym), dtype=dtype)
+                for other in values:
+                    value += _word_counts(other) if other.ndim == 1 else other
+                counts = value
+            done[id(node)] = value
+            profile[node_rows[id(node)], beg:end] = counts
+    return node_rows
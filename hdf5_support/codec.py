@@ -0,0 +1,421 @@
+"""
+Vectorized conversion between sequence symbols and 8-bits integers.
+
+Each alphabet is described by a 256 entries lookup table (LUT) in both
+directions, so that a whole sequence is converted with a single numpy
+indexing operation over its bytes instead of one dictionary lookup per
+symbol.
+
+Codons of nucleotide codes are translated to amino-acid codes the same way,
+with a lookup table indexed by the three bases of each codon (see
+translate_nt), so that protein views of a coding region are obtained from
+the nucleotide alignment without storing a second one.
+"""
+import numpy as np
+
+
+# symbol -> code. Codes are chosen so that bitwise AND of two symbols gives
+# the code of their ambiguity (IUPAC) symbol.
+NT_CODES = {
+    'A': int('00100101', 2),
+    'C': int('01101010', 2),
+    'G': int('10010110', 2),
+    'T': int('11011001', 2),
+
+    'W': int('00000001', 2),  # A or T
+    'S': int('00000010', 2),  # C or G
+    'R': int('00000100', 2),  # A or G
+    'Y': int('01001000', 2),  # C or T
+    'K': int('10010000', 2),  # G or T
+    'M': int('00100000', 2),  # A or C
+
+    'N': int('00000000', 2),
+    '-': int('11111111', 2),
+}
+
+# symbol -> code. Consensus through bitwise AND will give rise to some groups
+# based on BLOSUM62 matrix.
+AA_CODES = {
+    'C': int('00110011', 2),  # \
+    'S': int('01100011', 2),  #  | - small and polar
+    'T': int('11000011', 2),  # /
+    'P': int('00110110', 2),  # \
+    'A': int('01100110', 2),  #  | - small and non-polar
+    'G': int('11000110', 2),  # /
+    'N': int('00111100', 2),  # \
+    'D': int('01101100', 2),  #  | _ polar or acidic
+    'E': int('11001100', 2),  #  |
+    'Q': int('10011100', 2),  # /
+    'H': int('00110101', 2),  # \
+    'R': int('01100101', 2),  #  | - basic
+    'K': int('11000101', 2),  # /
+    'M': int('00111001', 2),  # \
+    'L': int('01101001', 2),  #  |_ large and hydrophobic
+    'I': int('11001001', 2),  #  |
+    'V': int('10011001', 2),  # /
+    'F': int('00111010', 2),  # \
+    'Y': int('01101010', 2),  #  | - aromatic
+    'W': int('11001010', 2),  # /
+    'X': int('00000000', 2),
+    '-': int('11111111', 2),
+    '*': int('11110000', 2),  # stop codon, gives X in consensus with others
+}
+
+# code -> symbol, for codes that can only be reached through consensus
+AA_GROUP_SYMBOLS = {
+    # official conventions:
+    int('01001100', 2): '-',  # negatively charged
+    int('00101100', 2): 'B',  # N or D
+    int('10001100', 2): 'Z',  # E or Q
+    int('01001001', 2): 'J',  # I or L
+
+    int('00100011', 2): 'p',  # \
+    int('01000011', 2): 'p',  #  | - small and polar
+    int('00000011', 2): 'p',  # /
+
+    int('00100110', 2): 's',  # \
+    int('01000110', 2): 's',  #  | - small and non-polar
+    int('00000110', 2): 's',  # /
+
+    int('00011100', 2): 'a',  # \
+    # int('00101100', 2): 'a',  #  |
+    # int('01001100', 2): 'a',  #  | - polar or acidic
+    # int('10001100', 2): 'a',  #  |
+    int('00001100', 2): 'a',  # /
+
+    int('00100101', 2): '+',  # \
+    int('01000101', 2): '+',  #  | - basic
+    int('00000101', 2): '+',  # /
+
+    int('00011001', 2): 'l',  # \
+    int('00101001', 2): 'l',  #  |
+    # int('01001001', 2): 'l',  #  | - large and hydrophobic
+    int('10001001', 2): 'l',  #  |
+    int('00001001', 2): 'l',  # /
+
+    int('00101010', 2): 'o',  # \
+    int('01001010', 2): 'o',  #  | - aromatic
+    int('00001010', 2): 'o',  # /
+
+    # everything else is also X...
+}
+
+
+def _encoding_table(codes, lowercase=False):
+    """
+    Builds the symbol -> code lookup table of an alphabet.
+
+    :param codes: dictionary mapping single character symbols to codes
+    :param False lowercase: also accept lowercase version of the symbols
+
+    :returns: a LUT of 256 uint8 codes, and a LUT of 256 booleans telling
+       which bytes are valid symbols
+    """
+    lut = np.zeros(256, dtype='uint8')
+    valid = np.zeros(256, dtype=bool)
+    for symbol, code in codes.items():
+        for s in {symbol, symbol.lower()} if lowercase else {symbol}:
+            lut[ord(s)] = code
+            valid[ord(s)] = True
+    return lut, valid
+
+
+def _decoding_table(codes, default=None):
+    """
+    Builds the code -> symbol lookup table of an alphabet.
+
+    :param codes: dictionary mapping codes to single character symbols
+    :param None default: symbol used for codes not in codes, if None these
+       codes are flagged as invalid
+
+    :returns: a LUT of 256 uint8 (ASCII) symbols, and a LUT of 256 booleans
+       telling which codes are valid
+    """
+    lut = np.full(256, ord(default or '?'), dtype='uint8')
+    valid = np.full(256, default is not None, dtype=bool)
+    for code, symbol in codes.items():
+        lut[code] = ord(symbol)
+        valid[code] = True
+    return lut, valid
+
+
+NT_ENCODER = _encoding_table(NT_CODES, lowercase=True)
+NT_DECODER = _decoding_table({v: k for k, v in NT_CODES.items()})
+AA_ENCODER = _encoding_table(AA_CODES)
+AA_DECODER = _decoding_table(
+    {**AA_GROUP_SYMBOLS, **{v: k for k, v in AA_CODES.items()}}, default='X')
+
+# code -> index of its column in allele count profiles (see
+# clade_data.count_profile): one per base, gaps, and any ambiguity as N
+PROFILE_SYMBOLS = 'ACGT-N'
+NT_PROFILE_INDEX = np.full(256, PROFILE_SYMBOLS.index('N'), dtype='uint8')
+NT_PROFILE_INDEX[[NT_CODES[s] for s in PROFILE_SYMBOLS[:-1]]] = range(5)
+
+
+def as_bytes(seq):
+    """
+    :param seq: sequence as a str, bytes, bytearray or numpy array of uint8
+
+    :returns: numpy array of uint8 with the (ASCII) bytes of seq, not copied
+       when possible
+    """
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return np.frombuffer(seq, dtype='uint8')
+
+
+def _unknown(buf, valid, what):
+    """
+    Raise listing all distinct unknown symbols and how many times they are
+    found, instead of failing at the first one.
+    """
+    bad = ~valid[buf]
+    if not bad.any():
+        return
+    positions = np.flatnonzero(bad)
+    values, counts = np.unique(buf[positions], return_counts=True)
+    found = ', '.join(f'{what(v)} (x{c})' for v, c in zip(values, counts))
+    raise Exception(f'ERROR: {len(positions)} unknown symbols found, first '
+                    f'at position {positions[0]}: {found}')
+
+
+def encode(seq, encoder, out=None):
+    """
+    :param seq: sequence as str or bytes-like object
+    :param encoder: a LUT pair as returned by _encoding_table
+    :param None out: numpy array of int8 of the same length as seq in which
+       to write the result (e.g. a row of a preallocated block)
+
+    :returns: numpy array of int8
+    """
+    lut, valid = encoder
+    buf = as_bytes(seq)
+    _unknown(buf, valid, lambda v: repr(chr(v)))
+    if out is None:
+        return lut[buf].view('int8')
+    np.take(lut, buf, out=out.view('uint8'))
+    return out
+
+
+def decode(sequence, decoder):
+    """
+    :param sequence: numpy array of int8 (or uint8)
+    :param decoder: a LUT pair as returned by _decoding_table
+
+    :returns: str
+    """
+    lut, valid = decoder
+    codes = np.asarray(sequence)
+    if codes.dtype != 'uint8':
+        codes = codes.astype('int8', copy=False).view('uint8')
+    _unknown(codes, valid, lambda v: f'{v:08b}')
+    return lut[codes].tobytes().decode()
+
+
+def seq2num_nt(seq):
+    """
+    Converts nucleotide symbols (upper or lower case) to 8-bits integers
+    """
+    return encode(seq, NT_ENCODER)
+
+
+def seq2num_aa(seq):
+    """
+    Converts amino-acid symbols to 8-bits integers.
+    Consensus through bitwise AND will give rise to some groups based
+    on BLOSUM62 matrix.
+    """
+    return encode(seq, AA_ENCODER)
+
+
+def num2seq_nt(sequence):
+    """
+    Converts 8-bits integers back to nucleotide symbols
+    """
+    return decode(sequence, NT_DECODER)
+
+
+def num2seq_aa(sequence):
+    """
+    Converts 8-bits integers back to amino-acid symbols, including the
+    group symbols of partial consensus (unknown codes are given as X).
+    """
+    return decode(sequence, AA_DECODER)
+
+
+# Packed nucleotides: 4 bits per base, two bases per byte (first base in the
+# high bits). Each bit marks a base that is NOT possible (A, C, G, T from
+# the lowest bit), so that, as with seq2num_nt codes, the bitwise AND of
+# several bases gives the set of bases observed (their IUPAC symbol), gaps
+# (all bits set) being ignored and N (no bit set) absorbing everything.
+_NT4_BASES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG',
+    'N': 'ACGT', '-': '',
+}
+NT4_CODES = {symbol: 0b1111 ^ sum(1 << 'ACGT'.index(b) for b in bases)
+             for symbol, bases in _NT4_BASES.items()}
+
+NT4_ENCODER = _encoding_table(NT4_CODES, lowercase=True)
+NT4_DECODER = _decoding_table({v: k for k, v in NT4_CODES.items()})
+
+# seq2num_nt codes <-> 4 bits codes (3 bases ambiguities have no 8 bits code
+# and become N)
+_NT_TO_NT4 = np.zeros(256, dtype='uint8')
+for _symbol, _code in NT_CODES.items():
+    _NT_TO_NT4[_code] = NT4_CODES[_symbol]
+_NT4_TO_NT = np.zeros(16, dtype='uint8')
+for _symbol, _code in NT4_CODES.items():
+    _NT4_TO_NT[_code] = NT_CODES.get(_symbol, NT_CODES['N'])
+# byte -> its two bases, as seq2num_nt codes (viewed as one uint16 to be
+# looked up with np.take)
+_UNPACK_NT = np.stack([_NT4_TO_NT[np.arange(256) >> 4],
+                       _NT4_TO_NT[np.arange(256) & 0b1111]], axis=1).view('uint16')[:, 0]
+
+
+def _pack(nibbles, out=None):
+    """
+    :param nibbles: array of 4 bits codes, last dimension being the sequence
+    """
+    if nibbles.shape[-1] % 2:  # pad with a gap (neutral in consensus)
+        pad = np.full(nibbles.shape[:-1] + (1,), NT4_CODES['-'], dtype='uint8')
+        nibbles = np.concatenate((nibbles, pad), axis=-1)
+    out = np.left_shift(nibbles[..., 0::2], 4, out=out)
+    out |= nibbles[..., 1::2]
+    return out
+
+
+def packed_length(length):
+    """
+    :returns: number of bytes needed to pack length bases
+    """
+    return (length + 1) // 2
+
+
+def seq2packed_nt(seq, out=None):
+    """
+    Converts nucleotide symbols (IUPAC, upper or lower case) to packed 4 bits
+    codes, two per byte.
+
+    :param None out: numpy array of uint8 of length packed_length(len(seq))
+
+    :returns: numpy array of uint8
+    """
+    return _pack(encode(seq, NT4_ENCODER).view('uint8'), out)
+
+
+def pack_nt(sequences):
+    """
+    :param sequences: numpy array of seq2num_nt codes (int8), 1D or 2D
+
+    :returns: numpy array of uint8, with the last dimension halved
+    """
+    return _pack(_NT_TO_NT4[np.asarray(sequences).view('uint8')])
+
+
+def unpack_nt(packed, length=None):
+    """
+    :param packed: numpy array of packed codes (uint8), 1D or 2D
+    :param None length: number of bases (to drop the padding of odd lengths)
+
+    :returns: numpy array of seq2num_nt codes (int8)
+    """
+    packed = np.asarray(packed).view('uint8')
+    codes = np.take(_UNPACK_NT, packed).view('int8')
+    return codes[..., :length]
+
+
+def packed2seq_nt(packed, length=None):
+    """
+    Converts packed 4 bits codes back to nucleotide symbols (IUPAC).
+    """
+    packed = np.asarray(packed).view('uint8')
+    nibbles = np.stack([packed >> 4, packed & 0b1111], axis=-1).reshape(-1)
+    return decode(nibbles[:length], NT4_DECODER)
+
+
+# Codon translation (standard genetic code). Bases, ambiguities and gaps of
+# seq2num_nt codes are indexed from 0 to 11, each codon (3 indexes) being
+# looked up in a table of 12**3 amino-acid codes. Ambiguous codons give the
+# bitwise AND of all the amino acids they may code for (e.g. the amino acid
+# itself for GCN, or a group symbol), codons of gaps a gap, and partially
+# gapped codons X.
+_CODON_BASES = 'TCAG'
+_GENETIC_CODE = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+_NT_SYMBOLS = list(NT_CODES)
+_NT_INDEX = np.full(256, _NT_SYMBOLS.index('N'), dtype='uint16')
+_NT_INDEX[[NT_CODES[s] for s in _NT_SYMBOLS]] = range(len(_NT_SYMBOLS))
+
+
+def _codon_table():
+    amino_acids = {a + b + c: _GENETIC_CODE[16 * i + 4 * j + k]
+                   for i, a in enumerate(_CODON_BASES)
+                   for j, b in enumerate(_CODON_BASES)
+                   for k, c in enumerate(_CODON_BASES)}
+    lut = np.zeros(len(_NT_SYMBOLS) ** 3, dtype='uint8')
+    for i, a in enumerate(_NT_SYMBOLS):
+        for j, b in enumerate(_NT_SYMBOLS):
+            for k, c in enumerate(_NT_SYMBOLS):
+                index = (i * len(_NT_SYMBOLS) + j) * len(_NT_SYMBOLS) + k
+                if a == b == c == '-':
+                    lut[index] = AA_CODES['-']
+                    continue
+                code = AA_CODES['-']
+                for x in _NT4_BASES[a]:
+                    for y in _NT4_BASES[b]:
+                        for z in _NT4_BASES[c]:
+                            code &= AA_CODES[amino_acids[x + y + z]]
+                # partial gaps have no base to expand
+                lut[index] = code if '-' not in (a, b, c) else AA_CODES['X']
+    return lut
+
+
+CODON_TABLE = _codon_table()
+
+# seq2num_nt code -> code of the complementary base
+_NT_COMPLEMENT = np.zeros(256, dtype='uint8')
+for _symbol, _other in zip('ACGTWSRYKMN-', 'TGCAWSYRMKN-'):
+    _NT_COMPLEMENT[NT_CODES[_symbol]] = NT_CODES[_other]
+
+
+def translate_nt(codes, reverse=False):
+    """
+    Translates nucleotide codes to amino-acid codes (see seq2num_aa), one
+    per codon, with a single lookup of all codons.
+
+    :param codes: numpy array of seq2num_nt codes (int8), 1D or 2D (rows x
+       bases), the number of bases being a multiple of 3
+    :param False reverse: translate the reverse complement of the sequences
+
+    :returns: numpy array of int8, with the last dimension divided by 3
+    """
+    codes = np.asarray(codes).view('uint8')
+    if codes.shape[-1] % 3:
+        raise Exception(f'ERROR: {codes.shape[-1]} bases is not a whole number '
+                        'of codons.')
+    if reverse:
+        codes = np.take(_NT_COMPLEMENT, codes[..., ::-1])
+    index = np.take(_NT_INDEX, codes).reshape(codes.shape[:-1] + (-1, 3))
+    index = (index[..., 0] * len(_NT_SYMBOLS) + index[..., 1]) * len(_NT_SYMBOLS) + index[..., 2]
+    return np.take(CODON_TABLE, index).view('int8')
+
+
+def is_protein(dataset):
+    """
+    :param dataset: hdf5 alignment dataset
+
+    :returns: True if it stores amino-acid codes (see seq2num_aa), its
+       attribute alphabet being then 'aa'
+    """
+    return dataset.attrs.get('alphabet') == 'aa'
+
+
+def is_packed(dataset):
+    """
+    :param dataset: hdf5 alignment dataset
+
+    :returns: True if it stores packed 4 bits codes (see pack_nt), its
+       attribute length being then the number of bases of each row
+    """
+    return dataset.attrs.get('encoding') == 'nt4'
@@ -0,0 +1,294 @@
+"""
+Pairwise distances between the sequences of the leaf alignment of h5trees.
+
+Distances are computed by tiles of rows (pairs of tiles, each pair giving
+the distances of all its pairs of rows), the alignment being read by
+blocks of columns aligned on its chunks, so that memory is bounded whatever
+the number of sequences, and tiles can be computed in parallel by worker
+processes.
+
+Only sites where both sequences have an unambiguous symbol (A, C, G or T,
+or one of the 20 amino acids) are compared. Each block of a tile is
+converted to one-hot vectors of its symbols, so that, for a pair of tiles,
+the number of sites compared and of identical symbols are two matrix
+products (float32, computed by BLAS), the mismatches being their
+difference. (With seq2num_nt codes, the bitwise AND of two different bases
+is not 0, but the code of their ambiguity.)
+
+The distances of all pairs are stored in condensed form (the upper
+triangle, row by row, as in scipy.spatial.distance.squareform), or only
+the k nearest neighbours of each sequence, in a group of the h5tree (see
+dump_distances).
+"""
+from multiprocessing import get_context
+
+import h5py
+import numpy as np
+
+from codec          import NT_CODES, AA_CODES, is_packed, is_protein
+from query          import H5Alignment
+
+
+METRICS = ('p', 'hamming')
+
+_NT_SYMBOLS = 'ACGT'
+_AA_SYMBOLS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def _symbol_table(codes, symbols):
+    """
+    :returns: array of float32 (256 codes x symbols), the one-hot vector of
+       each code (all zeros for gaps and ambiguities)
+    """
+    table = np.zeros((256, len(symbols)), dtype='float32')
+    for i, symbol in enumerate(symbols):
+        table[codes[symbol], i] = 1
+    return table
+
+
+def condensed_index(n, i, j):
+    """
+    :param n: number of sequences
+    :param i: position of a sequence
+    :param j: position of another sequence
+
+    :returns: position of the distance between i and j in the condensed
+       matrix
+    """
+    if i > j:
+        i, j = j, i
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def _tile_rows(read_cols, block_cols, nsym, buffer_size):
+    """
+    :returns: number of rows of the tiles, so that a pair of tiles takes
+       about buffer_size bytes: the columns read (int8), one-hot vectors
+       of a block of columns (float32), and counts, products and distances
+       (float64, 40 bytes per pair of rows)
+    """
+    # 40 r**2 + r * (2 read_cols + 8 block_cols (nsym + 1)) = buffer_size
+    b = 2 * read_cols + 8 * block_cols * (nsym + 1)
+    return max(1, int((-b + (b * b + 160 * buffer_size) ** 0.5) / 80))
+
+
+def _distances(h5a, rows_i, rows_j, reads, block_cols, table, metric):
+    """
+    :returns: distances between two tiles of rows (float32 for p-distances,
+       NaN without sites compared, uint32 for hamming)
+    """
+    same = rows_i is rows_j
+    mismatches = np.zeros((len(rows_i), len(rows_j)))
+    compared = np.zeros((len(rows_i), len(rows_j)))
+    for beg, end in reads:
+        codes_i = h5a.read_rows(rows_i, slice(beg, end)).view('uint8')
+        codes_j = codes_i if same else h5a.read_rows(rows_j, slice(beg, end)).view('uint8')
+        for c in range(0, end - beg, block_cols):
+            x = np.take(table, codes_i[:, c:c + block_cols], axis=0)
+            y = x if same else np.take(table, codes_j[:, c:c + block_cols], axis=0)
+            both = x.sum(axis=2) @ y.sum(axis=2).T
+            compared += both
+            mismatches += both - x.reshape(len(x), -1) @ y.reshape(len(y), -1).T
+    if metric == 'hamming':
+        return mismatches.astype('uint32')
+    out = np.full(mismatches.shape, np.nan, dtype='float32')
+    np.divide(mismatches, compared, out=out, where=compared > 0, casting='unsafe')
+    return out
+
+
+def _tile_distances(h5a, pair, rows, *args):
+    """
+    :returns: distances between a pair of tiles, given as (start, end)
+       positions in rows
+    """
+    (i0, i1), (j0, j1) = pair
+    rows_i = rows[i0:i1]
+    rows_j = rows_i if (i0, i1) == (j0, j1) else rows[j0:j1]
+    return _distances(h5a, rows_i, rows_j, *args)
+
+
+def _init_worker(fname, name, swmr, args):
+    global _h5a, _args
+    # one chunk in cache: the rows of a tile are read once per column block
+    _h5a = H5Alignment(h5py.File(fname, 'r', libver='latest', swmr=swmr), name,
+                       chunk_cache=1)
+    _args = args
+
+
+def _tile_task(pair):
+    return _tile_distances(_h5a, pair, *_args)
+
+
+def iter_distances(alignment, rows=None, columns=slice(None), metric='p',
+                   tile_rows=None, block_cols=None, buffer_size=2**28, workers=1):
+    """
+    Computes the distances between all pairs of a set of sequences, by pairs
+    of tiles of rows.
+
+    With several workers, pairs of tiles are computed in parallel by a pool
+    of processes, each opening the file read-only (the file should then not
+    be open for writing, unless in SWMR mode, see dump_distances). Memory
+    used is about buffer_size and one chunk of the alignment per worker.
+
+    :param alignment: hdf5 alignment dataset of the leaf_data group, int8 or
+       packed, of nucleotides or amino acids
+    :param None rows: rows of the sequences (by default all rows)
+    :param slice(None) columns: slice of columns (sites) compared
+    :param 'p' metric: 'p' for p-distances (proportion of the sites compared
+       that differ), or 'hamming' for the number of sites that differ
+    :param None tile_rows: number of rows of the tiles, by default as many
+       as fit in buffer_size
+    :param None block_cols: number of columns converted to one-hot vectors
+       at once (by default 1024, at most the columns read at once, a column
+       chunk of the alignment)
+    :param 2**28 buffer_size: bytes used for a pair of tiles (by each
+       worker)
+    :param 1 workers: number of worker processes
+
+    :yields: the positions (in rows) of the first rows of both tiles, and
+       their distances (2D array), for pairs of tiles with the first one
+       before or equal to the second
+    """
+    if metric not in METRICS:
+        raise Exception(f'ERROR: unknown metric {metric}, should be one of '
+                        f'{", ".join(METRICS)}.')
+    packed = is_packed(alignment)
+    length = int(alignment.attrs['length']) if packed else alignment.shape[1]
+    rows = np.arange(alignment.shape[0]) if rows is None else np.asarray(rows, dtype='int64')
+    if is_protein(alignment):
+        table = _symbol_table(AA_CODES, _AA_SYMBOLS)
+    else:
+        table = _symbol_table(NT_CODES, _NT_SYMBOLS)
+    first, last, _ = columns.indices(length)
+    read_cols = ((alignment.chunks[1] * (2 if packed else 1)) if alignment.chunks
+                 else 2**16)
+    block_cols = min(block_cols or 1024, read_cols)
+    # blocks read aligned on the chunks
+    starts = [first] + list(range((first // read_cols + 1) * read_cols, last, read_cols))
+    reads = [(beg, min(last, end)) for beg, end in zip(starts, starts[1:] + [last])
+             if beg < last]
+    tile_rows = tile_rows or _tile_rows(read_cols, block_cols, table.shape[1], buffer_size)
+    tiles = [(beg, min(len(rows), beg + tile_rows)) for beg in range(0, len(rows), tile_rows)]
+    pairs = [(tile_i, tile_j) for i, tile_i in enumerate(tiles) for tile_j in tiles[i:]]
+    args = (rows, reads, block_cols, table, metric)
+    name = alignment.name.split('/')[-1]
+    if workers > 1:
+        if alignment.file.mode != 'r' and not alignment.file.swmr_mode:
+            raise Exception('ERROR: the alignment file must be opened read-only '
+                            '(or in SWMR mode) to be read by worker processes.')
+        pool = get_context().Pool(workers, _init_worker,
+                                  (alignment.file.filename, name,
+                                   alignment.file.swmr_mode, args))
+        results = pool.imap(_tile_task, pairs)
+    else:
+        pool = None
+        h5a = H5Alignment(alignment.file, name, chunk_cache=1)
+        results = (_tile_distances(h5a, pair, *args) for pair in pairs)
+    try:
+        for ((i0, _), (j0, _)), values in zip(pairs, results):
+            yield i0, j0, values
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _merge_nearest(best, best_ids, values, ids, k):
+    """
+    Keeps the k smallest distances of each row, among the best ones so far
+    and new ones (NaN, no site compared, being the largest).
+    """
+    values = np.concatenate((best, values), axis=1)
+    ids = np.concatenate((best_ids, np.broadcast_to(ids, (len(values), len(ids)))), axis=1)
+    keys = np.where(np.isnan(values), np.inf, values)
+    if keys.shape[1] > k:
+        keep = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        values = np.take_along_axis(values, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    return values, ids
+
+
+def dump_distances(fname, rows=None, k=None, name='distances', **kwargs):
+    """
+    Computes the distances between the sequences of an h5tree (see
+    iter_distances), and stores them in a group of the h5tree, with the
+    metric as attribute:
+
+      - condensed: distances of all pairs (upper triangle of the matrix,
+        row by row, see condensed_index), written tile by tile
+      - or neighbors and neighbor_distances: alignment rows and distances of
+        the k nearest neighbours of each sequence, closest first (-1 rows,
+        and NaN or 0 distances, for neighbours without any site compared)
+      - rows: alignment rows of the sequences, if not all
+
+    The distances stored follow the alignment rows (and the rows given), so
+    that they should be computed again after rows are appended or sorted.
+
+    With several workers, the file is switched to SWMR mode once the group
+    is created, so that workers can read the alignment while distances are
+    written.
+
+    :param fname: path to the h5tree
+    :param None rows: rows of the sequences (by default all rows)
+    :param None k: number of nearest neighbours stored, instead of the
+       condensed matrix
+    :param 'distances' name: name of the group (replaced if it exists)
+    :param kwargs: columns, metric, tile_rows, block_cols, buffer_size and
+       workers arguments of iter_distances
+    """
+    h5f = h5py.File(fname, 'r+', libver='latest')
+    alignment = h5f['leaf_data']['alignment']
+    n = alignment.shape[0] if rows is None else len(rows)
+    if n < 2:
+        raise Exception('ERROR: distances need at least two sequences.')
+    metric = kwargs.get('metric', 'p')
+    dtype = 'uint32' if metric == 'hamming' else 'float32'
+    if name in h5f:
+        del h5f[name]
+    group = h5f.create_group(name)
+    group.attrs['metric'] = metric
+    if rows is not None:
+        rows = np.asarray(rows, dtype='int64')
+        group.create_dataset('rows', data=rows)
+    if k is None:
+        npairs = n * (n - 1) // 2
+        condensed = group.create_dataset('condensed', (npairs,), dtype=dtype,
+                                         chunks=(min(npairs, 2**20),))
+    else:
+        # datasets cannot be created in SWMR mode
+        k = min(k, n - 1)
+        neighbors = group.create_dataset('neighbors', (n, k), dtype='int64')
+        distances = group.create_dataset('neighbor_distances', (n, k), dtype=dtype)
+        best = np.full((n, k), np.nan)
+        best_ids = np.full((n, k), -1, dtype='int64')
+    if kwargs.get('workers', 1) > 1:
+        h5f.swmr_mode = True
+    for i0, j0, values in iter_distances(alignment, rows, **kwargs):
+        ni, nj = values.shape
+        if k is None:
+            for a in range(ni):
+                i = i0 + a
+                beg = max(j0, i + 1)
+                if beg < j0 + nj:
+                    start = condensed_index(n, i, beg)
+                    condensed[start:start + j0 + nj - beg] = values[a, beg - j0:]
+            continue
+        values = values.astype('float64')
+        if i0 == j0:  # not its own neighbour
+            np.fill_diagonal(values, np.nan)
+        best[i0:i0 + ni], best_ids[i0:i0 + ni] = _merge_nearest(
+            best[i0:i0 + ni], best_ids[i0:i0 + ni], values, np.arange(j0, j0 + nj), k)
+        if i0 != j0:
+            best[j0:j0 + nj], best_ids[j0:j0 + nj] = _merge_nearest(
+                best[j0:j0 + nj], best_ids[j0:j0 + nj], values.T, np.arange(i0, i0 + ni), k)
+    if k is not None:
+        keys = np.where(np.isnan(best), np.inf, best)
+        order = np.argsort(keys, axis=1, kind='stable')
+        best = np.take_along_axis(best, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_ids[np.isnan(best)] = -1
+        neighbors[...] = best_ids if rows is None else np.where(best_ids < 0, -1,
+                                                                rows[best_ids])
+        if metric == 'hamming':
+            best = np.nan_to_num(best)
+        distances[...] = best
+    h5f.close()
@@ -0,0 +1,559 @@
+"""
+Dirty tracking of h5trees loaded for writing (load_h5tree(..., mode='r+')),
+and incremental flush of their changes back to the file.
+
+When loaded, the state of each node (parent, children, name, dist, support
+and properties) is recorded. On flush, nodes are compared to their record
+to find those added, removed, moved (new parent), reordered (new children)
+or edited (new properties), and only the records of these nodes, and of
+the ancestors whose set of leaves changed, are rewritten:
+
+  - group-per-node layout: groups of moved, added or renamed nodes are
+    relinked (hdf5 link moves, no copy of their subtree), and groups of
+    removed nodes deleted
+  - array layout: topology records of the nodes are rewritten in place,
+    ids of removed nodes being reused for added nodes (or the datasets
+    extended)
+
+In both layouts, properties of added and edited nodes are rewritten in
+their columns (see node_props.py).
+
+For ancestors whose leaves changed, the range of alignment rows they span
+is updated (or removed if their leaves do not span contiguous rows any
+more), as well as their consensus and allele count profiles in node_data,
+recomputed from those of their children.
+"""
+from hashlib        import md5
+
+import numpy as np
+
+from codec          import unpack_nt, packed_length, is_packed
+from clade_data     import one_hot_profile
+from node_props     import MANAGED, write_props
+
+
+def _leaf_value(name):
+    return int(md5((name or '').encode()).hexdigest(), 16)
+
+
+def _depth(node):
+    depth = 0
+    while node.up is not None:
+        node, depth = node.up, depth + 1
+    return depth
+
+
+def _same(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:  # numpy arrays
+        return np.array_equal(a, b)
+
+
+class H5TreeState:
+    """
+    Records of the nodes of a loaded h5tree, as stored in its file.
+
+    :param tree: ete4 Tree loaded with load_h5tree (not lazy)
+
+    :attr records: dictionary mapping id(node) to the record of the node
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.h5file = tree.props['h5node'].file
+        self.layout = 'arrays' if 'topology' in self.h5file else 'groups'
+        self.leaf_data = list(self.h5file['leaf_data'])
+        self.node_data = list(self.h5file.get('node_data', ()))
+        self.managed = MANAGED | set(self.leaf_data) | set(self.node_data)
+        self.records = {}
+        for node in tree.traverse('postorder'):
+            self._record(node)
+
+    def props(self, node):
+        """
+        :returns: dictionary of the user properties of node (including name,
+           dist and support)
+        """
+        props = {k: v for k, v in node.props.items() if k not in self.managed}
+        props.update(name=node.name, dist=node.dist, support=node.support)
+        return props
+
+    def _record(self, node, clade=None):
+        if clade is None:
+            clade = (sum(self.records[id(c)]['clade'] for c in node.children) % 2**128
+                     if node.children else _leaf_value(node.name))
+        self.records[id(node)] = {
+            'node': node,  # keeps the node alive, so that its id is not reused
+            'parent': id(node.up) if node.up is not None else None,
+            'children': tuple(id(c) for c in node.children),
+            'props': self.props(node),
+            'clade': clade}
+
+    def _in_tree(self, node, known):
+        path = []
+        while id(node) not in known:
+            if node is self.tree:
+                known[id(node)] = True
+                break
+            path.append(node)
+            if node.up is None or not any(c is node for c in node.up.children):
+                known[id(node)] = False
+                break
+            node = node.up
+        result = known[id(node)]
+        for n in path:
+            known[id(n)] = result
+        return result
+
+    def changes(self, touched=None):
+        """
+        Compares nodes with their records.
+
+        :param None touched: nodes known to be the only ones modified (along
+           with their parents and children, old and new), to avoid comparing
+           all nodes
+
+        :returns: dictionary with lists of nodes 'added', 'removed', 'moved',
+           'reordered' and 'edited'
+        """
+        if touched is None:
+            candidates = {id(n): n for n in self.tree.traverse()}
+            candidates.update((k, r['node']) for k, r in self.records.items())
+        else:
+            candidates = {}
+            for node in touched:
+                candidates[id(node)] = node
+                for n in node.children + ([node.up] if node.up else []):
+                    candidates[id(n)] = n
+                rec = self.records.get(id(node))
+                if rec:
+                    for k in rec['children'] + ((rec['parent'],) if rec['parent'] else ()):
+                        candidates[k] = self.records[k]['node']
+        known = {}
+        changes = {'added': [], 'removed': [], 'moved': [], 'reordered': [],
+                   'edited': []}
+        todo = list(candidates.values())
+        seen = set()
+        while todo:
+            node = todo.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            rec = self.records.get(id(node))
+            if not self._in_tree(node, known):
+                if rec:  # removed, with the descendants it had
+                    changes['removed'].append(node)
+                    todo.extend(self.records[k]['node'] for k in rec['children'])
+                continue
+            if rec is None:  # added, with its new descendants
+                changes['added'].append(node)
+                todo.extend(node.children)
+                continue
+            parent = id(node.up) if node.up is not None else None
+            if parent != rec['parent']:
+                changes['moved'].append(node)
+            if tuple(id(c) for c in node.children) != rec['children']:
+                changes['reordered'].append(node)
+                todo.extend(node.children)
+            props = self.props(node)
+            if props.keys() != rec['props'].keys() or not all(
+                    _same(v, rec['props'][k]) for k, v in props.items()):
+                changes['edited'].append(node)
+        return changes
+
+    def _clades(self, changes):
+        """
+        Recomputes the clade value (sum of md5 of leaf names) of the nodes
+        whose leaves may have changed and of their ancestors.
+
+        :returns: the list of these nodes (deepest first), and a dictionary
+           mapping id(node) to the new clade value of those whose value
+           changed (or new)
+        """
+        starts = changes['added'] + changes['reordered'] + [
+            n for n in changes['edited'] if not n.children]
+        affected = {}
+        for node in starts:
+            while node is not None and id(node) not in affected:
+                affected[id(node)] = node
+                node = node.up
+        affected = sorted(affected.values(), key=_depth, reverse=True)
+        values = {}
+        for node in affected:
+            if node.children:
+                values[id(node)] = sum(
+                    values[id(c)] if id(c) in values else self.records[id(c)]['clade']
+                    for c in node.children) % 2**128
+            else:
+                values[id(node)] = _leaf_value(node.name)
+        return affected, {k: v for k, v in values.items()
+                          if k not in self.records or self.records[k]['clade'] != v}
+
+    def flush(self, touched=None):
+        """
+        Writes the changes of the tree to its file.
+
+        :param None touched: see changes
+
+        :returns: the changes written (see changes)
+        """
+        if self.h5file.mode != 'r+':
+            raise Exception('ERROR: h5tree not writable, load it with mode="r+".')
+        changes = self.changes(touched)
+        if not any(changes.values()):
+            return changes
+        affected, clades = self._clades(changes)
+        rows = self._update_rows(changes, affected, clades)
+        freed = [n.props['node_id'] for n in changes['removed'] if 'node_id' in n.props]
+        if self.layout == 'groups':
+            self._flush_groups(changes, affected, clades, rows)
+        else:
+            self._flush_arrays(changes, affected, clades, rows)
+        self._flush_props(changes, freed)
+        self.h5file.flush()
+        removed = {id(n) for n in changes['removed']}
+        for key in removed:
+            self.records.pop(key, None)
+        nodes = {id(n): n for n in changes['added'] + changes['moved'] +
+                 changes['reordered'] + changes['edited'] + affected}
+        for key, node in nodes.items():
+            if key not in removed:
+                self._record(node, clades.get(key, self.records.get(key, {}).get('clade')))
+        return changes
+
+    def _update_rows(self, changes, affected, clades):
+        """
+        Updates the row ranges of the nodes whose leaves may have changed
+        (deepest first, so that children are updated before their parent),
+        and the node_data rows (consensus and profiles) of those whose
+        leaves changed.
+
+        :returns: set of id(node) whose row properties changed
+        """
+        changed = set()
+        for node in affected:
+            if node.children:
+                ranges = [(c.props.get('row_start'), c.props.get('row_end'))
+                          for c in node.children]
+                contiguous = all(s is not None for s, _ in ranges)
+                if contiguous:  # children are not in row order (e.g. groups by name)
+                    ranges.sort()
+                    contiguous = all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+                start, end = (ranges[0][0], ranges[-1][1]) if contiguous else (None, None)
+            elif 'alignment' in node.props:
+                start, end = node.props['alignment'], node.props['alignment'] + 1
+            else:
+                start = end = None
+            if (start, end) != (node.props.get('row_start'), node.props.get('row_end')):
+                changed.add(id(node))
+            if start is None:
+                node.props.pop('row_start', None)
+                node.props.pop('row_end', None)
+            else:
+                node.add_prop('row_start', int(start))
+                node.add_prop('row_end', int(end))
+        if not self.node_data or 'alignment' not in self.leaf_data:
+            return changed
+        # rows freed by removed internal nodes, reused by new ones
+        free = sorted({n.props[nd] for n in changes['removed'] for nd in self.node_data
+                       if nd in n.props})
+        for node in changes['removed']:
+            for nd in self.node_data:
+                node.props.pop(nd, None)
+        alignment = self.h5file['leaf_data']['alignment']
+        node_data = self.h5file['node_data']
+        nodes = []
+        for node in affected:
+            if id(node) not in clades:
+                continue
+            if not node.children:
+                for nd in self.node_data:
+                    if nd in node.props:
+                        free.append(node.props.pop(nd))
+                        changed.add(id(node))
+                continue
+            nodes.append(node)
+            if all(nd in node.props for nd in self.node_data):
+                continue
+            # same row in all node_data datasets
+            if free:
+                row = free.pop(0)
+            else:
+                row = node_data[self.node_data[0]].shape[0]
+                for nd in self.node_data:
+                    if node_data[nd].maxshape[0] is not None:
+                        raise Exception(f'ERROR: node_data/{nd} cannot be extended.')
+                    node_data[nd].resize(row + 1, axis=0)
+            for nd in self.node_data:
+                node.add_prop(nd, row)
+            changed.add(id(node))
+        self._update_node_data(nodes, alignment, node_data)
+        return changed
+
+    def _update_node_data(self, nodes, alignment, node_data):
+        """
+        Recomputes the consensus and profiles (see clade_data.py) of nodes
+        (children first) from those of their children, by blocks of columns.
+        """
+        consensus = node_data.get('consensus')
+        profile = node_data.get('profile')
+        if not nodes or (consensus is None and profile is None):
+            return
+        packed = is_packed(alignment)
+        length = int(alignment.attrs['length']) if packed else alignment.shape[1]
+        block_cols = ((alignment.chunks[1] * (2 if packed else 1))
+                      if alignment.chunks else 2**20)
+        for beg in range(0, length, block_cols):
+            end = min(length, beg + block_cols)
+            cols = slice(beg // 2, packed_length(end)) if packed else slice(beg, end)
+            values, counts = {}, {}
+            for node in nodes:
+                children = [c for c in node.children
+                            if c.children or 'alignment' in c.props]
+                if consensus is not None:
+                    value = np.full(cols.stop - cols.start, 0xFF, dtype='uint8').view(
+                        alignment.dtype)
+                    for child in children:
+                        if id(child) in values:
+                            np.bitwise_and(value, values[id(child)], out=value)
+                        elif child.children:
+                            np.bitwise_and(value, consensus[child.props['consensus'], cols],
+                                           out=value)
+                        else:
+                            np.bitwise_and(value, alignment[child.props['alignment'], cols],
+                                           out=value)
+                    values[id(node)] = value
+                    consensus[node.props['consensus'], cols] = value
+                if profile is not None:
+                    count = np.zeros((end - beg,) + profile.shape[2:], dtype=profile.dtype)
+                    for child in children:
+                        if id(child) in counts:
+                            count += counts[id(child)]
+                        elif child.children:
+                            count += profile[child.props['profile'], beg:end]
+                        else:
+                            codes = alignment[child.props['alignment'], cols]
+                            if packed:
+                                codes = unpack_nt(codes, end - beg)
+                            count += one_hot_profile(codes)
+                    counts[id(node)] = count
+                    profile[node.props['profile'], beg:end] = count
+
+    def _attrs(self, node, group):
+        """
+        Rewrites the user properties of node (the root) as attributes of its
+        group.
+        """
+        props = self.props(node)
+        for k in list(group.attrs):
+            if k not in self.managed and (k not in props or props[k] is None):
+                del group.attrs[k]
+        for k, v in props.items():
+            if v is not None:
+                group.attrs[k] = v
+
+    def _flush_groups(self, changes, affected, clades, rows):
+        h5file = self.h5file
+
+        def _name(node):
+            if node.children:
+                value = clades.get(id(node), self.records.get(id(node), {}).get('clade'))
+                return f'{value:032x}'
+            return node.name
+
+        added = {id(n) for n in changes['added']}
+        relink = {id(n): n for n in changes['added'] + changes['moved']}
+        for node in affected + changes['edited']:
+            if node.up is not None and id(node) not in added and (
+                    node.props['h5node'].name.rsplit('/', 1)[1] != _name(node)):
+                relink[id(node)] = node
+        # internal nodes loaded from groups are named after them
+        renamed = {id(n) for n in relink.values() if n.children and id(n) not in added
+                   and n.name == n.props['h5node'].name.rsplit('/', 1)[1]}
+        staged = 0
+        # attach, parents being at their final place first, and moving
+        # aside stale groups found at the destination (removed, or to be
+        # relinked later)
+        for node in sorted(relink.values(), key=_depth):
+            parent = node.up.props['h5node']
+            name = _name(node)
+            if name in parent and (id(node) in added or
+                                   parent[name] != node.props['h5node']):
+                staging = h5file.require_group('_staging')
+                h5file.move(f'{parent.name}/{name}', f'{staging.name}/{staged}')
+                staged += 1
+            if id(node) in added:
+                node.add_prop('h5node', parent.create_group(name))
+            elif node.props['h5node'].name != f'{parent.name}/{name}':
+                h5file.move(node.props['h5node'].name, f'{parent.name}/{name}')
+            if id(node) in renamed:
+                node.name = name
+        for node in changes['removed']:
+            group = node.props.pop('h5node')
+            if group.name and group.name in h5file:  # not within removed groups
+                del h5file[group.name]
+        if '_staging' in h5file:
+            del h5file['_staging']
+        # node ids (properties being stored as columns, see node_props.py),
+        # reusing those of removed nodes
+        props = h5file.require_group('node_props')
+        free = sorted(n.props.pop('node_id') for n in changes['removed']
+                      if 'node_id' in n.props)
+        size = props.attrs.get('size', 1)
+        for node in changes['added'] + changes['edited']:
+            if node.up is not None and 'node_id' not in node.props:
+                if free:
+                    node.add_prop('node_id', free.pop(0))
+                else:
+                    node.add_prop('node_id', size)
+                    size += 1
+                node.props['h5node'].attrs['node_id'] = node.props['node_id']
+        props.attrs['size'] = size
+        if any(n is self.tree for n in changes['edited']):
+            self._attrs(self.tree, self.tree.props['h5node'])
+        for node in changes['added'] + affected:
+            if id(node) not in rows and id(node) not in added:
+                continue
+            group = node.props['h5node']
+            for k in ['row_start', 'row_end'] + self.leaf_data + self.node_data:
+                if k in node.props:
+                    group.attrs[k] = node.props[k]
+                elif k in group.attrs:
+                    del group.attrs[k]
+
+    def _flush_props(self, changes, freed):
+        """
+        Rewrites the property columns of the nodes added or edited, and
+        clears those of the ids freed by removed nodes (see node_props.py).
+        """
+        group = self.h5file.require_group('node_props')
+        exclude = set(self.managed)
+        if self.layout == 'arrays':
+            size = len(self.h5file['topology']['parent'])
+            exclude.update(('name', 'dist', 'support'))  # in topology
+        else:
+            size = group.attrs['size']
+        updates = {i: {} for i in freed}
+        for node in changes['added'] + changes['edited']:
+            if node.up is not None:
+                updates[node.props['node_id']] = {
+                    k: v for k, v in node.props.items()
+                    if k not in exclude and v is not None}
+        write_props(group, size, updates)
+
+    def _flush_arrays(self, changes, affected, clades, rows):
+        topo = self.h5file['topology']
+        size = len(topo['parent'])
+        free = sorted(n.props['node_id'] for n in changes['removed'])
+        for node in changes['removed']:
+            node.props.pop('node_id')
+        new_ids = free[:len(changes['added'])]
+        extra = len(changes['added']) - len(new_ids)
+        if extra:
+            for name in ('parent', 'first_child', 'next_sibling', 'dist', 'support',
+                         'leaf_row', 'node_row', 'row_start', 'row_end'):
+                if name in topo:
+                    if topo[name].maxshape[0] is not None:
+                        raise Exception(f'ERROR: topology/{name} cannot be extended.')
+                    topo[name].resize(size + extra, axis=0)
+            new_ids += list(range(size, size + extra))
+        for node, i in zip(changes['added'], new_ids):
+            node.add_prop('node_id', i)
+        # records to rewrite
+        nodes = {}
+        for node in changes['added'] + changes['moved'] + changes['edited'] + affected:
+            nodes[id(node)] = node
+        for node in changes['reordered']:
+            nodes[id(node)] = node
+            nodes.update((id(c), c) for c in node.children)
+        nodes = sorted(nodes.values(), key=lambda n: n.props['node_id'])
+        ids = [n.props['node_id'] for n in nodes]
+        leaf_data = self.leaf_data[0] if self.leaf_data else None
+        node_data = self.node_data[0] if self.node_data else None
+
+        def _sibling(node):
+            if node.up is None:
+                return -1
+            sisters = node.up.children
+            i = next(i for i, s in enumerate(sisters) if s is node)
+            return sisters[i + 1].props['node_id'] if i + 1 < len(sisters) else -1
+
+        values = {
+            'parent': [n.up.props['node_id'] if n.up is not None else -1 for n in nodes],
+            'first_child': [n.children[0].props['node_id'] if n.children else -1
+                            for n in nodes],
+            'next_sibling': [_sibling(n) for n in nodes],
+            'dist': [np.nan if n.dist is None else n.dist for n in nodes],
+            'support': [np.nan if n.support is None else n.support for n in nodes],
+            'leaf_row': [n.props.get(leaf_data, -1) if not n.children else -1
+                         for n in nodes],
+            'node_row': [n.props.get(node_data, -1) if n.children else -1
+                         for n in nodes],
+            'row_start': [n.props.get('row_start', -1) for n in nodes],
+            'row_end': [n.props.get('row_end', -1) for n in nodes],
+        }
+        # records of removed nodes (not reused) are freed
+        unused = sorted(set(free) - set(new_ids))
+        for name, vals in values.items():
+            if name not in topo:
+                continue
+            if ids:
+                topo[name][ids] = vals
+            if unused:
+                topo[name][unused] = (-2 if name == 'parent' else
+                                      np.nan if name in ('dist', 'support') else -1)
+        # names are concatenated, rewritten if any changed (added nodes may
+        # reuse the id of a named node, even if they have no name)
+        renamed = [n for n in changes['added'] + changes['edited']
+                   if id(n) not in self.records or
+                   self.records[id(n)]['props']['name'] != n.name]
+        if renamed or extra:
+            offsets = topo['name_offsets'][:]
+            data = topo['names'][:].tobytes()
+            names = [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+            names += [b''] * (len(topo['parent']) - len(names))
+            for n in renamed:
+                names[n.props['node_id']] = (n.name or '').encode()
+            offsets = np.zeros(len(names) + 1, dtype='int64')
+            np.cumsum([len(n) for n in names], out=offsets[1:])
+            for name, value in (('names', np.frombuffer(b''.join(names), dtype='uint8')),
+                                ('name_offsets', offsets)):
+                if topo[name].maxshape[0] is None:
+                    topo[name].resize(len(value), axis=0)
+                    topo[name][:] = value
+                else:
+                    del topo[name]
+                    topo.create_dataset(name, data=value, maxshape=(None,))
+        if any(n is self.tree for n in changes['edited']):
+            for k in list(topo.attrs):
+                if k not in self.managed:
+                    del topo.attrs[k]
+            for k, v in self.tree.props.items():
+                if k not in self.managed and v is not None:
+                    topo.attrs[k] = v
+
+
+def track(tree):
+    """
+    Starts recording the changes of a loaded h5tree (done by load_h5tree
+    when the file is opened for writing).
+    """
+    tree.add_prop('h5state', H5TreeState(tree))
+
+
+def flush(tree, touched=None):
+    """
+    Writes the changes of a tree loaded with load_h5tree(..., mode='r+') to
+    its file (see H5TreeState.flush).
+
+    :param None touched: nodes known to be the only ones modified (with
+       their parents and children, old and new), if None all nodes are
+       compared to their records
+
+    :returns: dictionary of the lists of nodes 'added', 'removed', 'moved',
+       'reordered' and 'edited'
+    """
+    if 'h5state' not in tree.props:
+        raise Exception('ERROR: changes of the tree are not tracked, load it '
+                        'with mode="r+".')
+    return tree.props['h5state'].flush(touched)
@@ -0,0 +1,14 @@
+"""
+Benchmark suite of h5trees: dump, load, alignment retrieval and consensus,
+swept over tree size, sequence length and chunk shape, with results saved
+as JSON (to track regressions across versions) and plotted.
+
+usage (from the hdf5_support directory):
+
+  python -m h5bench run --tree-lens 1000 10000 --seq-lens 10000 100000 \\
+      --chunks 1000x100000 100x10000 -o results.json --plot plots
+  python -m h5bench plot results.json -o plots
+"""
+from .timing        import measure, drop_file_cache, peak_memory
+from .suite         import run, bench_case, environment, summary
+from .plots         import plot_report
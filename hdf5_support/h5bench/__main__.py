@@ -0,0 +1,82 @@
+"""
+Command line interface of the benchmark suite (see h5bench/__init__.py).
+"""
+import json
+
+from argparse       import ArgumentParser
+
+from .suite         import run, summary
+from .plots         import plot_report
+
+
+def _chunk_size(value):
+    rows, cols = value.lower().split('x')
+    return int(rows), int(cols)
+
+
+def main():
+    parser = ArgumentParser(prog='h5bench', description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    bench = commands.add_parser('run', help='run benchmark sweeps')
+    bench.add_argument('--tree-lens', type=int, nargs='+', default=[1000],
+                       help='numbers of leaves [%(default)s]')
+    bench.add_argument('--seq-lens', type=int, nargs='+', default=[10_000],
+                       help='sequence lengths [%(default)s]')
+    bench.add_argument('--chunks', type=_chunk_size, nargs='+',
+                       default=[(1000, 100_000)], metavar='ROWSxCOLS',
+                       help='alignment chunk shapes [1000x100000]')
+    bench.add_argument('--layout', default='groups', choices=('groups', 'arrays'))
+    bench.add_argument('--queries', type=int, default=1000,
+                       help='number of leaves queried [%(default)s]')
+    bench.add_argument('--columns', type=int, default=200,
+                       help='number of columns queried [%(default)s]')
+    bench.add_argument('--repeats', type=int, default=5,
+                       help='timed runs of each step [%(default)s]')
+    bench.add_argument('--warmup', type=int, default=1,
+                       help='untimed runs before warm cache runs [%(default)s]')
+    bench.add_argument('--dump-repeats', type=int, default=1,
+                       help='timed runs of the dump [%(default)s]')
+    bench.add_argument('--no-cold', dest='cold', action='store_false',
+                       help='skip cold cache runs')
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--mutation-rate', type=float,
+                       help='substitutions per site from a reference (or per '
+                       'unit of branch length) instead of independent sequences')
+    bench.add_argument('--tree-correlated', action='store_true',
+                       help='evolve sequences along the tree branches')
+    bench.add_argument('--workdir', default='.',
+                       help='where to write temporary files [%(default)s]')
+    bench.add_argument('--keep', action='store_true',
+                       help='keep FASTA and h5tree files')
+    bench.add_argument('-o', '--output', default='h5bench.json',
+                       help='JSON report [%(default)s]')
+    bench.add_argument('--plot', metavar='DIR',
+                       help='also plot the report into DIR')
+
+    plot = commands.add_parser('plot', help='plot a JSON report')
+    plot.add_argument('report')
+    plot.add_argument('-o', '--outdir', default='plots',
+                      help='directory of the figures [%(default)s]')
+
+    opts = parser.parse_args()
+    if opts.command == 'run':
+        report = run(opts.tree_lens, opts.seq_lens, opts.chunks, opts.layout,
+                     opts.queries, opts.columns, opts.repeats, opts.warmup,
+                     opts.cold, opts.dump_repeats, opts.workdir, opts.keep,
+                     opts.seed, opts.mutation_rate, opts.tree_correlated)
+        with open(opts.output, 'w') as out:
+            json.dump(report, out, indent=1)
+        summary(report)
+        if opts.plot:
+            for fname in plot_report(report, opts.plot):
+                print(fname)
+    else:
+        with open(opts.report) as fh:
+            report = json.load(fh)
+        for fname in plot_report(report, opts.outdir):
+            print(fname)
+
+
+if __name__ == '__main__':
+    main()
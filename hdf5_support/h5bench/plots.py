@@ -0,0 +1,114 @@
+"""
+Plots of benchmark reports (as written by run), regenerating the figures of
+the README.
+
+Each figure shows the median time (bars from the fastest to the slowest
+run) of a step against one parameter, the other parameters being set to the
+first value of their sweep.
+"""
+import os
+
+import numpy as np
+
+
+PARAMS = {'tree_len': 'number of leaves', 'seq_len': 'sequence length',
+          'chunk_rows': 'chunk rows', 'chunk_cols': 'chunk columns'}
+
+# figure file name -> (step, parameter on the x axis)
+FIGURES = {
+    'benchmark_alignment-retrieval_VS_Tree-size.png': ('query', 'tree_len'),
+    'benchmark_alignment-retrieval_VS_alignment-size.png': ('query', 'seq_len'),
+    'benchmark_alignment-retrieval_VS_tree-chunk-size.png': ('query', 'chunk_rows'),
+    'benchmark_alignment-retrieval_VS_alignment-chunk-size.png': ('query', 'chunk_cols'),
+    'benchmark_consensus_sequence.png': ('consensus', 'tree_len'),
+    'benchmark_dump_VS_Tree-size.png': ('dump', 'tree_len'),
+    'benchmark_load_VS_Tree-size.png': ('load', 'tree_len'),
+}
+
+
+def _reference(report):
+    params = report['params']
+    return {'tree_len': params['tree_lens'][0],
+            'seq_len': params['seq_lens'][0],
+            'chunk_rows': params['chunk_sizes'][0][0],
+            'chunk_cols': params['chunk_sizes'][0][1]}
+
+
+def _series(report, step, xparam):
+    """
+    :returns: dictionary mapping (pattern, cache) to the list of (x, times)
+       of the results of step, with other parameters at their reference value
+    """
+    ref = _reference(report)
+    series = {}
+    for r in report['results']:
+        if r['step'] != step:
+            continue
+        if any(r[p] != v for p, v in ref.items() if p != xparam):
+            continue
+        series.setdefault((r['pattern'], r['cache']), []).append((r[xparam], r['times']))
+    return series
+
+
+def plot_report(report, outdir='plots'):
+    """
+    Draws the figures of a benchmark report (those with a single value of
+    their parameter are skipped), and a box plot of the query times of each
+    pattern (benchmark_random_alignment_retrieval.png).
+
+    :param report: dictionary returned by run (or loaded from its JSON)
+    :param 'plots' outdir: directory of the PNG files
+
+    :returns: list of paths of the figures written
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+    except ImportError:
+        raise Exception('ERROR: matplotlib is needed to plot benchmarks.')
+    os.makedirs(outdir, exist_ok=True)
+    written = []
+    ref = _reference(report)
+    for fname, (step, xparam) in FIGURES.items():
+        series = _series(report, step, xparam)
+        if not series or all(len(points) < 2 for points in series.values()):
+            continue
+        fig, ax = plt.subplots(figsize=(7, 5))
+        for (pattern, cache), points in sorted(series.items(), key=str):
+            points.sort(key=lambda p: p[0])
+            xs = [x for x, _ in points]
+            med = np.array([np.median(t) for _, t in points])
+            low = med - np.array([min(t) for _, t in points])
+            high = np.array([max(t) for _, t in points]) - med
+            label = ' '.join(v for v in (pattern, cache) if v) or step
+            ax.errorbar(xs, med, yerr=(low, high), marker='o', capsize=3,
+                        label=label)
+        fixed = ', '.join(f'{PARAMS[p]}={v}' for p, v in ref.items() if p != xparam)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel(PARAMS[xparam])
+        ax.set_ylabel(f'{step} time (s)')
+        ax.set_title(fixed, fontsize=9)
+        ax.legend()
+        fig.tight_layout()
+        fig.savefig(os.path.join(outdir, fname))
+        plt.close(fig)
+        written.append(os.path.join(outdir, fname))
+
+    # all query times at the reference parameters, by pattern and cache
+    series = {k: times for k, points in _series(report, 'query', 'tree_len').items()
+              for x, times in points if x == ref['tree_len']}
+    if series:
+        fig, ax = plt.subplots(figsize=(7, 5))
+        keys = sorted(series, key=str)
+        ax.boxplot([series[k] for k in keys])
+        ax.set_xticks(range(1, len(keys) + 1), [' '.join(filter(None, k)) for k in keys])
+        ax.set_ylabel('query time (s)')
+        ax.set_title(', '.join(f'{PARAMS[p]}={v}' for p, v in ref.items()), fontsize=9)
+        fig.tight_layout()
+        fname = os.path.join(outdir, 'benchmark_random_alignment_retrieval.png')
+        fig.savefig(fname)
+        plt.close(fig)
+        written.append(fname)
+    return written
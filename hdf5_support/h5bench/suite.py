@@ -0,0 +1,249 @@
+"""
+Benchmark sweeps over tree size, sequence length and chunk shape.
+
+For each combination an h5tree is dumped from a random alignment and the
+following steps are timed:
+
+  - dump: dump_h5tree from FASTA (alignment and tree)
+  - load: load_h5tree
+  - query: retrieval of a window of columns for a set of leaves, either
+    grouped (the leaves of a clade, contiguous rows) or random (leaves drawn
+    at random), by name through H5Alignment, or legacy (random leaves, each
+    searched in the loaded h5tree, followed by a fancy-indexed read of their
+    sorted rows, as before H5Alignment), as baseline
+  - consensus: query of a clade followed by its consensus
+
+Reads are timed with warm caches (file kept open, after warm-up runs) and
+cold caches (file dropped from the OS page cache and reopened before each
+run).
+"""
+import os
+import sys
+import platform
+import subprocess
+import datetime
+
+import h5py
+import numpy as np
+
+from ete4           import Tree
+
+from h5node_prototype import printime, dump_h5tree, load_h5tree, consensus
+from query          import H5Alignment
+from simulate       import write_fasta
+
+from .timing        import measure, drop_file_cache
+
+
+def environment():
+    """
+    :returns: dictionary describing the code version and the machine, to
+       compare results across versions
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit or None,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'h5py': h5py.version.version,
+            'hdf5': h5py.version.hdf5_version}
+
+
+def _clade_leaves(tree, size):
+    """
+    :returns: leaf names (in row order) of the smallest clade with at least
+       size leaves
+    """
+    best = tree
+    for node in tree.traverse():
+        nleaves = node.props['row_end'] - node.props['row_start']
+        if size <= nleaves < best.props['row_end'] - best.props['row_start']:
+            best = node
+    return [n.name for n in best.traverse('preorder') if not n.children]
+
+
+def bench_case(tree, fasta, h5out, chunk_size, layout='groups', nqueries=1000,
+               ncols=200, repeats=5, warmup=1, cold=True, dump_repeats=1,
+               seed=0):
+    """
+    Runs all benchmark steps for one h5tree.
+
+    :param tree: ete4 Tree object
+    :param fasta: path to the FASTA alignment of the leaves of tree
+    :param h5out: path to the h5tree to write
+    :param chunk_size: (rows, columns) of the alignment chunks
+    :param 'groups' layout: topology layout (see dump_h5tree)
+    :param 1000 nqueries: number of leaves queried
+    :param 200 ncols: number of columns queried
+    :param 5 repeats: number of timed runs of each step
+    :param 1 warmup: number of untimed runs before warm cache runs
+    :param True cold: also run the steps reading the file with cold caches
+    :param 1 dump_repeats: number of timed runs of the dump
+    :param 0 seed: seed of the random leaves drawn
+
+    :returns: list of dictionaries with the step, pattern, cache, and times
+    """
+    results = []
+    caches = ['warm', 'cold'] if cold else ['warm']
+
+    def _add(step, times, pattern=None, cache=None):
+        results.append({'step': step, 'pattern': pattern, 'cache': cache,
+                        'times': times})
+
+    def _dump():
+        dump_h5tree(tree, h5out, fasta, overwrite=True, chunk_size=chunk_size,
+                    layout=layout)
+        # in the groups layout, nodes keep their group (and the file open)
+        h5nodes = [node.props.pop('h5node') for node in tree.traverse()
+                   if 'h5node' in node.props]
+        if h5nodes:
+            h5nodes[0].file.close()
+    _add('dump', measure(_dump, dump_repeats, warmup=0))
+
+    def _open_tree():
+        drop_file_cache(h5out)
+        return None
+
+    def _load_tree():
+        drop_file_cache(h5out)
+        return load_h5tree(h5out)
+
+    def _close_tree(h5tree):
+        h5tree.props['h5node'].file.close()
+
+    for cache in caches:
+        _add('load', measure(
+            lambda _: _close_tree(load_h5tree(h5out)), repeats,
+            warmup if cache == 'warm' else 0,
+            setup=_open_tree if cache == 'cold' else lambda: None), cache=cache)
+
+    h5tree = load_h5tree(h5out)
+    rng = np.random.default_rng(seed)
+    names = [n.name for n in h5tree.traverse() if not n.children]
+    grouped = _clade_leaves(h5tree, min(nqueries, len(names)))
+    seq_len = H5Alignment(h5tree.props['h5node'].file).length
+    _close_tree(h5tree)
+    beg = int(rng.integers(0, max(1, seq_len - ncols)))
+    columns = slice(beg, beg + ncols)
+
+    def _items(pattern):
+        if pattern == 'grouped':
+            return lambda: grouped
+        return lambda: [names[i] for i in rng.choice(len(names), min(nqueries, len(names)))]
+
+    def _open():
+        drop_file_cache(h5out)
+        return H5Alignment(h5py.File(h5out, 'r'))
+
+    def _close(h5a):
+        h5a.dataset.file.close()
+
+    steps = [('query', pattern, lambda h5a, items: h5a.get_alignment(items, columns))
+             for pattern in ('grouped', 'random')]
+    steps.append(('consensus', 'grouped',
+                  lambda h5a, items: consensus(h5a.get_alignment(items, raw=True))))
+    for step, pattern, func in steps:
+        items = _items(pattern)
+        for cache in caches:
+            if cache == 'cold':
+                times = measure(lambda h5a: func(h5a, items()), repeats, 0,
+                                setup=_open, teardown=_close)
+            else:
+                h5a = H5Alignment(h5py.File(h5out, 'r'))
+                times = measure(lambda: func(h5a, items()), repeats, warmup)
+                _close(h5a)
+            _add(step, times, pattern, cache)
+
+    def _legacy(h5tree, items):
+        rows = sorted(set(h5tree[name].props['alignment'] for name in items))
+        return h5tree.props['h5node'].file['leaf_data']['alignment'][rows, columns]
+
+    items = _items('random')
+    for cache in caches:
+        if cache == 'cold':
+            times = measure(lambda h5tree: _legacy(h5tree, items()), repeats, 0,
+                            setup=_load_tree, teardown=_close_tree)
+        else:
+            h5tree = load_h5tree(h5out)
+            times = measure(lambda: _legacy(h5tree, items()), repeats, warmup)
+            _close_tree(h5tree)
+        _add('query', times, 'legacy', cache)
+    return results
+
+
+def run(tree_lens, seq_lens, chunk_sizes, layout='groups', nqueries=1000,
+        ncols=200, repeats=5, warmup=1, cold=True, dump_repeats=1,
+        workdir='.', keep=False, seed=0, mutation_rate=None,
+        tree_correlated=False):
+    """
+    Runs bench_case for each combination of tree size, sequence length and
+    chunk shape.
+
+    :param tree_lens: list of numbers of leaves
+    :param seq_lens: list of sequence lengths
+    :param chunk_sizes: list of (rows, columns) chunk shapes
+    :param '.' workdir: where to write the FASTA and h5tree files
+    :param False keep: keep the files written
+    :param 0 seed: seed of the random alignments and queries
+    :param None mutation_rate: see simulate.alignment_blocks (by default
+       sequences are independent)
+    :param False tree_correlated: see simulate.alignment_blocks
+
+    Other parameters are those of bench_case.
+
+    :returns: dictionary with the environment, the parameters, and the
+       results (one dictionary per step and combination)
+    """
+    params = {'tree_lens': list(tree_lens), 'seq_lens': list(seq_lens),
+              'chunk_sizes': [list(c) for c in chunk_sizes], 'layout': layout,
+              'nqueries': nqueries, 'ncols': ncols, 'repeats': repeats,
+              'warmup': warmup, 'cold': cold, 'dump_repeats': dump_repeats,
+              'seed': seed, 'mutation_rate': mutation_rate,
+              'tree_correlated': tree_correlated}
+    report = {'environment': environment(), 'params': params, 'results': []}
+    for tree_len in tree_lens:
+        tree = Tree()
+        tree.populate(tree_len, names=[str(i) for i in range(tree_len)])
+        for seq_len in seq_lens:
+            base_name = f'{tree_len}leaves_{seq_len}bp'
+            fasta = os.path.join(workdir, f'h5bench_{base_name}.fasta')
+            printime(f'Generate random alignment {base_name}')
+            write_fasta(tree, seq_len, fasta, overwrite=True, seed=seed,
+                        mutation_rate=mutation_rate,
+                        tree_correlated=tree_correlated)
+            for chunk_size in chunk_sizes:
+                h5out = os.path.join(
+                    workdir, f'h5bench_{base_name}_chunks{chunk_size[0]}-{chunk_size[1]}.hdf5')
+                printime(f'Benchmark {base_name} with chunks {chunk_size}')
+                case = {'tree_len': tree_len, 'seq_len': seq_len,
+                        'chunk_rows': chunk_size[0], 'chunk_cols': chunk_size[1],
+                        'layout': layout}
+                for result in bench_case(
+                        tree, fasta, h5out, chunk_size, layout, nqueries, ncols,
+                        repeats, warmup, cold, dump_repeats, seed):
+                    report['results'].append(dict(case, **result))
+                if not keep:
+                    os.remove(h5out)
+            if not keep:
+                os.remove(fasta)
+    return report
+
+
+def summary(report, out=sys.stdout):
+    """
+    Prints the median time of each step of a report as a table.
+    """
+    out.write(f'{"tree_len":>9}{"seq_len":>10}{"chunks":>16}{"step":>11}'
+              f'{"pattern":>9}{"cache":>6}{"median (s)":>12}\n')
+    for r in report['results']:
+        chunks = f'{r["chunk_rows"]}x{r["chunk_cols"]}'
+        out.write(f'{r["tree_len"]:>9}{r["seq_len"]:>10}{chunks:>16}{r["step"]:>11}'
+                  f'{r["pattern"] or "":>9}{r["cache"] or "":>6}'
+                  f'{np.median(r["times"]):>12.5f}\n')
@@ -0,0 +1,93 @@
+"""
+Timing helpers: repeated runs after warm-up runs, optionally with cold caches,
+and peak memory of a run in a new process.
+"""
+import os
+import gc
+import resource
+
+from time           import perf_counter
+from multiprocessing import Process, Queue
+
+
+def drop_file_cache(fname):
+    """
+    Asks the OS to evict the pages of a file from its page cache, so that
+    the next read comes from disk (Linux only, no-op elsewhere).
+
+    :param fname: path to the file (closed)
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def measure(func, repeats=5, warmup=1, setup=None, teardown=None):
+    """
+    Times repeated calls of func.
+
+    :param func: function called without arguments, or with the value
+       returned by setup
+    :param 5 repeats: number of timed runs
+    :param 1 warmup: number of runs before the timed ones (not reported)
+    :param None setup: function called (untimed) before each run, e.g. to
+       open a file after dropping it from the OS cache
+    :param None teardown: function called (untimed) after each run with the
+       value returned by setup
+
+    :returns: list of times in seconds, one per timed run
+    """
+    times = []
+    for run in range(warmup + repeats):
+        arg = setup() if setup else None
+        gc.collect()
+        t0 = perf_counter()
+        if setup:
+            func(arg)
+        else:
+            func()
+        elapsed = perf_counter() - t0
+        if teardown:
+            teardown(arg)
+        if run >= warmup:
+            times.append(elapsed)
+    return times
+
+
+def _peak_memory(func, args, results):
+    try:
+        value = func(*args)
+    except Exception as e:
+        results.put((e, None))
+        return
+    # kB on linux
+    memory = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    results.put((value, memory))
+
+
+def peak_memory(func, *args):
+    """
+    Calls func in a new process, to measure its peak memory alone.
+
+    :param func: function (picklable, e.g. defined at module level) called
+       with args, its value being sent back (pickled) from the process
+    :param args: arguments of func
+
+    :returns: the value returned by func, and the peak memory in bytes
+       (largest resident set size of the process and of the processes it
+       waited for, e.g. its workers)
+    """
+    results = Queue()
+    proc = Process(target=_peak_memory, args=(func, args, results))
+    proc.start()
+    value, memory = results.get()
+    proc.join()
+    if memory is None:
+        raise value
+    return value, memory
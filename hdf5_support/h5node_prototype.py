@@ -1,19 +1,31 @@
 #! /usr/bin/env python
 """
 """
-import sys
 import os
 import datetime
 
 from time           import time
-from random         import random, choices
 from hashlib        import md5
+from itertools      import chain
 
 import h5py
 import numpy as np
 
+from h5py           import h5d, h5p, h5s, h5t
+
 from ete4           import Tree
 
+from codec          import num2seq_nt, num2seq_aa
+from codec          import pack_nt, unpack_nt, packed_length, is_packed, is_protein
+from ingest         import fasta_reader, write_alignment, write_alignment_parallel, copy_rows
+from topology       import dump_topology, load_topology
+from lazy           import LazyH5Tree
+from flush          import track, flush
+from node_props     import MANAGED, dump_props, load_props, _kind
+from live           import LiveWriter
+from clade_data     import dump_consensus, dump_profiles, row_ranges
+from simulate       import write_fasta, write_alignment as write_random_alignment
+
 
 def printime(msg):
     print(msg +
@@ -24,130 +36,8 @@ def printime(msg):
 
 
 
-def seq2num_aa(seq):
-    """
-    Converts amino-acid symbols to 8-bits intergers.
-    Consensus through bitwise AND will give rise to some groups based
-    on BLOSUM62 matrix.
-    """
-    conv = {
-        int('00110011', 2): 'C',  # \
-        int('01100011', 2): 'S',  #  | - small and polar
-        int('11000011', 2): 'R',  # /
-        int('00110110', 2): 'P',  # \
-        int('01100110', 2): 'A',  #  | - small and non-polar
-        int('11000110', 2): 'G',  # /
-        int('00111100', 2): 'N',  # \
-        int('01101100', 2): 'D',  #  | _ polar or acidic
-        int('11001100', 2): 'E',  #  |
-        int('10011100', 2): 'Q',  # /
-        int('00110101', 2): 'H',  # \
-        int('01100101', 2): 'R',  #  | - basic
-        int('11000101', 2): 'K',  # /
-        int('00111001', 2): 'M',  # \
-        int('01101001', 2): 'L',  #  |_ large and hydrophobic
-        int('11001001', 2): 'I',  #  |
-        int('10011001', 2): 'V',  # /
-        int('00111010', 2): 'F',  # \
-        int('01101010', 2): 'Y',  #  | - aromatic
-        int('11001010', 2): 'W',  # /
-        int('00000000', 2): 'X',
-        int('11111111', 2): '-',
-    }
-    return np.array([conv[n] for n in seq], dtype='int8')
-
-
 def _print_sequence_aa(sequence):
-    rev_conv = {
-        int('00110011', 2): 'C',  # \
-        int('01100011', 2): 'S',  #  | - small and polar
-        int('11000011', 2): 'R',  # /
-
-        int('00110110', 2): 'P',  # \
-        int('01100110', 2): 'A',  #  | - small and non-polar
-        int('11000110', 2): 'G',  # /
-
-        int('00111100', 2): 'N',  # \
-        int('01101100', 2): 'D',  #  | _ polar or acidic
-        int('11001100', 2): 'E',  #  |
-        int('10011100', 2): 'Q',  # /
-
-        int('00110101', 2): 'H',  # \
-        int('01100101', 2): 'R',  #  | - basic
-        int('11000101', 2): 'K',  # /
-
-        int('00111001', 2): 'M',  # \
-        int('01101001', 2): 'L',  #  |_ large and hydrophobic
-        int('11001001', 2): 'I',  #  |
-        int('10011001', 2): 'V',  # /
-
-        int('00111010', 2): 'F',  # \
-        int('01101010', 2): 'Y',  #  | - aromatic
-        int('11001010', 2): 'W',  # /
-
-        int('00000000', 2): 'X',
-        int('11111111', 2): '-',
-
-        # official conventions:
-        int('01001100', 2): '-',  # negatively charged
-        int('00101100', 2): 'B',  # N or D
-        int('10001100', 2): 'Z',  # E or Q
-        int('01001001', 2): 'J',  # I or L
-
-        int('00100011', 2): 'p',  # \
-        int('01000011', 2): 'p',  #  | - small and polar
-        int('00000011', 2): 'p',  # /
-
-        int('00100110', 2): 's',  # \
-        int('01000110', 2): 's',  #  | - small and non-polar
-        int('00000110', 2): 's',  # /
-
-        int('00011100', 2): 'a',  # \
-        # int('00101100', 2): 'a',  #  | 
-        # int('01001100', 2): 'a',  #  | - polar or acidic
-        # int('10001100', 2): 'a',  #  |
-        int('00001100', 2): 'a',  # /
-
-        int('00100101', 2): '+',  # \
-        int('01000101', 2): '+',  #  | - basic
-        int('00000101', 2): '+',  # /
-
-        int('00011001', 2): 'l',  # \
-        int('00101001', 2): 'l',  #  |
-        # int('01001001', 2): 'l',  #  | - large and hydrophobic
-        int('10001001', 2): 'l',  #  |
-        int('00001001', 2): 'l',  # /
-
-        int('00100101', 2): 'o',  # \
-        int('01000101', 2): 'o',  #  | - aromatic
-        int('00000101', 2): 'o',  # /
-
-        # everything else is also X...
-    }
-    return ''.join(rev_conv.get(s, 'X') for s in sequence)
-
-
-def seq2num_nt(seq):
-    """
-    Converts nucleotide symbols to 8-bits intergers
-    """
-    conv = {
-        'A': int('00100101', 2),
-        'C': int('01101010', 2),
-        'G': int('10010110', 2),
-        'T': int('11011001', 2),
-
-        'W': int('00000001', 2),  # A or T
-        'S': int('00000010', 2),  # C or G
-        'R': int('00000100', 2),  # A or G
-        'Y': int('01001000', 2),  # C or T
-        'K': int('10010000', 2),  # G or T
-        'M': int('00100000', 2),  # A or C
-
-        'N': int('00000000', 2),
-        '-': int('11111111', 2),
-    }
-    return np.array([conv[n] for n in seq], dtype='int8')
+    return num2seq_aa(sequence)
 
 
 def consensus(sequences):
@@ -155,69 +45,172 @@ def consensus(sequences):
     returns consensus sequence of an alignment as an array of int-8
 
     :param sequences: numpy 2D array of dtype int-8 (rows are individual 
-       sequences)
+       sequences), or of packed sequences (see codec.pack_nt), the consensus
+       being then packed too
     """
     return np.bitwise_and.reduce(sequences)
 
 
 def _print_sequence_nt(sequence):
-    rev_conv = {
-        int('00100101', 2): 'A',
-        int('01101010', 2): 'C',
-        int('10010110', 2): 'G',
-        int('11011001', 2): 'T',
-
-        int('00000001', 2): 'W',  # A or T
-        int('00000010', 2): 'S',  # C or G
-        int('00000100', 2): 'R',  # A or G
-        int('01001000', 2): 'Y',  # C or T
-        int('10010000', 2): 'K',  # G or T
-        int('00100000', 2): 'M',  # A or C
-
-        int('00000000', 2): 'N',
-        int('11111111', 2): '-',
+    return num2seq_nt(sequence)
 
-    }
-    return ''.join(rev_conv[s] for s in sequence)
 
 
-
-def generate_random_alignment(tree, seq_len, fname, overwrite=False):
+def generate_random_alignment(tree, seq_len, fname, overwrite=False, **kwargs):
     """
     seq_len = 4_000_000_000 # genome size
     seq_len = 400_000_000   # chromosome size
     seq_len = 4_000_000     # big chunk
     seq_len = 40_000        # protein
+
+    :param kwargs: seed, mutation_rate, tree_correlated, ambiguity_rate,
+       gap_rate... (see simulate.alignment_blocks)
     """
+    write_fasta(tree, seq_len, fname, overwrite=overwrite, **kwargs)
 
-    if os.path.exists(fname) and not overwrite:
-        return
-    out = open(fname, 'w')
-    for leaf_name in t.iter_leaf_names():
-        seq = "".join("ATCG"[int(random() * 4)] for _ in range(seq_len))
-        out.write(f'>{leaf_name}\n{seq}\n')
-    out.close()
-
-
-def fasta_reader(fasta, header_delimiter='\t'):
-    with open(fasta) as fh:
-        header = next(fh)[1:].strip().split(header_delimiter)
-        seq = ''
-        for l in fh:
-            if l.startswith('>'):
-                yield header, seq
-                header = l[1:].strip().split(header_delimiter)
-                seq = ''
-                continue
-            seq += l.strip()
-        yield header, seq
-
-
-def dump_h5tree(tree, h5out, fasta=None, overwrite=False, chunk_size=(1000, 100_000)):
+
+def clade_names(tree, legacy=False):
+    """
+    Computes a name for each internal node, identifying the clade by its set
+    of leaves: the sum (modulo 2**128) of the md5 digests of its leaf names,
+    obtained in a single postorder pass as the sum of the values of its
+    children. Names are stable across runs and do not depend on the order
+    of the children.
+
+    :param tree: ete4 Tree object
+    :param False legacy: instead, use md5 of the ':' joined leaf names (as
+       in h5trees written before), quadratic in the worst case
+
+    :returns: dictionary mapping id(node) to the hexadecimal name of the
+       group of each internal node
+    """
+    names = {}
+    if legacy:
+        for node in tree.traverse():
+            if node.children:
+                names[id(node)] = md5(':'.join(l.name for l in node.leaves()).encode()).hexdigest()
+        return names
+    sums = {}
+    for node in tree.traverse('postorder'):
+        if node.children:
+            value = sum(sums.pop(id(child)) for child in node.children) % 2**128
+            names[id(node)] = f'{value:032x}'
+        else:
+            value = int(md5(node.name.encode()).hexdigest(), 16)
+        sums[id(node)] = value
+    return names
+
+
+def _create_alignment(group, tree_len, seq_len, chunk_size, packed=False,
+                      contiguous=False, alphabet='nt', **filters):
+    """
+    Creates the alignment dataset, chunk_size being given in bases.
+
+    :param False contiguous: contiguous layout (no chunks), allocated at
+       creation so that the dataset has a file offset (see query.memmap_dataset),
+       and rows cannot be appended
+    :param 'nt' alphabet: 'aa' for amino acids, recorded as the alphabet
+       attribute of the dataset (see codec.is_protein)
+    :param filters: compression, compression_opts and shuffle arguments of
+       h5py create_dataset
+    """
+    alignment = _create_dataset(group, tree_len, seq_len, chunk_size, packed,
+                                contiguous, **filters)
+    if alphabet == 'aa':
+        alignment.attrs['alphabet'] = 'aa'
+    return alignment
+
+
+def _create_dataset(group, tree_len, seq_len, chunk_size, packed, contiguous,
+                    **filters):
+    """
+    Creates the alignment dataset (see _create_alignment).
+    """
+    chunks = (min(tree_len, chunk_size[0]), min(seq_len, chunk_size[1]))
+    if contiguous:
+        if filters.get('compression') or filters.get('shuffle'):
+            raise Exception('ERROR: contiguous alignments cannot be compressed.')
+        dcpl = h5p.create(h5p.DATASET_CREATE)
+        dcpl.set_alloc_time(h5d.ALLOC_TIME_EARLY)
+        width = packed_length(seq_len) if packed else seq_len
+        dtype = np.dtype('uint8' if packed else 'int8')
+        space = h5s.create_simple((tree_len, width))
+        h5d.create(group.id, b'alignment', h5t.py_create(dtype), space, dcpl=dcpl)
+        alignment = group['alignment']
+        if packed:
+            alignment.attrs['encoding'] = 'nt4'
+            alignment.attrs['length'] = seq_len
+        return alignment
+    # rows can be appended (see live.py)
+    if not packed:
+        return group.create_dataset('alignment', (tree_len, seq_len),
+                                    maxshape=(None, seq_len), dtype='int8',
+                                    chunks=chunks, **filters)
+    alignment = group.create_dataset(
+        'alignment', (tree_len, packed_length(seq_len)),
+        maxshape=(None, packed_length(seq_len)), dtype='uint8',
+        chunks=(chunks[0], packed_length(chunks[1])), **filters)
+    alignment.attrs['encoding'] = 'nt4'
+    alignment.attrs['length'] = seq_len
+    return alignment
+
+
+def dump_h5tree(tree, h5out, fasta=None, overwrite=False, chunk_size=(1000, 100_000),
+                buffer_size=2**30, workers=1, layout='groups', legacy_names=False,
+                consensus=False, source=None, packed=False, compression=None,
+                compression_opts=None, shuffle=False, simulate=None,
+                contiguous=False, profiles=False, alphabet='nt'):
+    """
+    Alignment rows follow the preorder of the leaves, so that each node spans
+    a range of rows, stored as row_start and row_end (excluded) attributes or
+    datasets.
+
+    :param None source: instead of a FASTA file, copy the alignment from an
+       existing h5tree, as a tuple with the alignment dataset and a
+       dictionary mapping leaf names to its rows
+    :param False consensus: precompute the consensus of each internal node
+       into node_data/consensus (see clade_data.py)
+    :param False legacy_names: name groups of internal nodes as in h5trees
+       written before (md5 of the joined leaf names, see clade_names)
+    :param 'groups' layout: how to store the tree topology, 'groups' for one
+       hdf5 group per node (hierarchy of groups following the tree), or
+       'arrays' for flat datasets indexed by node (see topology.py)
+    :param False packed: store nucleotides with 4 bits codes, two per byte
+       (see codec.pack_nt), halving the size of the alignment
+    :param None compression: compression filter of the alignment (and
+       consensus) datasets, 'gzip' or 'lzf' (see bench_compression.py)
+    :param None compression_opts: compression level for gzip (0-9, default 4)
+    :param False shuffle: apply the hdf5 shuffle filter before compression
+       (no effect on one byte codes)
+    :param None simulate: instead of a FASTA file, fill the alignment with a
+       synthetic one, as a dictionary with seq_len and other arguments of
+       simulate.alignment_blocks (e.g. seed, mutation_rate)
+    :param False contiguous: store the alignment without chunks (and
+       without compression), so that it can be memory mapped (see
+       query.MappedAlignment), chunk_size then sets the blocks in which it is
+       processed
+    :param False profiles: precompute the allele counts of each column for
+       each internal node into node_data/profile (see
+       clade_data.dump_profiles)
+    :param 'nt' alphabet: 'aa' for amino-acid sequences (see
+       codec.seq2num_aa), their consensus giving symbols of BLOSUM62 groups
+       of amino acids (e.g. 'l' for large and hydrophobic). Taken from the
+       alignment copied if source is given. Amino acids cannot be packed,
+       simulated, or counted in profiles.
+    """
     if os.path.exists(h5out) and not overwrite:
         return
+    if source:
+        alphabet = 'aa' if is_protein(source[0]) else 'nt'
+    if alphabet not in ('nt', 'aa'):
+        raise Exception(f'ERROR: unknown alphabet {alphabet}, should be nt or aa.')
+    if alphabet == 'aa' and (packed or simulate or profiles):
+        raise Exception('ERROR: amino-acid alignments cannot be packed, '
+                        'simulated or have allele count profiles.')
 
     tree_len = len(tree)
+    filters = dict(compression=compression, compression_opts=compression_opts,
+                   shuffle=shuffle)
 
     # with h5py.File('foo2.hdf5','w') as treef:
     treef = h5py.File(h5out, 'w', libver='latest') 
@@ -228,13 +221,15 @@ def dump_h5tree(tree, h5out, fasta=None, overwrite=False, chunk_size=(1000, 100_
     lg = treef.create_group("leaf_data")
     # - as all datasets here contain one entry per leaf, the attributes
     #   of this group will allow to to map entry numbers to the leaves
-    leaf_number = 0
-    for leaf_name in tree.iter_leaf_names():
+    leaf_rows = {}
+    for leaf in tree.traverse('preorder'):
+        if leaf.children:
+            continue
+        leaf_name = leaf.name
         # check for leaf_name clash
-        if leaf_name in lg.attrs:
+        if leaf_name in leaf_rows:
             raise Exception(f'ERROR: Leaf name {leaf_name} found multiple times.')
-        lg.attrs[leaf_name] = leaf_number
-        leaf_number += 1
+        lg.attrs[leaf_name] = leaf_rows[leaf_name] = len(leaf_rows)
     # create a SEQUENCE dataset to store alignment
     if fasta:
         # get sequence length
@@ -242,40 +237,127 @@ def dump_h5tree(tree, h5out, fasta=None, overwrite=False, chunk_size=(1000, 100_
         printime(' - Dumping FASTA to hdf5 alignment group')
         fr = fasta_reader(fasta)
         header, seq = next(fr)
-        alignment = lg.create_dataset(
-            'alignment', (tree_len, len(seq)), dtype='int8', 
-            chunks=(min(tree_len, chunk_size[0]), min(len(seq), chunk_size[1]))) #, compression='gzip', compression_opts=7)
-        alignment[lg.attrs[header[0]]] = seq2num_nt(seq)
-        for header, seq in fr:
-            alignment[lg.attrs[header[0]]] = seq2num_nt(seq)
+        alignment = _create_alignment(lg, tree_len, len(seq), chunk_size, packed,
+                                      contiguous, alphabet, **filters)
+        # stream sequences to the dataset by blocks of chunk rows
+        if workers > 1:
+            fr.close()
+            write_alignment_parallel(alignment, fasta, leaf_rows, workers=workers,
+                                     buffer_size=buffer_size)
+        else:
+            write_alignment(alignment, chain([(header, seq)], fr), leaf_rows,
+                            buffer_size=buffer_size)
+    elif source:
+        printime(' - Copying alignment to hdf5 alignment group')
+        src, src_rows = source
+        seq_len = int(src.attrs['length']) if is_packed(src) else src.shape[1]
+        alignment = _create_alignment(lg, tree_len, seq_len, chunk_size, packed,
+                                      contiguous, alphabet, **filters)
+        if packed == is_packed(src):
+            convert = None
+        elif packed:
+            convert = pack_nt
+        else:
+            convert = lambda block: unpack_nt(block, seq_len)
+        copy_rows(src, alignment, {leaf_rows[n]: r for n, r in src_rows.items()},
+                  buffer_size=buffer_size, convert=convert)
+    elif simulate:
+        printime(' - Generating random alignment into hdf5 alignment group')
+        simulate = dict(simulate)
+        alignment = _create_alignment(lg, tree_len, simulate.pop('seq_len'),
+                                      chunk_size, packed, contiguous, **filters)
+        write_random_alignment(tree, alignment, leaf_rows, buffer_size=buffer_size,
+                               **simulate)
+    # range of rows spanned by each node
+    ranges = row_ranges(tree, leaf_rows)
+    #####################################
+    # create GROUP for generic internal node data (one entry per internal
+    # node, e.g. consensus sequences)
+    node_rows = {}
+    if (fasta or source or simulate) and consensus:
+        printime(' - Computing consensus of internal nodes')
+        block_cols = (packed_length(chunk_size[1]) if packed else chunk_size[1])
+        node_rows = dump_consensus(tree, alignment, treef.require_group('node_data'),
+                                   leaf_rows, block_cols=block_cols)
+    if (fasta or source or simulate) and profiles:
+        printime(' - Computing allele count profiles of internal nodes')
+        node_rows = dump_profiles(tree, alignment, treef.require_group('node_data'),
+                                  leaf_rows, block_cols=chunk_size[1],
+                                  node_rows=node_rows)
     
+    # properties of nodes referring to rows of datasets are not stored
+    row_props = set(lg) | set(treef.get('node_data', ()))
+    if source:
+        row_props.update(source[0].file['leaf_data'])
+        row_props.update(source[0].file.get('node_data', ()))
+
     t1 = time()
+    if layout == 'arrays':
+        printime(' - Creating h5Tree topology arrays')
+        nodes = dump_topology(tree, treef.create_group('topology'), leaf_rows,
+                              node_rows, ranges)
+        printime(' - Creating h5Tree node property columns')
+        dump_props(nodes, treef.create_group('node_props'),
+                   exclude=row_props | {'name', 'dist', 'support'})
+        return t1
     printime(' - Creating h5Tree groups')
+    hashed_names = clade_names(tree, legacy=legacy_names)
     traverser = tree.traverse()
     h5root = next(traverser)
     root = treef.create_group("tree")
     h5root.add_prop('h5node', root)
     # store name, dist, support as h5py attributes
     for k, v in tree.props.items():
-        root.attrs[k] = v
+        if k not in MANAGED:
+            root.attrs[k] = v
+    root.attrs['node_id'] = 0
+    for nd in treef.get('node_data', ()):
+        root.attrs[nd] = node_rows[id(tree)]
+    root.attrs['row_start'], root.attrs['row_end'] = ranges[id(tree)]
     # link to sequences
     #     root.attrs['sequence'] = alignment.ref  # store a reference to the alignment
 
+    nodes = [tree]
     for node in traverser:
-        if not node.is_leaf():  # we create a fancy hashed name
-            hashed_name = md5(':'.join(node.get_leaf_names()).encode())
-            g = node.up.props['h5node'].create_group(hashed_name.hexdigest())
+        if node.children:  # we create a fancy hashed name
+            g = node.up.props['h5node'].create_group(hashed_names[id(node)])
+            # associate each internal node to each node-dataset (e.g. consensus)
+            for nd in treef.get('node_data', ()):
+                g.attrs[nd] = node_rows[id(node)]
         else:
             # group name is leaf name
             g = node.up.props['h5node'].create_group(node.name)
             # associate each leaf to each leaf-dataset (e.g. sequences)
             if treef['leaf_data'].keys():
                 for ld in treef['leaf_data']:
-                    g.attrs[ld] = lg.attrs[node.name]
+                    g.attrs[ld] = leaf_rows[node.name]
+        g.attrs['row_start'], g.attrs['row_end'] = ranges[id(node)]
+        # other properties are stored as columns, indexed by node_id
+        g.attrs['node_id'] = len(nodes)
+        nodes.append(node)
         node.add_prop('h5node', g)
+    printime(' - Creating h5Tree node property columns')
+    dump_props(nodes, treef.create_group('node_props'), exclude=row_props)
     return t1
 
 
+def sort_h5tree(fname, h5out, **kwargs):
+    """
+    Rewrites an h5tree with its alignment rows in preorder of the leaves,
+    and the row range of each node (see dump_h5tree).
+
+    :param fname: path to the h5tree to sort
+    :param h5out: path to the new h5tree
+    :param kwargs: passed to dump_h5tree, by default keeping the layout,
+       chunks (or contiguous layout), packing, compression, consensus and
+       profiles of the input h5tree
+    """
+    tree = load_h5tree(fname)
+    h5f = tree.props['h5node'].file
+    save_h5tree(tree, h5out, **kwargs)
+    h5f.close()
+
+
 def _load_tree_from_h5(tree, h5tree):
     """
     populate ete4 Tree using hdf5 group structure
@@ -292,72 +374,234 @@ def _load_tree_from_h5(tree, h5tree):
         _load_tree_from_h5(n, h5tree[h5n])
 
 
-def load_h5tree(fname):
+def load_h5tree(fname, lazy=False, max_nodes=None, mode='r', props=None):
     """
     Load ete4 Tree from hdf5 attaching a h5node property 
     to each node.
 
+    :param False lazy: only load the root and its children, other nodes being
+       loaded on demand, only by LazyH5Tree.traverse or expand (through the
+       h5lazy property of the root, see lazy.py): ete4 methods see nodes not
+       yet loaded as leaves
+    :param None max_nodes: in lazy mode, maximum number of nodes kept in
+       memory
+    :param 'r' mode: 'r+' to open the file for writing, changes to the tree
+       being then tracked and written back with save_h5tree (see flush.py)
+    :param None props: names of the node properties to load (see
+       node_props.py), by default all
+
     :returns: Tree object
     """
-    h5node = h5py.File(fname)
-    # create empty Tree to be populated from hdf5 file structure
-    tree = Tree()
-    tree.add_prop('h5node', h5node['tree'])
-    _load_tree_from_h5(tree, h5node['tree'])
+    if lazy:
+        return LazyH5Tree(fname, max_nodes=max_nodes, props=props).tree
+    h5node = h5py.File(fname, mode)
+    if 'topology' in h5node:  # array-backed layout
+        tree = load_topology(h5node['topology'])
+        tree.add_prop('h5node', h5node['topology'])
+    else:
+        # create empty Tree to be populated from hdf5 file structure
+        tree = Tree()
+        for k, v in h5node['tree'].attrs.items():
+            tree.add_prop(k, v)
+        tree.add_prop('h5node', h5node['tree'])
+        _load_tree_from_h5(tree, h5node['tree'])
+    if 'node_props' in h5node:
+        load_props(h5node['node_props'], tree.traverse(), props)
+    if mode != 'r':
+        track(tree)
     return tree
 
 
-times = {}
-
-t = Tree()
-
-tree_len = int(sys.argv[1])  # wanted random tree length
-seq_len  = int(sys.argv[2])  # wanted random sequences length
-chunk_size = int(sys.argv[3]), int(sys.argv[4])  # for storing alignment
-
-t.populate(tree_len, names_library=map(str, range(tree_len + 1)))
-base_name_fasta = f'{len(t)}leaves_{int(seq_len / 1_000)}Kbp'
-base_name = f'{len(t)}leaves_{int(seq_len / 1_000)}Kbp_chunks{chunk_size[0]}-{chunk_size[1]}'
-fasta  = f'alignment_{base_name_fasta}.fasta'
-
-printime('Generate random alignment')
-generate_random_alignment(t, seq_len, fasta)
-
-printime('Create h5tree')
-t0 = time()
-t1 = dump_h5tree(t, f'h5tree_{base_name}.hdf5', fasta)
-if t1 is None:
-    t1 = time()
-times['store hdf5 alignment'] = t1 - t0
-times['create hdf5 tree'] = time() - t1
-t1 = time()
-
-del(t)
-
-printime('Read h5tree')
-h5tree = load_h5tree(f'h5tree_{base_name}.hdf5')
-times['read hdf5 tree'] = time() - t1
-
-printime('random access to h5tree sequences')
-for _ in range(10):
-    wanted_leaves = choices(h5tree.get_leaf_names(), k=1000)
+def save_h5tree(tree, h5out=None, touched=None, **kwargs):
+    """
+    Writes the changes made to a tree loaded with load_h5tree.
+
+    By default, only the records of the nodes changed (moved, added, removed,
+    or with new properties) and of their ancestors are rewritten in the file
+    the tree was loaded from (opened with mode='r+', see flush.py). Rows of
+    the alignment are not moved, so that clades may stop spanning contiguous
+    rows (see sort_h5tree).
+
+    :param None h5out: instead, write the whole tree to this new h5tree, with
+       the alignment rows copied in preorder of the leaves
+    :param None touched: nodes known to be the only ones modified, to avoid
+       comparing all nodes with their records (see flush.flush)
+    :param kwargs: passed to dump_h5tree, by default keeping the layout,
+       chunks (or contiguous layout), packing, compression, consensus and
+       profiles of the h5tree
+
+    :returns: in the incremental mode, the changes written
+    """
+    if h5out is None:
+        return flush(tree, touched)
+    h5f = tree.props['h5node'].file
+    if 'alignment' in h5f['leaf_data']:
+        src = h5f['leaf_data']['alignment']
+        kwargs.setdefault('packed', is_packed(src))
+        kwargs.setdefault('contiguous', src.chunks is None)
+        if src.chunks and is_packed(src):  # chunks are given in bases
+            kwargs.setdefault('chunk_size', (src.chunks[0], 2 * src.chunks[1]))
+        if src.chunks:
+            kwargs.setdefault('chunk_size', src.chunks)
+        kwargs.setdefault('compression', src.compression)
+        kwargs.setdefault('compression_opts', src.compression_opts)
+        kwargs.setdefault('shuffle', src.shuffle)
+        kwargs.setdefault('source', (src, {n.name: n.props['alignment']
+                                           for n in tree.traverse()
+                                           if not n.children}))
+    kwargs.setdefault('layout', 'arrays' if 'topology' in h5f else 'groups')
+    kwargs.setdefault('consensus', 'consensus' in h5f.get('node_data', ()))
+    kwargs.setdefault('profiles', 'profile' in h5f.get('node_data', ()))
+    tree.props.pop('h5state', None)  # nodes now point to the new file
+    dump_h5tree(tree, h5out, overwrite=True, **kwargs)
+
+
+def _new_clades(new, known):
+    """
+    :param new: tree with new leaves and leaves of the h5tree
+    :param known: names of the leaves of the h5tree
 
-    refs = sorted(set([(h5tree & l).props['h5node'].attrs['alignment']
-                for l in wanted_leaves]))
+    :returns: list of the largest clades of new leaves, with the names of
+       the leaves of the h5tree in the clade of their parent
+    """
+    old = {}  # id(node) -> whether it has leaves of the h5tree
+    for node in new.traverse('postorder'):
+        if node.children:
+            old[id(node)] = any(old[id(c)] for c in node.children)
+        else:
+            old[id(node)] = node.name in known
+    if not old[id(new)]:
+        raise Exception('ERROR: no leaf of the h5tree found in the new tree.')
+    clades = []
+    for node in new.traverse(is_leaf_fn=lambda n: not old[id(n)]):
+        if not old[id(node)]:
+            clades.append((node, [n.name for n in node.up.leaves() if n.name in known]))
+    return clades
 
-    t1 = time()
-    print(h5tree.props['h5node'].file['leaf_data']['alignment'][refs, 400:600])
-    times.setdefault('random access alignment', []).append(time() - t1)
 
-log = open(f'h5test_{base_name}.log', 'w')
-for k in times:
-    if k == 'random access alignment':
-        log.write(f'{k}\t{",".join(str(t) for t in times[k])}\n')
+def append_leaves(tree_file, new, fasta):
+    """
+    Appends leaves, with their sequences, to an h5tree without rewriting it:
+    alignment rows and topology records (or groups) are appended, and only
+    the records of the ancestors of the new leaves are updated (row ranges,
+    consensus and profiles, see flush.py), at a cost proportional to the new
+    data in the array-backed layout (see live.py). In the group-per-node
+    layout, the tree is loaded to find where to attach the new nodes.
+
+    New leaves get the rows following those of the h5tree, so that their
+    ancestors may stop spanning contiguous rows (see sort_h5tree).
+
+    :param tree_file: path to the h5tree, with a chunked alignment
+    :param new: either a tree with the new leaves and leaves of the h5tree
+       (e.g. the tree updated with new samples), each largest clade of new
+       leaves being attached, with its topology and properties, to the most
+       recent common ancestor in the h5tree of the other leaves of its
+       parent, or a list of placements (name of a new leaf, node, branch
+       length), node being the name of a leaf of the h5tree or a node id,
+       the new leaf being attached to it or, if it is a leaf, to its parent
+    :param fasta: FASTA file with the sequences of the new leaves (other
+       records are skipped)
+
+    :returns: number of leaves appended
+    """
+    if isinstance(new, Tree):
+        clades = None
+        names = {n.name for n in new.leaves()}
     else:
-        log.write(f'{k}\t{times[k]}\n')
-log.close()
-
-# clean 
-# os.system(f'rm -f h5tree_{base_name}.hdf5')
+        clades = []
+        for name, node, dist in new:
+            leaf = Tree()
+            leaf.name, leaf.dist = name, dist
+            clades.append((leaf, node))
+        names = {leaf.name for leaf, _ in clades}
+    with h5py.File(tree_file, 'r') as h5f:
+        known = set(h5f['leaf_data'].attrs)
+        row_props = MANAGED | set(h5f['leaf_data']) | set(h5f.get('node_data', ()))
+        arrays = 'topology' in h5f
+    names -= known
+    if clades is None:
+        clades = _new_clades(new, known)
+    sequences = {}
+    for header, seq in fasta_reader(fasta):
+        if header[0] in names:
+            sequences[header[0]] = seq
+    missing = names - set(sequences)
+    if missing:
+        raise Exception(f'ERROR: {len(missing)} sequences not found in {fasta}, '
+                        f'e.g. {next(iter(missing))}.')
+
+    def _props(node):
+        return {k: v for k, v in node.props.items()
+                if k not in row_props and k not in ('name', 'dist', 'support')}
+
+    if arrays:
+        columns = {}
+        for clade, _ in clades:
+            for node in clade.traverse():
+                for k, v in _props(node).items():
+                    columns.setdefault(k, []).append(v)
+        columns = {k: {'b': bool, 'i': int, 'f': float, 'O': str}[_kind(values)]
+                   for k, values in columns.items()}
+        writer = LiveWriter(tree_file, columns, swmr=False)
+        leaf_ids = None
+        records = {'parents': [], 'names': [], 'sequences': [], 'dists': [],
+                   'supports': [], 'props': []}
+        for clade, anchor in clades:
+            if isinstance(anchor, (int, np.integer)):
+                target = writer.mrca([int(anchor)])
+            else:
+                if leaf_ids is None:
+                    leaf_ids = writer.leaf_ids()
+                target = writer.mrca(leaf_ids[n] for n in ([anchor] if isinstance(anchor, str)
+                                                           else anchor))
+            ids = {}
+            for node in clade.traverse('preorder'):
+                ids[id(node)] = writer.size + len(records['names'])
+                records['parents'].append(target if node is clade else ids[id(node.up)])
+                records['names'].append(node.name)
+                records['sequences'].append(None if node.children else sequences[node.name])
+                records['dists'].append(node.dist)
+                records['supports'].append(node.support if node.children else None)
+                records['props'].append(_props(node))
+        writer.append_nodes(**records)
+        writer.close()
+        return len(names)
+
+    tree = load_h5tree(tree_file, mode='r+')
+    h5f = tree.props['h5node'].file
+    leaves = {n.name: n for n in tree.leaves()}
+    ids = {n.props['node_id']: n for n in tree.traverse() if 'node_id' in n.props}
+    alignment = h5f['leaf_data']['alignment']
+    if alignment.maxshape[0] is not None:
+        raise Exception('ERROR: rows cannot be appended to the alignment '
+                        '(contiguous, or written by an older version).')
+    rows = {}
+    touched = []
+    for clade, anchor in clades:
+        if isinstance(anchor, (int, np.integer)):
+            target = ids[int(anchor)]
+        else:
+            target = tree.common_ancestor(*[leaves[n] for n in (
+                [anchor] if isinstance(anchor, str) else anchor)])
+        if not target.children:
+            target = target.up
+        copies = {}  # copy without the properties managed by the h5tree
+        for node in clade.traverse('preorder'):
+            copy = Tree(dict(_props(node), name=node.name))
+            for k in ('dist', 'support'):
+                if node.props.get(k) is not None:
+                    copy.add_prop(k, node.props[k])
+            if not node.children:
+                rows[node.name] = len(alignment) + len(rows)
+                copy.add_prop('alignment', rows[node.name])
+            (target if node is clade else copies[id(node.up)]).add_child(copy)
+            copies[id(node)] = copy
+        touched += [target] + list(copies.values())
+    alignment.resize(len(alignment) + len(rows), axis=0)
+    write_alignment(alignment, (((name,), sequences[name]) for name in rows), rows)
+    for name, row in rows.items():
+        h5f['leaf_data'].attrs[name] = row
+    save_h5tree(tree, touched=touched)
+    h5f.close()
+    return len(rows)
 
-printime('Done.')
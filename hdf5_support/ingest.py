@@ -0,0 +1,332 @@
+"""
+Streaming ingestion of FASTA alignments into an hdf5 alignment dataset.
+
+Sequences are built in bytearrays (linear in their length whatever the
+number of lines), encoded straight into a buffer of rows matching the row
+chunks of the dataset, and each full buffer is flushed with a single
+contiguous write.
+
+Packed alignment datasets (see codec.is_packed) are encoded with
+seq2packed_nt, and amino-acid ones (see codec.is_protein) with seq2num_aa,
+whatever the encoder given.
+"""
+import os
+
+from multiprocessing               import get_context
+from multiprocessing.shared_memory import SharedMemory
+from queue                         import Empty
+
+import numpy as np
+
+from codec          import encode, seq2packed_nt, is_packed, is_protein
+from codec          import NT_ENCODER, AA_ENCODER
+
+
+def fasta_reader(fasta, header_delimiter='\t', start=0, end=None):
+    """
+    :param fasta: path to FASTA file
+    :param '\\t' header_delimiter: to split headers into fields
+    :param 0 start: file offset of the first record to read (must be the
+       start of a header line)
+    :param None end: file offset after which no new record is read
+
+    :yields: header fields (list of str) and the sequence (bytearray)
+    """
+    with open(fasta, 'rb') as fh:
+        fh.seek(start)
+        pos = start
+        header = None
+        seq = bytearray()
+        for l in fh:
+            if l.startswith(b'>'):
+                if end is not None and pos >= end:
+                    break
+                if header is not None:
+                    yield header, seq
+                header = l[1:].strip().decode().split(header_delimiter)
+                seq = bytearray()
+            else:
+                seq += l.rstrip()
+            pos += len(l)
+        if header is not None:
+            yield header, seq
+
+
+def fasta_ranges(fasta, num, read_size=2**20):
+    """
+    Splits a FASTA file in byte ranges starting at record boundaries.
+
+    :param fasta: path to FASTA file
+    :param num: wanted number of ranges (less are returned if records are
+       too long)
+
+    :returns: list of (start, end) file offsets
+    """
+    size = os.path.getsize(fasta)
+    bounds = [0]
+    with open(fasta, 'rb') as fh:
+        for i in range(1, num):
+            pos = max(bounds[-1], i * size // num, 1)
+            # look for the next line starting with '>' from the byte before
+            fh.seek(pos - 1)
+            prev = fh.read(1)
+            while pos < size:
+                block = fh.read(read_size)
+                found = (prev[-1:] + block).find(b'\n>')
+                if found != -1:
+                    pos += found
+                    break
+                pos += len(block)
+                prev = block
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def block_rows(alignment, buffer_size=2**30):
+    """
+    :param alignment: hdf5 (chunked) alignment dataset
+    :param 2**30 buffer_size: maximum size in bytes of a block of rows
+
+    :returns: number of rows per block, the number of rows of a chunk, unless
+       they do not fit into buffer_size
+    """
+    rows = alignment.chunks[0] if alignment.chunks else alignment.shape[0]
+    return max(1, min(rows, buffer_size // max(1, alignment.shape[1])))
+
+
+def _flush_block(alignment, start, block, filled):
+    """
+    Writes the filled rows of a block, with a single write if all are filled,
+    or one write per contiguous run of filled rows otherwise.
+    """
+    if filled.all():
+        alignment[start:start + len(block)] = block
+        return
+    # limits of runs of True in filled
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], filled, [0])).astype('int8')))
+    for beg, end in zip(edges[::2], edges[1::2]):
+        alignment[start + beg:start + end] = block[beg:end]
+
+
+def write_rows(alignment, items, put=np.copyto, buffer_size=2**30,
+               max_pending=2):
+    """
+    Writes rows into an alignment dataset by blocks of rows.
+
+    When rows come in the same order as in the dataset, only one block is
+    kept in memory and each block is written at once. Otherwise up to
+    max_pending partially filled blocks are kept, the oldest being partially
+    written when a new one is needed.
+
+    :param alignment: hdf5 int8 dataset of shape (number of rows, sequence
+       length)
+    :param items: iterable of (row number, value)
+    :param np.copyto put: function called as put(out, value) to write value
+       in out, the buffer of the row
+    :param 2**30 buffer_size: maximum size in bytes of a block of rows
+    :param 2 max_pending: maximum number of blocks kept in memory
+    """
+    nrows, ncols = alignment.shape
+    size = block_rows(alignment, buffer_size)
+    pending = {}  # block number -> (block of rows, filled rows)
+    for row, value in items:
+        num = row // size
+        if num not in pending:
+            if len(pending) >= max_pending:
+                oldest = next(iter(pending))
+                _flush_block(alignment, oldest * size, *pending.pop(oldest))
+            length = min(size, nrows - num * size)
+            pending[num] = (np.empty((length, ncols), dtype=alignment.dtype),
+                            np.zeros(length, dtype=bool))
+        block, filled = pending[num]
+        put(block[row - num * size], value)
+        filled[row - num * size] = True
+        if filled.all():
+            _flush_block(alignment, num * size, *pending.pop(num))
+    for num, (block, filled) in pending.items():
+        _flush_block(alignment, num * size, block, filled)
+
+
+def _check_length(header, seq, ncols):
+    if len(seq) != ncols:
+        raise Exception(f'ERROR: sequence {header[0]} has length '
+                        f'{len(seq)}, expected {ncols}.')
+
+
+def _encoding(alignment, encoder):
+    """
+    :returns: the length of the sequences to write in alignment, and the
+       encoder to pass to _encode_row ('nt4' for packed datasets)
+    """
+    if is_packed(alignment):
+        return int(alignment.attrs['length']), 'nt4'
+    if is_protein(alignment):
+        return alignment.shape[1], AA_ENCODER
+    return alignment.shape[1], encoder
+
+
+def _encode_row(seq, encoder, out):
+    if encoder == 'nt4':
+        seq2packed_nt(seq, out=out)
+    else:
+        encode(seq, encoder, out=out)
+
+
+def write_alignment(alignment, records, rows, encoder=NT_ENCODER,
+                    buffer_size=2**30, max_pending=2):
+    """
+    Encodes and writes sequences into an alignment dataset by blocks of rows
+    (see write_rows).
+
+    :param alignment: hdf5 int8 dataset of shape (number of rows, sequence
+       length)
+    :param records: iterable of (header, sequence) as yielded by fasta_reader
+    :param rows: dictionary mapping sequence name (first header field) to
+       row number
+    :param NT_ENCODER encoder: LUT pair from codec
+    :param 2**30 buffer_size: maximum size in bytes of a block of rows
+    :param 2 max_pending: maximum number of blocks kept in memory
+    """
+    seq_len, encoder = _encoding(alignment, encoder)
+
+    def _items():
+        for header, seq in records:
+            _check_length(header, seq, seq_len)
+            yield rows[header[0]], seq
+
+    write_rows(alignment, _items(),
+               lambda out, seq: _encode_row(seq, encoder, out),
+               buffer_size=buffer_size, max_pending=max_pending)
+
+
+def copy_rows(src, alignment, rows, buffer_size=2**30, convert=None):
+    """
+    Copies rows of a dataset into an alignment dataset in a different order,
+    by blocks of destination rows.
+
+    :param src: hdf5 dataset with the same number of columns as alignment
+       (once converted)
+    :param alignment: hdf5 dataset
+    :param rows: dictionary mapping rows of alignment to rows of src
+    :param 2**30 buffer_size: maximum size in bytes of a block of rows
+    :param None convert: function applied to the blocks of rows read from
+       src (e.g. codec.pack_nt)
+    """
+    nrows, ncols = alignment.shape
+    size = block_rows(alignment, buffer_size)
+    for beg in range(0, nrows, size):
+        end = min(nrows, beg + size)
+        dst = np.array([r for r in range(beg, end) if r in rows], dtype='int64')
+        old = np.array([rows[r] for r in dst], dtype='int64')
+        # hdf5 selections must be increasing
+        order = np.argsort(old)
+        block = np.zeros((end - beg, ncols), dtype=alignment.dtype)
+        if len(old):
+            values = src[old[order].tolist()]
+            block[dst[order] - beg] = convert(values) if convert else values
+        alignment[beg:end] = block
+
+
+def _init_worker(slot_names, free, done):
+    global _slots, _free, _done
+    _slots = [SharedMemory(name) for name in slot_names]
+    _free = free
+    _done = done
+
+
+def _encode_range(fasta, start, end, seq_len, shape, batch, encoder):
+    """
+    Worker task: encodes the records of a byte range of a FASTA file into
+    shared memory slots, sent to the writer as (slot, sequence names).
+
+    :returns: number of slots sent
+    """
+    sent = 0
+    names = []
+    block = None
+    for header, seq in fasta_reader(fasta, start=start, end=end):
+        _check_length(header, seq, seq_len)
+        if not names:
+            slot = _free.get()
+            block = np.ndarray((batch, shape[1]), dtype=shape[0],
+                               buffer=_slots[slot].buf)
+        _encode_row(seq, encoder, block[len(names)])
+        names.append(header[0])
+        if len(names) == batch:
+            _done.put((slot, names))
+            sent += 1
+            names = []
+    if names:
+        _done.put((slot, names))
+        sent += 1
+    del block
+    return sent
+
+
+def write_alignment_parallel(alignment, fasta, rows, workers=4,
+                             encoder=NT_ENCODER, buffer_size=2**30,
+                             max_pending=2):
+    """
+    Same as write_alignment, but with FASTA parsing and encoding done by a
+    pool of worker processes, each on a byte range of the FASTA file.
+    Encoded rows are passed to this process (the only one writing to the
+    file) through a fixed set of shared memory slots, so that memory use is
+    bounded whatever the speed of the writer.
+
+    :param alignment: hdf5 int8 dataset of shape (number of rows, sequence
+       length)
+    :param fasta: path to FASTA file
+    :param rows: dictionary mapping sequence name (first header field) to
+       row number
+    :param 4 workers: number of worker processes
+    :param NT_ENCODER encoder: LUT pair from codec
+    :param 2**30 buffer_size: maximum size in bytes of a block of rows, half
+       of it is also shared among the slots used by the workers
+    :param 2 max_pending: maximum number of blocks kept in memory by the
+       writer
+    """
+    ncols = alignment.shape[1]
+    seq_len, encoder = _encoding(alignment, encoder)
+    shape = (alignment.dtype.str, ncols)
+    nslots = 2 * workers
+    batch = max(1, min(block_rows(alignment, buffer_size),
+                       buffer_size // (2 * nslots * max(1, ncols))))
+    slots = [SharedMemory(create=True, size=batch * max(1, ncols))
+             for _ in range(nslots)]
+    ctx = get_context()
+    free = ctx.Queue()
+    done = ctx.Queue()
+    for slot in range(nslots):
+        free.put(slot)
+    tasks = [(fasta, start, end, seq_len, shape, batch, encoder)
+             for start, end in fasta_ranges(fasta, 4 * workers)]
+
+    def _items(result):
+        received = 0
+        while not result.ready() or received < sum(result.get()):
+            try:
+                slot, names = done.get(timeout=0.1)
+            except Empty:
+                continue
+            received += 1
+            block = np.ndarray((batch, ncols), dtype=alignment.dtype,
+                               buffer=slots[slot].buf)
+            for i, name in enumerate(names):
+                yield rows[name], block[i]
+            del block
+            free.put(slot)
+
+    try:
+        with ctx.Pool(workers, _init_worker,
+                      ([s.name for s in slots], free, done)) as pool:
+            result = pool.starmap_async(_encode_range, tasks)
+            write_rows(alignment, _items(result), buffer_size=buffer_size,
+                       max_pending=max_pending)
+    finally:
+        for s in slots:
+            s.close()
+            s.unlink()
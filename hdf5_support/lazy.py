@@ -0,0 +1,199 @@
+"""
+Lazy, on-demand, materialization of h5trees.
+
+Only the root and its children are created when opening the file. Other
+nodes are created when their parent is expanded, which happens as they are
+reached by LazyH5Tree.traverse (or explicitly with LazyH5Tree.expand).
+Internal nodes whose children are not yet created are stubs, marked with
+the property "stub".
+
+WARNING: stubs are plain ete4 nodes without children. Only
+LazyH5Tree.traverse and LazyH5Tree.expand materialize the tree: ete4
+methods (node.children, leaves(), descendants(), traverse(), write(), ...)
+see stubs as leaves, and give partial leaf sets or newicks without error.
+
+Under a memory budget (maximum number of materialized nodes), the least
+recently expanded subtrees are collapsed back to stubs.
+
+Works with both the group-per-node and the array-backed layouts.
+"""
+from collections    import OrderedDict
+
+import h5py
+
+from ete4           import Tree
+
+from node_props     import read_columns, set_props
+
+
+class LazyH5Tree:
+    """
+    Tree of an h5tree file, materialized on demand.
+
+    WARNING: only LazyH5Tree.traverse and LazyH5Tree.expand materialize
+    nodes. Iterating over self.tree with ete4 methods (children, leaves(),
+    write(), ...) sees unexpanded internal nodes (property "stub") as
+    leaves. Use self.traverse() (or expand(self.tree, depth)) first, e.g.
+    before writing the tree.
+
+    :param fname: path to h5tree file
+    :param None max_nodes: maximum number of nodes kept in memory (the
+       budget can be exceeded by the ancestors and children of the node
+       being expanded, which are never evicted)
+    :param None props: names of the node properties to load (see
+       node_props.py), by default all (their columns are read when opening)
+
+    :attr tree: root of the ete4 Tree (with a h5lazy property pointing to
+       this object)
+    """
+    def __init__(self, fname, max_nodes=None, props=None):
+        self.h5file = h5py.File(fname, 'r')
+        self.max_nodes = max_nodes
+        self._columns = (read_columns(self.h5file['node_props'], props)
+                         if 'node_props' in self.h5file else {})
+        self.size = 1
+        self.expanded = OrderedDict()  # id(node) -> node, in expansion order
+        self.tree = Tree()
+        self.tree.add_prop('h5lazy', self)
+        if 'topology' in self.h5file:  # array-backed layout
+            topo = self.h5file['topology']
+            self._first_child = topo['first_child'][:]
+            self._next_sibling = topo['next_sibling'][:]
+            self._dist = topo['dist'][:]
+            self._support = topo['support'][:]
+            self._leaf_row = topo['leaf_row'][:]
+            self._offsets = topo['name_offsets'][:]
+            self._names = topo['names'][:].tobytes()
+            self._node_row = topo['node_row'][:] if 'node_row' in topo else None
+            self._node_data = list(self.h5file.get('node_data', ()))
+            self._ranges = (topo['row_start'][:], topo['row_end'][:]) if 'row_start' in topo else None
+            self._children = self._children_from_arrays
+            for k, v in topo.attrs.items():
+                self.tree.add_prop(k, v)
+            self._set_array_node(self.tree, 0)
+        else:
+            self._children = self._children_from_groups
+            for k, v in self.h5file['tree'].attrs.items():
+                self.tree.add_prop(k, v)
+            self.tree.add_prop('h5node', self.h5file['tree'])
+        self.tree.add_prop('stub', True)
+        self.expand(self.tree)
+
+    def _set_array_node(self, node, i):
+        if self._offsets[i + 1] > self._offsets[i]:
+            node.name = self._names[self._offsets[i]:self._offsets[i + 1]].decode()
+        if self._dist[i] == self._dist[i]:  # not NaN
+            node.dist = float(self._dist[i])
+        if self._support[i] == self._support[i]:
+            node.support = float(self._support[i])
+        node.add_prop('node_id', i)
+        if self._columns and i:
+            set_props(node, self._columns, i)
+        if self._ranges and self._ranges[0][i] >= 0:
+            node.add_prop('row_start', int(self._ranges[0][i]))
+            node.add_prop('row_end', int(self._ranges[1][i]))
+        if self._leaf_row[i] >= 0:
+            node.add_prop('alignment', int(self._leaf_row[i]))
+        elif self._first_child[i] != -1:
+            node.add_prop('stub', True)
+            if self._node_data and self._node_row[i] >= 0:
+                for nd in self._node_data:
+                    node.add_prop(nd, int(self._node_row[i]))
+
+    def _children_from_arrays(self, node):
+        child = self._first_child[node.props['node_id']]
+        while child != -1:
+            self._set_array_node(node.add_child(), child)
+            child = self._next_sibling[child]
+
+    def _children_from_groups(self, node):
+        group = node.props['h5node']
+        for name in group:
+            child = node.add_child()
+            child.name = name
+            for k, v in group[name].attrs.items():
+                child.add_prop(k, v)
+            if self._columns and 'node_id' in child.props:
+                set_props(child, self._columns, child.props['node_id'])
+            child.add_prop('h5node', group[name])
+            if len(group[name]):
+                child.add_prop('stub', True)
+
+    def expand(self, node, depth=1):
+        """
+        Materializes the children of a stub node (and of its descendants,
+        down to depth levels).
+
+        :returns: the children of node
+        """
+        if node.props.get('stub'):
+            node.del_prop('stub')
+            self._children(node)
+            self.size += len(node.children)
+            self.expanded[id(node)] = node
+            self._evict(node)
+        elif id(node) in self.expanded:
+            self.expanded.move_to_end(id(node))
+        if depth > 1:
+            for child in node.children:
+                self.expand(child, depth - 1)
+        return node.children
+
+    def collapse(self, node):
+        """
+        Turns node back into a stub, freeing all its descendants.
+        """
+        if node.props.get('stub') or not node.children:
+            return
+        for desc in self._materialized(node):
+            if desc is not node:
+                self.size -= 1
+            self.expanded.pop(id(desc), None)
+        node.children = []
+        node.add_prop('stub', True)
+
+    def _evict(self, keep):
+        """
+        Collapses least recently expanded nodes until the budget is met,
+        sparing keep and its ancestors.
+        """
+        if self.max_nodes is None or self.size <= self.max_nodes:
+            return
+        spared = set()
+        while keep is not None:
+            spared.add(id(keep))
+            keep = keep.up
+        for key in list(self.expanded):
+            if self.size <= self.max_nodes:
+                break
+            if key not in spared and key in self.expanded:
+                self.collapse(self.expanded[key])
+
+    def _materialized(self, node):
+        """
+        Iterates over materialized nodes of a subtree (without expanding).
+        """
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            yield node
+            todo.extend(node.children)
+
+    def traverse(self, node=None, is_leaf_fn=None):
+        """
+        Preorder traversal of the tree, expanding stubs as they are reached
+        (before they are yielded, so that their children can be inspected).
+
+        :param None node: root of the traversal (defaults to the tree root)
+        :param None is_leaf_fn: function returning True for nodes that should
+           be considered leaves (and therefore not expanded)
+        """
+        todo = [node or self.tree]
+        while todo:
+            node = todo.pop()
+            if is_leaf_fn is None or not is_leaf_fn(node):
+                todo.extend(reversed(self.expand(node)))
+            yield node
+
+    def close(self):
+        self.h5file.close()
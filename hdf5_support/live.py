@@ -0,0 +1,487 @@
+"""
+Single writer, multiple readers (hdf5 SWMR) access to h5trees.
+
+One process (LiveWriter) appends leaves, with their sequences and
+properties, to an h5tree of the array-backed layout (see topology.py),
+while other processes (LiveReader) read it concurrently, without locking
+each other out and without reopening the file: readers refresh their view
+of the datasets to see what was appended since.
+
+In SWMR mode, hdf5 only supports writing to existing datasets (no new
+datasets, groups or attributes), hence:
+
+  - the alignment has to be chunked with an unlimited number of rows (as
+    written by dump_h5tree, except contiguous alignments)
+  - the columns of properties of the new leaves missing in the h5tree
+    (see node_props.py), and the masks of the columns, are created when
+    the writer opens the file, before readers can open it
+  - variable length data is not supported (readers fail to read strings
+    written after they opened the file), string properties of the new
+    leaves are stored with a fixed length, their columns being rewritten
+    when the writer opens the file
+  - the leaf_data attributes mapping leaf names to rows are only written
+    when the writer is closed, after the readers (until then, readers find
+    the new leaves through the topology)
+
+Each append first writes the records of the new leaves (alignment rows,
+topology records, property columns) and updates the consensus, profiles
+and row ranges of their ancestors, flushes them, and only then links the
+new leaves to their parents (first_child and next_sibling), flushed again.
+Node ids of the new leaves being larger than any id seen by a reader,
+links to them are ignored (see topology.load_topology) until the reader
+refreshes its view, so that every leaf it reaches has its records already
+written.
+"""
+import h5py
+import numpy as np
+
+from codec          import unpack_nt, is_packed, NT_ENCODER
+from ingest         import _encoding, _encode_row, _check_length
+from clade_data     import count_profile
+from node_props     import MANAGED, _kind, _fits, _column, _write_column, column_values
+from node_props     import load_props
+from topology       import load_topology
+from query          import H5Alignment
+
+
+_KINDS = {bool: 'b', int: 'i', float: 'f', str: 'O'}
+
+
+class LiveWriter:
+    """
+    Appends leaves to an h5tree while readers access it (see LiveReader),
+    which can open the file once the writer is created.
+
+    :param fname: path to an h5tree with the array-backed layout
+    :param None columns: dictionary mapping names of properties of the new
+       nodes to their type (bool, int, float or str), needed for properties
+       not stored in the h5tree, and, in SWMR mode, for strings
+    :param 64 string_size: maximum length in bytes (utf-8) of the strings
+       of the columns given as str
+    :param True swmr: False to append without concurrent readers (see
+       h5node_prototype.append_leaves), strings being then stored with
+       variable length
+    """
+    def __init__(self, fname, columns=None, string_size=64, swmr=True):
+        self.fname = fname
+        self.swmr = swmr
+        self.h5file = h5py.File(fname, 'r+', libver='latest')
+        if 'topology' not in self.h5file:
+            raise Exception('ERROR: live mode needs an h5tree with the '
+                            'array-backed layout (layout="arrays").')
+        if 'alignment' not in self.h5file['leaf_data']:
+            raise Exception('ERROR: h5tree without alignment.')
+        self.alignment = self.h5file['leaf_data']['alignment']
+        if self.alignment.maxshape[0] is not None:
+            raise Exception('ERROR: rows cannot be appended to the alignment '
+                            '(contiguous, or written by an older version).')
+        self.seq_len, self._encoder = _encoding(self.alignment, NT_ENCODER)
+        self.topology = self.h5file['topology']
+        self.node_data = self.h5file.get('node_data', {})
+        for nd in self.node_data:
+            if self.node_data[nd].maxshape[0] is not None:
+                raise Exception(f'ERROR: node_data/{nd} cannot be extended.')
+        # single writer: the links are kept in memory
+        self._parent = self.topology['parent'][:].tolist()
+        self._first_child = self.topology['first_child'][:].tolist()
+        self._next_sibling = self.topology['next_sibling'][:].tolist()
+        self._leaf_row = self.topology['leaf_row'][:].tolist()
+        self._node_row = self.topology['node_row'][:].tolist()
+        self._ranges = None
+        if 'row_start' in self.topology:
+            self._ranges = (self.topology['row_start'][:].tolist(),
+                            self.topology['row_end'][:].tolist())
+        self._last_child = {}
+        self._new_leaves = {}  # name -> row, for the leaf_data attributes
+        # all columns get a mask, as new nodes may lack their property
+        self.props = self.h5file.require_group('node_props')
+        size = self.size
+        for key, kind in (columns or {}).items():
+            if kind is str and swmr and (key not in self.props or
+                                         self.props[key].dtype.kind == 'O'):
+                values = (column_values(self.props, key, size) if key in self.props
+                          else [None] * size)
+                _write_column(self.props, key, values, dtype=f'S{string_size}')
+            elif key not in self.props:
+                _write_column(self.props, key, [None] * size, _KINDS[kind])
+        masks = self.props.require_group('_defined')
+        for key in self.props:
+            if key != '_defined' and key not in masks:
+                masks.create_dataset(key, data=np.ones(len(self.props[key]), dtype=bool),
+                                     maxshape=(None,))
+        if swmr:
+            self.h5file.swmr_mode = True
+
+    @property
+    def size(self):
+        """
+        Number of node ids.
+        """
+        return len(self._parent)
+
+    def _last(self, parent):
+        """
+        :returns: id of the last child of a node (-1 if none)
+        """
+        if parent not in self._last_child:
+            last, child = -1, self._first_child[parent]
+            while child != -1:
+                last, child = child, self._next_sibling[child]
+            self._last_child[parent] = last
+        return self._last_child[parent]
+
+    def _link(self, parent, child):
+        """
+        Adds child as the last child of parent (in memory).
+
+        :returns: name of the link changed, and id of the node changed
+        """
+        last = self._last(parent)
+        self._last_child[parent] = child
+        if last == -1:
+            self._first_child[parent] = child
+            return 'first_child', parent
+        self._next_sibling[last] = child
+        return 'next_sibling', last
+
+    def _ancestors(self, node_id):
+        ancestors = []
+        while node_id != -1:
+            ancestors.append(node_id)
+            node_id = self._parent[node_id]
+        return ancestors
+
+    def mrca(self, ids):
+        """
+        :param ids: node ids
+
+        :returns: id of their most recent common ancestor (the parent of a
+           single leaf)
+        """
+        ids = iter(ids)
+        path = self._ancestors(next(ids))
+        depth = {a: d for d, a in enumerate(reversed(path))}
+        mrca = path[0]
+        seen = set()
+        for node in ids:
+            while node not in depth and node not in seen:
+                seen.add(node)
+                node = self._parent[node]
+            if node in depth and depth[node] < depth[mrca]:
+                mrca = node
+        return self._parent[mrca] if self._leaf_row[mrca] >= 0 else mrca
+
+    def leaf_ids(self):
+        """
+        :returns: dictionary mapping the names of the leaves to their ids
+        """
+        offsets = self.topology['name_offsets'][:].tolist()
+        names = self.topology['names'][:].tobytes()
+        return {names[offsets[i]:offsets[i + 1]].decode(): i
+                for i, row in enumerate(self._leaf_row)
+                if row >= 0 and self._parent[i] != -2}
+
+    def _extend(self, dataset, values):
+        if len(values):
+            dataset.resize(len(dataset) + len(values), axis=0)
+            dataset[-len(values):] = values
+
+    def append(self, names, sequences, parent=0, dists=None, props=None):
+        """
+        Appends leaves, with their sequences, visible to readers once the
+        call returns.
+
+        :param names: names of the new leaves
+        :param sequences: their aligned sequences (str)
+        :param 0 parent: id of the internal node to which the leaves are
+           attached (see topology.py), or list of ids, one per leaf
+        :param None dists: list of the branch lengths of the new leaves
+        :param None props: list of dictionaries with the properties of each
+           new leaf
+
+        :returns: list of the node ids of the new leaves
+        """
+        if isinstance(parent, (int, np.integer)):
+            parent = [int(parent)] * len(names)
+        return self.append_nodes(parent, names, sequences, dists, props=props)
+
+    def append_nodes(self, parents, names, sequences, dists=None, supports=None,
+                     props=None):
+        """
+        Appends nodes, leaves or clades of new nodes (in preorder), visible
+        to readers once the call returns.
+
+        :param parents: id of the parent of each node: an internal node of
+           the h5tree or a node appended before in the same call (appended
+           nodes get ids from size on, in order)
+        :param names: names of the nodes
+        :param sequences: aligned sequences (str) of the leaves, None for
+           internal nodes
+        :param None dists: branch lengths (None where undefined)
+        :param None supports: supports (None where undefined)
+        :param None props: dictionaries with the properties of each node
+
+        :returns: list of the node ids of the new nodes
+        """
+        num = len(names)
+        size, nrows = self.size, len(self.alignment)
+        ids = list(range(size, size + num))
+        internal = [seq is None for seq in sequences]
+        parents = [int(p) for p in parents]
+        for i, p in enumerate(parents):
+            if not (0 <= p < size and self._parent[p] != -2 and self._leaf_row[p] < 0
+                    or size <= p < size + i and internal[p - size]):
+                raise Exception(f'ERROR: node {p} is not an internal node.')
+        childless = {ids[i] for i in range(num) if internal[i]} - set(parents)
+        if childless:
+            raise Exception(f'ERROR: new internal nodes without children: {sorted(childless)}.')
+        leaf_names = self.h5file['leaf_data'].attrs
+        new_names = set()
+        for name, is_internal in zip(names, internal):
+            if is_internal:
+                continue
+            if name in leaf_names or name in self._new_leaves or name in new_names:
+                raise Exception(f'ERROR: Leaf name {name} found multiple times.')
+            new_names.add(name)
+        props = props or [{}] * num
+        unknown = {k for p in props for k in p} - set(self.props) - MANAGED
+        if unknown:
+            raise Exception(f'ERROR: properties {", ".join(sorted(unknown))} '
+                            'missing in the h5tree (see columns of LiveWriter).')
+        leaves = [i for i in range(num) if not internal[i]]
+        block = np.empty((len(leaves), self.alignment.shape[1]), dtype=self.alignment.dtype)
+        for j, i in enumerate(leaves):
+            _check_length((names[i],), sequences[i], self.seq_len)
+            _encode_row(sequences[i], self._encoder, block[j])
+        # rows in preorder of the new leaves, internal nodes starting at the
+        # row of their first leaf
+        rows, node_rows, starts = [], [], []
+        nd_size = len(self.node_data[next(iter(self.node_data))]) if self.node_data else 0
+        row = nrows
+        for i in range(num):
+            starts.append(row)
+            if internal[i]:
+                rows.append(-1)
+                node_rows.append(nd_size if self.node_data else -1)
+                nd_size += bool(self.node_data)
+            else:
+                rows.append(row)
+                node_rows.append(-1)
+                row += 1
+
+        # records of the new nodes, linked to each other but not yet to the
+        # nodes of the h5tree
+        self._parent += parents
+        self._first_child += [-1] * num
+        self._next_sibling += [-1] * num
+        self._leaf_row += rows
+        self._node_row += node_rows
+        links = []
+        for i, p in zip(ids, parents):
+            if p < size:
+                links.append((p, i))
+            else:
+                self._link(p, i)
+        self._extend(self.alignment, block)
+        encoded = [(name or '').encode() for name in names]
+        offsets = self.topology['name_offsets'][-1] + np.cumsum([len(n) for n in encoded])
+        self._extend(self.topology['names'], np.frombuffer(b''.join(encoded), dtype='uint8'))
+        self._extend(self.topology['name_offsets'], offsets)
+        for name, values in (('parent', parents), ('leaf_row', rows),
+                             ('node_row', node_rows),
+                             ('first_child', self._first_child[size:]),
+                             ('next_sibling', self._next_sibling[size:]),
+                             ('dist', dists or [None] * num),
+                             ('support', supports or [None] * num)):
+            self._extend(self.topology[name], [np.nan if v is None else v for v in values])
+        self._append_props(props, size)
+
+        # ancestors (new and of the h5tree): row ranges, and consensus and
+        # profiles (new leaves of each internal node at once)
+        ancestors = {p: self._ancestors(p) for p in set(parents)}
+        members = {}
+        for j, i in enumerate(leaves):
+            for a in ancestors[parents[i]]:
+                if self._node_row[a] >= 0:
+                    members.setdefault(a, []).append(j)
+        self._update_node_data(block, members, size, nd_size)
+        if self._ranges:
+            self._update_ranges(ancestors, parents, rows, starts, size)
+        self.h5file.flush()
+
+        # links, once all the records they point to are written
+        changes = {'first_child': {}, 'next_sibling': {}}
+        for p, i in links:
+            name, changed = self._link(p, i)
+            changes[name][changed] = i
+        for name, changed in changes.items():
+            if changed:
+                changed_ids = sorted(changed)
+                self.topology[name][changed_ids] = [changed[i] for i in changed_ids]
+        self.h5file.flush()
+        self._new_leaves.update((names[i], rows[i]) for i in leaves)
+        return ids
+
+    def _append_props(self, props, size):
+        """
+        Extends the property columns (and their masks) with the values of
+        the new nodes, from node id size on.
+        """
+        masks = self.props['_defined']
+        for key in self.props:
+            if key == '_defined':
+                continue
+            dataset = self.props[key]
+            current = dataset.dtype.kind
+            old_size = len(dataset)
+            values = [None] * (size - old_size) + [p.get(key) for p in props]
+            kind = _kind(v for v in values if v is not None)
+            if current == 'O' and self.swmr:
+                if any(v is not None for v in values):
+                    raise Exception(f'ERROR: property {key} stored as variable '
+                                    'length strings (see columns of LiveWriter).')
+                continue  # nodes beyond the column do not have the property
+            data, defined = _column(values, current)
+            if not _fits(kind, current) or (current == 'S' and
+                                            data.dtype.itemsize > dataset.dtype.itemsize):
+                raise Exception(f'ERROR: values of property {key} do not fit '
+                                f'its column ({dataset.dtype}).')
+            self._extend(dataset, data)
+            self._extend(masks[key], defined)
+
+    def _update_node_data(self, block, members, size, nd_size):
+        """
+        Adds the new leaves (rows of block) to the consensus and profiles of
+        their ancestors (members mapping their ids to positions in block),
+        new internal nodes (from id size on) getting new rows, up to nd_size.
+        """
+        for nd in self.node_data:
+            self.node_data[nd].resize(nd_size, axis=0)
+        consensus = self.node_data.get('consensus')
+        profile = self.node_data.get('profile')
+        if profile is not None:
+            total = len(self.alignment)
+            if total > np.iinfo(profile.dtype).max:
+                raise Exception(f'ERROR: {total} leaves overflow profile counts '
+                                f'({profile.dtype}).')
+        for a, positions in members.items():
+            row = self._node_row[a]
+            codes = block[positions]
+            if consensus is not None:
+                value = np.bitwise_and.reduce(codes)
+                if a < size:
+                    value &= consensus[row]
+                consensus[row] = value
+            if profile is not None:
+                if is_packed(self.alignment):
+                    codes = unpack_nt(codes, self.seq_len)
+                counts = count_profile(codes, out=None if a >= size else
+                                       profile[row].astype('int64'))
+                profile[row] = counts.astype(profile.dtype)
+
+    def _update_ranges(self, ancestors, parents, rows, starts, size):
+        """
+        Extends the row range of the ancestors of new leaves ending right
+        before their rows, others do not span contiguous rows any more (new
+        internal nodes, from id size on, start with an empty range at the
+        row of their first leaf, in starts).
+        """
+        row_start, row_end = self._ranges
+        row_start.extend(starts)
+        row_end.extend(s + (r >= 0) for s, r in zip(starts, rows))
+        changed = set()
+        for p, row in zip(parents, rows):
+            if row < 0:
+                continue
+            for a in ancestors[p]:
+                if row_start[a] < 0:
+                    continue
+                if row_end[a] == row:
+                    row_end[a] = row + 1
+                else:
+                    row_start[a] = row_end[a] = -1
+                changed.add(a)
+        changed = sorted(a for a in changed if a < size)
+        if changed:
+            self.topology['row_start'][changed] = [row_start[a] for a in changed]
+            self.topology['row_end'][changed] = [row_end[a] for a in changed]
+        self._extend(self.topology['row_start'], row_start[size:])
+        self._extend(self.topology['row_end'], row_end[size:])
+
+    def close(self):
+        """
+        Ends the live session, writing the rows of the new leaves to the
+        leaf_data attributes (the file being reopened without SWMR, readers
+        have to be closed before).
+        """
+        self.h5file.close()
+        with h5py.File(self.fname, 'r+', libver='latest') as h5file:
+            leaf_data = h5file['leaf_data']
+            for name, row in self._new_leaves.items():
+                leaf_data.attrs[name] = row
+            h5file['node_props'].attrs['size'] = len(self._parent)
+
+
+class LiveReader:
+    """
+    Reads an h5tree while a LiveWriter appends to it (the reader has to be
+    opened after the writer).
+
+    :param fname: path to the h5tree
+    :param None props: names of the node properties to load with the tree
+       (see node_props.py), by default all
+
+    :attr alignment: H5Alignment of the leaf alignment (see query.py)
+    """
+    def __init__(self, fname, props=None):
+        self.h5file = h5py.File(fname, 'r', libver='latest', swmr=True)
+        self.props = props
+        self.alignment = H5Alignment(self.h5file)
+        self._parent = self.h5file['topology']['parent']
+        self._datasets = []
+        for name in ('topology', 'node_props', 'node_props/_defined', 'node_data'):
+            if name in self.h5file:
+                self._datasets.extend(d for d in self.h5file[name].values()
+                                      if isinstance(d, h5py.Dataset))
+        self._datasets.append(self.alignment.dataset)
+        self.size = len(self._parent)
+
+    def refresh(self):
+        """
+        Updates the view of the datasets with what the writer flushed since
+        the last refresh, the number of nodes first, so that other datasets
+        hold at least the records of these nodes.
+
+        :returns: number of node ids
+        """
+        self._parent.refresh()
+        self.size = len(self._parent)
+        for dataset in self._datasets:
+            dataset.refresh()
+        return self.size
+
+    def load_tree(self):
+        """
+        :returns: Tree with the nodes seen at the last refresh, with the
+           same properties as given by load_h5tree
+        """
+        tree = load_topology(self.h5file['topology'], self.size)
+        if 'node_props' in self.h5file:
+            load_props(self.h5file['node_props'], tree.traverse(), self.props)
+        return tree
+
+    def get_alignment(self, items, columns=slice(None), raw=False):
+        """
+        :param items: leaf names (of leaves written before the current
+           writer) or nodes of a tree given by load_tree
+
+        :returns: 2D numpy array, rows in the order of items (see
+           query.H5Alignment.read_rows)
+        """
+        rows = self.alignment.resolve(items)
+        if len(rows) and rows.max() >= len(self.alignment.dataset):
+            self.alignment.dataset.refresh()  # ranges updated since
+        return self.alignment.read_rows(rows, columns, raw=raw)
+
+    def close(self):
+        self.h5file.close()
@@ -0,0 +1,241 @@
+"""
+Columnar storage of node properties in h5trees.
+
+Instead of attributes of the group of each node (one hdf5 metadata
+operation per property and node), the properties of all nodes but the root
+are stored in the node_props group, as one dataset per property key indexed
+by node id (see topology.py, or the node_id attribute of the groups of the
+group-per-node layout):
+
+  - booleans, integers and floats as bool, int64 and float64 datasets
+  - strings (and any other value, converted with str) as variable-length
+    utf-8 strings, as are properties with values of different types (other
+    than integers and floats)
+
+Nodes without a property get a fill value (False, 0, NaN or ''), and, if
+not all nodes have it, a boolean dataset of the same name in
+node_props/_defined tells which nodes do.
+
+Strings can also be stored with a fixed length (utf-8 encoded), as needed
+to append them while the file is read concurrently (see live.py).
+
+Properties of the root are stored as attributes (of the tree group, or of
+the topology group).
+"""
+import h5py
+import numpy as np
+
+
+# properties set when loading h5trees, not user data
+MANAGED = {'h5node', 'h5state', 'h5lazy', 'node_id', 'row_start', 'row_end',
+           'stub'}
+
+_FILLS = {'b': False, 'i': 0, 'f': np.nan, 'O': '', 'S': b''}
+
+
+def _kind(values):
+    """
+    :returns: numpy dtype kind of the column storing values: 'b', 'i', 'f',
+       or 'O' for strings
+    """
+    kinds = set()
+    for v in values:
+        if isinstance(v, (bool, np.bool_)):
+            kinds.add('b')
+        elif isinstance(v, (int, np.integer)):
+            kinds.add('i')
+        elif isinstance(v, (float, np.floating)):
+            kinds.add('f')
+        else:
+            return 'O'
+    if len(kinds) < 2:
+        return kinds.pop() if kinds else 'b'
+    return 'f' if kinds <= {'i', 'f'} else 'O'
+
+
+def _fits(kind, current):
+    """
+    :returns: whether values of dtype kind can be written to a column of
+       dtype kind current
+    """
+    return (kind == current or current in 'OS' or (kind == 'b' and current in 'if')
+            or (kind == 'i' and current == 'f'))
+
+
+def _column(values, kind=None):
+    """
+    :param values: list of property values (None where undefined)
+    :param None kind: dtype kind of the column (see _kind), or 'S' for
+       fixed length strings
+
+    :returns: numpy array of the values (fill values where undefined), and
+       boolean array of the defined values
+    """
+    defined = np.array([v is not None for v in values], dtype=bool)
+    kind = kind or _kind(v for v in values if v is not None)
+    fill = _FILLS[kind]
+    if kind == 'O':
+        data = np.array([fill if v is None else str(v) for v in values], dtype=object)
+    elif kind == 'S':
+        data = np.array([fill if v is None else str(v).encode() for v in values], dtype='S')
+    else:
+        data = np.array([fill if v is None else v for v in values],
+                        dtype={'b': bool, 'i': 'int64', 'f': 'float64'}[kind])
+    return data, defined
+
+
+def _write_column(group, key, values, kind=None, dtype=None):
+    """
+    (Re)creates the dataset of a property, from the list of its values by
+    node id (None where undefined).
+
+    :param None kind: dtype kind of the column (see _kind), by default
+       guessed from the values
+    :param None dtype: instead, dtype of the column (e.g. 'S64' for strings
+       of up to 64 bytes)
+    """
+    if '/' in key or key == '_defined':
+        raise Exception(f'ERROR: property name {key} not supported.')
+    data, defined = _column(values, np.dtype(dtype).kind if dtype else kind)
+    if dtype and data.dtype.itemsize > np.dtype(dtype).itemsize:
+        raise Exception(f'ERROR: values of property {key} too long for {dtype}.')
+    if key in group:
+        del group[key]
+    if dtype is None:
+        dtype = h5py.string_dtype() if data.dtype.kind == 'O' else data.dtype
+    group.create_dataset(key, data=data, dtype=dtype, maxshape=(None,))
+    masks = group.require_group('_defined')
+    if key in masks:
+        del masks[key]
+    if not defined.all():
+        masks.create_dataset(key, data=defined, maxshape=(None,))
+
+
+def dump_props(nodes, group, exclude=()):
+    """
+    Stores the properties of nodes as columns of an hdf5 group.
+
+    :param nodes: list of nodes, the position in the list being the node id
+       (the root, with id 0, is skipped)
+    :param group: hdf5 group (empty)
+    :param () exclude: property names not to store
+    """
+    exclude = MANAGED | set(exclude)
+    columns = {}
+    for i, node in enumerate(nodes):
+        if i == 0:
+            continue
+        for k, v in node.props.items():
+            if k not in exclude and v is not None:
+                if k not in columns:
+                    columns[k] = [None] * len(nodes)
+                columns[k][i] = v
+    group.attrs['size'] = len(nodes)
+    for k, values in columns.items():
+        _write_column(group, k, values)
+
+
+def read_columns(group, keys=None):
+    """
+    Reads property columns at once.
+
+    :param None keys: names of the properties to read (by default all)
+
+    :returns: dictionary mapping each property name to the list of its
+       values by node id, and the list telling which nodes have it (None if
+       all do)
+    """
+    masks = group.get('_defined', {})
+    columns = {}
+    for key in (k for k in group if k != '_defined') if keys is None else keys:
+        if key not in group:
+            continue
+        dataset = group[key]
+        values = (dataset.asstr()[:] if dataset.dtype.kind in 'OS' else dataset[:]).tolist()
+        defined = masks[key][:].tolist() if key in masks else None
+        columns[key] = (values, defined)
+    return columns
+
+
+def column_values(group, key, size=0):
+    """
+    :returns: list of the values of a property by node id (None where
+       undefined), of at least size values
+    """
+    values, defined = read_columns(group, [key])[key]
+    values = [v if defined is None or defined[i] else None
+              for i, v in enumerate(values)]
+    return values + [None] * (size - len(values))
+
+
+def set_props(node, columns, i):
+    """
+    Adds to node the properties of node id i (see read_columns).
+    """
+    for key, (values, defined) in columns.items():
+        if i < len(values) and (defined is None or i < len(defined) and defined[i]):
+            node.add_prop(key, values[i])
+
+
+def load_props(group, nodes, keys=None):
+    """
+    Adds properties from the columns of an hdf5 group to nodes.
+
+    :param nodes: iterable of nodes with a node_id property
+    :param None keys: names of the properties to load (by default all)
+    """
+    columns = read_columns(group, keys)
+    if not columns:
+        return
+    for node in nodes:
+        if node.up is not None and 'node_id' in node.props:
+            set_props(node, columns, node.props['node_id'])
+
+
+def write_props(group, size, updates):
+    """
+    Rewrites the properties of some nodes in place (columns being extended,
+    created or, if their type changes, rewritten).
+
+    :param size: number of node ids
+    :param updates: dictionary mapping node ids to dictionaries of their
+       properties (empty for nodes removed)
+    """
+    if not updates:
+        return
+    ids = sorted(updates)
+    masks = group.require_group('_defined')
+    keys = {k for props in updates.values() for k in props}
+    keys.update(k for k in group if k != '_defined')
+    for key in keys:
+        values = [updates[i].get(key) for i in ids]
+        if key not in group:
+            column = [None] * size
+            for i, v in zip(ids, values):
+                column[i] = v
+            if any(v is not None for v in column):
+                _write_column(group, key, column)
+            continue
+        dataset = group[key]
+        kind = _kind(v for v in values if v is not None)
+        current = dataset.dtype.kind
+        data, defined = _column(values, current) if _fits(kind, current) else (None, None)
+        if data is None or data.dtype.itemsize > dataset.dtype.itemsize and current == 'S':
+            column = column_values(group, key, size)
+            for i, v in zip(ids, values):
+                column[i] = v
+            _write_column(group, key, column)
+            continue
+        old_size = len(dataset)
+        if size > old_size:
+            dataset.resize(size, axis=0)
+        dataset[ids] = data
+        if key not in masks and (not defined.all() or size > old_size):
+            masks.create_dataset(key, data=np.ones(old_size, dtype=bool),
+                                 maxshape=(None,))
+        if key in masks:
+            if size > len(masks[key]):
+                masks[key].resize(size, axis=0)
+                masks[key][old_size:] = False
+            masks[key][ids] = defined
+    group.attrs['size'] = size
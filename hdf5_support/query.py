@@ -0,0 +1,396 @@
+"""
+Batched queries of the leaf alignment of h5trees.
+
+Rows wanted are resolved in bulk, sorted and coalesced into runs of
+contiguous rows, each run being a hyperslab (instead of a point selection
+per row) of a single read, and finally scattered back in the order asked.
+
+The alignment dataset is opened with an hdf5 chunk cache sized after its
+chunks, holding one chunk by default (the default 1 MiB cache cannot hold a
+single (1000, 100_000) chunk, which is then read, and decompressed, again
+for each access). The cache is capped by CHUNK_CACHE_MAX_BYTES, each reader
+(e.g. each worker process) having its own. CachedAlignment adds an LRU cache
+of blocks of the alignment for repeated reads of overlapping windows.
+
+Packed alignments (see codec.pack_nt) are queried in bases, and unpacked to
+seq2num_nt codes unless raw bytes are asked for.
+
+Protein views of the coding regions of nucleotide alignments are translated
+on the fly (see H5Alignment.get_protein and codec.translate_nt).
+
+Contiguous (unchunked, uncompressed) alignments can be memory mapped with
+MappedAlignment: reads are then numpy indexing of the OS page cache, and
+blocks of contiguous rows are returned as views, without any copy.
+"""
+from collections    import OrderedDict
+
+import h5py
+import numpy as np
+
+from h5py           import h5s, h5p, h5d
+
+from codec          import is_packed, is_protein, unpack_nt, translate_nt
+
+
+def coalesce(rows, max_gap=0):
+    """
+    :param rows: array of row numbers (any order, possibly repeated)
+    :param 0 max_gap: runs separated by up to max_gap unwanted rows are
+       merged (reading a few more rows is cheaper than another hyperslab,
+       in particular if they belong to chunks read anyway)
+
+    :returns: the sorted unique rows, the position of each input row in them,
+       and the (start, end) limits of the runs (end excluded)
+    """
+    uniq, inverse = np.unique(rows, return_inverse=True)
+    breaks = np.flatnonzero(np.diff(uniq) > max_gap + 1) + 1
+    starts = uniq[np.concatenate(([0], breaks))]
+    ends = uniq[np.concatenate((breaks - 1, [len(uniq) - 1]))] + 1
+    return uniq, inverse, list(zip(starts.tolist(), ends.tolist()))
+
+
+# maximum size of the chunk cache of each reader, by default enough for one
+# (1000, 100_000) chunk of int8
+CHUNK_CACHE_MAX_BYTES = 2**27
+
+
+def _next_prime(num):
+    while any(num % d == 0 for d in range(2, int(num ** 0.5) + 1)):
+        num += 1
+    return num
+
+
+def open_dataset(group, name, nchunks=1, w0=1.0, nbytes=None,
+                 max_bytes=CHUNK_CACHE_MAX_BYTES):
+    """
+    Opens a chunked dataset with a chunk cache able to hold nchunks chunks
+    (the dataset should not be already open).
+
+    :param group: hdf5 group containing the dataset
+    :param name: name of the dataset
+    :param 1 nchunks: number of chunks fitting in the cache, if None (and
+       nbytes is None), use the cache settings of the file
+    :param 1.0 w0: hdf5 preemption policy, 1 evicts first chunks fully read
+       (fine for read only access)
+    :param None nbytes: instead of nchunks, a fixed size of the cache
+    :param CHUNK_CACHE_MAX_BYTES max_bytes: maximum size of the cache sized
+       after the chunks (chunks larger than the cache are not cached)
+
+    :returns: h5py Dataset
+    """
+    dataset = group[name]
+    if (nchunks is None and nbytes is None) or dataset.chunks is None:
+        return dataset
+    chunk_bytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+    if nbytes is None:
+        nbytes = min(nchunks * chunk_bytes, max_bytes)
+    # the cache is set when the dataset is first opened, close it before
+    # reopening (settings are ignored if it is still open elsewhere)
+    del dataset
+    dapl = h5p.create(h5p.DATASET_ACCESS)
+    # hdf5 advises about 100 times more hash slots than chunks, prime
+    nslots = _next_prime(max(521, 100 * -(-nbytes // chunk_bytes)))
+    dapl.set_chunk_cache(nslots, nbytes, w0)
+    return h5py.Dataset(h5d.open(group.id, name.encode(), dapl=dapl))
+
+
+class H5Alignment:
+    """
+    Access to the alignment of an h5tree.
+
+    :param h5file: open h5py File of the h5tree
+    :param 'alignment' name: name of the dataset in leaf_data
+    :param 1 chunk_cache: number of chunks held by the hdf5 chunk cache (see
+       open_dataset)
+    :param None chunk_cache_bytes: instead, a fixed size of the chunk cache
+    :param CHUNK_CACHE_MAX_BYTES max_cache_bytes: maximum size of the chunk
+       cache sized after the chunks
+    """
+    def __init__(self, h5file, name='alignment', chunk_cache=1,
+                 chunk_cache_bytes=None, max_cache_bytes=CHUNK_CACHE_MAX_BYTES):
+        self.leaf_data = h5file['leaf_data']
+        self.dataset = open_dataset(self.leaf_data, name, chunk_cache,
+                                    nbytes=chunk_cache_bytes, max_bytes=max_cache_bytes)
+        self.packed = is_packed(self.dataset)
+        self.length = (int(self.dataset.attrs['length']) if self.packed else
+                       self.dataset.shape[1])
+        self._leaf_rows = None
+
+    @property
+    def leaf_rows(self):
+        """
+        Dictionary mapping leaf names to rows, read once for all names.
+        """
+        if self._leaf_rows is None:
+            self._leaf_rows = dict(self.leaf_data.attrs.items())
+        return self._leaf_rows
+
+    def resolve(self, items):
+        """
+        :param items: leaf names or ete4 nodes of an h5tree (internal nodes
+           standing for all their leaves, in row order)
+
+        :returns: numpy array of rows
+        """
+        rows = []
+        for item in items:
+            if isinstance(item, str):
+                rows.append([self.leaf_rows[item]])
+            elif 'row_start' in item.props:
+                rows.append(range(item.props['row_start'], item.props['row_end']))
+            elif item.children:
+                rows.append([n.props['alignment'] for n in item.traverse()
+                             if not n.children])
+            else:
+                rows.append([item.props['alignment']])
+        return np.fromiter((r for run in rows for r in run), dtype='int64')
+
+    def read_rows(self, rows, columns=slice(None), max_gap=None, raw=False):
+        """
+        All runs of rows are combined into a single hdf5 selection, read at
+        once.
+
+        :param rows: array of rows (any order, possibly repeated)
+        :param slice(None) columns: slice of contiguous columns (bases)
+        :param None max_gap: see coalesce, defaults to the number of rows of
+           the dataset chunks
+        :param False raw: for packed alignments, return the packed bytes
+           holding the columns (starting at an even column), instead of
+           seq2num_nt codes
+
+        :returns: 2D numpy array of int8 with one row per input row
+        """
+        beg, end, step = columns.indices(self.length)
+        if step != 1:
+            raise Exception('ERROR: only contiguous columns can be queried.')
+        end = max(beg, end)
+        if not self.packed:
+            return self._read(rows, beg, end, max_gap)
+        packed = self._read(rows, beg // 2, (end + 1) // 2, max_gap)
+        if raw:
+            return packed
+        return unpack_nt(packed)[:, beg % 2:beg % 2 + end - beg]
+
+    def _read(self, rows, beg, end, max_gap):
+        """
+        :returns: rows of the dataset, from column beg to end (excluded)
+        """
+        ncols = end - beg
+        if not len(rows) or not ncols:
+            return np.empty((len(rows), ncols), dtype=self.dataset.dtype)
+        if max_gap is None:
+            max_gap = self.dataset.chunks[0] if self.dataset.chunks else 0
+        uniq, inverse, runs = coalesce(rows, max_gap)
+        starts = np.array([s for s, _ in runs], dtype='int64')
+        lengths = np.array([e - s for s, e in runs], dtype='int64')
+        fspace = self.dataset.id.get_space()
+        fspace.select_none()
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            fspace.select_hyperslab((start, beg), (length, ncols), op=h5s.SELECT_OR)
+        out = np.empty((lengths.sum(), ncols), dtype=self.dataset.dtype)
+        self.dataset.id.read(h5s.create_simple(out.shape), fspace, out)
+        if len(out) > len(uniq):  # rows read in gaps are dropped
+            run = np.searchsorted(starts, uniq, side='right') - 1
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            out = out[offsets[run] + uniq - starts[run]]
+        return out[inverse]
+
+    def get_alignment(self, items, columns=slice(None), max_gap=None, raw=False):
+        """
+        :param items: leaf names or ete4 nodes of an h5tree (see resolve)
+        :param slice(None) columns: slice of columns
+        :param False raw: see read_rows
+
+        :returns: 2D numpy array of int8, rows in the order of items
+        """
+        return self.read_rows(self.resolve(items), columns, max_gap, raw)
+
+    def get_protein(self, items, start, end, reverse=False, max_gap=None):
+        """
+        Translates the codons of a coding region of a nucleotide alignment.
+
+        :param items: leaf names or ete4 nodes of an h5tree (see resolve)
+        :param start: first column of the region (e.g. of a gene)
+        :param end: column after the last one, the region being a whole
+           number of codons
+        :param False reverse: the region is on the reverse strand (translated
+           from end to start, complemented)
+
+        :returns: 2D numpy array of amino-acid codes (see codec.seq2num_aa),
+           rows in the order of items
+        """
+        if is_protein(self.dataset):
+            raise Exception('ERROR: the alignment already stores amino acids.')
+        return translate_nt(self.get_alignment(items, slice(start, end), max_gap),
+                            reverse=reverse)
+
+
+class CachedAlignment(H5Alignment):
+    """
+    Access to the alignment of an h5tree through an LRU cache of blocks (by
+    default of the shape of the dataset chunks), for repeated reads of
+    overlapping windows (e.g. interactive viewing).
+
+    :param h5file: open h5py File of the h5tree
+    :param 'alignment' name: name of the dataset in leaf_data
+    :param 2**28 cache_bytes: maximum size in bytes of the blocks cached
+    :param None block_shape: (rows, columns) of the blocks, defaults to the
+       chunk shape
+    :param 1 chunk_cache: number of chunks held by the hdf5 chunk cache, as
+       blocks are read once, it only needs to hold the chunks of a block
+
+    :attr stats: dictionary with cache hits, misses and evictions counts
+    """
+    def __init__(self, h5file, name='alignment', cache_bytes=2**28,
+                 block_shape=None, chunk_cache=1):
+        super().__init__(h5file, name, chunk_cache)
+        self.block_shape = block_shape or self.dataset.chunks or self.dataset.shape
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.blocks = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def block(self, i, j):
+        """
+        :returns: block of the alignment in block row i, block column j
+        """
+        if (i, j) in self.blocks:
+            self.stats['hits'] += 1
+            self.blocks.move_to_end((i, j))
+            return self.blocks[i, j]
+        self.stats['misses'] += 1
+        rows, cols = self.block_shape
+        block = self.dataset[i * rows:(i + 1) * rows, j * cols:(j + 1) * cols]
+        while self.blocks and self.cached_bytes + block.nbytes > self.cache_bytes:
+            self.cached_bytes -= self.blocks.popitem(last=False)[1].nbytes
+            self.stats['evictions'] += 1
+        if block.nbytes <= self.cache_bytes:
+            self.blocks[i, j] = block
+            self.cached_bytes += block.nbytes
+        return block
+
+    def clear(self):
+        self.blocks.clear()
+        self.cached_bytes = 0
+
+    def _read(self, rows, beg, end, max_gap):
+        """
+        Same as H5Alignment._read, through the block cache (max_gap is
+        ignored).
+        """
+        ncols = end - beg
+        if not len(rows) or not ncols:
+            return np.empty((len(rows), ncols), dtype=self.dataset.dtype)
+        uniq, inverse = np.unique(rows, return_inverse=True)
+        out = np.empty((len(uniq), ncols), dtype=self.dataset.dtype)
+        brows, bcols = self.block_shape
+        # limits in uniq of the rows of each block row
+        nums = uniq // brows
+        limits = np.flatnonzero(np.diff(nums)) + 1
+        for lo, hi in zip(np.concatenate(([0], limits)),
+                          np.concatenate((limits, [len(uniq)]))):
+            i = nums[lo]
+            local = uniq[lo:hi] - i * brows
+            for j in range(beg // bcols, (end - 1) // bcols + 1):
+                cbeg, cend = max(beg, j * bcols), min(end, (j + 1) * bcols)
+                out[lo:hi, cbeg - beg:cend - beg] = self.block(i, j)[
+                    local, cbeg - j * bcols:cend - j * bcols]
+        return out[inverse]
+
+    def window(self, rows=slice(None), columns=slice(None)):
+        """
+        :param slice(None) rows: slice of contiguous rows
+        :param slice(None) columns: slice of contiguous columns
+
+        :returns: 2D numpy array of int8
+        """
+        return self.read_rows(np.arange(*rows.indices(self.dataset.shape[0])),
+                              columns)
+
+
+def dataset_location(dataset):
+    """
+    :param dataset: contiguous, uncompressed, hdf5 dataset
+
+    :returns: (path of the file, offset, shape, dtype) to memory map it
+    """
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None:
+        raise Exception(f'ERROR: dataset {dataset.name} is not contiguous '
+                        '(or not allocated) and cannot be memory mapped.')
+    return dataset.file.filename, offset, dataset.shape, dataset.dtype.str
+
+
+def memmap_location(location):
+    """
+    :param location: as returned by dataset_location
+
+    :returns: read-only np.memmap of the dataset
+    """
+    fname, offset, shape, dtype = location
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def memmap_dataset(dataset):
+    """
+    :returns: read-only np.memmap of a contiguous dataset
+    """
+    return memmap_location(dataset_location(dataset))
+
+
+class MappedAlignment(H5Alignment):
+    """
+    Access to a contiguous alignment through a memory map of the file.
+
+    Objects can be passed to worker processes (e.g. as arguments of a
+    multiprocessing pool): only the location of the data is sent, and each
+    process maps the same file pages, shared through the OS page cache.
+
+    :param h5file: open h5py File of the h5tree (the file should not be
+       written while mapped)
+    :param 'alignment' name: name of the dataset in leaf_data
+
+    :attr data: np.memmap of the alignment dataset
+    """
+    def __init__(self, h5file, name='alignment'):
+        self.leaf_data = h5file['leaf_data']
+        self.dataset = self.leaf_data[name]
+        self.packed = is_packed(self.dataset)
+        self.length = (int(self.dataset.attrs['length']) if self.packed else
+                       self.dataset.shape[1])
+        self.location = dataset_location(self.dataset)
+        self.data = memmap_location(self.location)
+        self._leaf_rows = None
+
+    def __getstate__(self):
+        return {'location': self.location, 'packed': self.packed,
+                'length': self.length, '_leaf_rows': self.leaf_rows}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.leaf_data = self.dataset = None
+        self.data = memmap_location(self.location)
+
+    def _read(self, rows, beg, end, max_gap):
+        """
+        :returns: a view of the memory map if rows are contiguous and
+           increasing, a copy of the rows otherwise
+        """
+        rows = np.asarray(rows)
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1 and (
+                len(rows) == 1 or (np.diff(rows) == 1).all()):
+            return self.data[rows[0]:rows[-1] + 1, beg:end]
+        return self.data[rows, beg:end]
+
+
+def get_alignment(h5tree, items, columns=slice(None), max_gap=None):
+    """
+    Shortcut to H5Alignment(file).get_alignment(items, columns)
+
+    :param h5tree: ete4 Tree loaded with load_h5tree
+    """
+    if 'h5lazy' in h5tree.props:
+        h5file = h5tree.props['h5lazy'].h5file
+    else:
+        h5file = h5tree.props['h5node'].file
+    return H5Alignment(h5file).get_alignment(items, columns, max_gap)
@@ -0,0 +1,195 @@
+"""
+Synthetic nucleotide alignments, generated with numpy by blocks of columns
+(all leaves at once), so that memory use does not depend on the sequence
+length, and streamed to FASTA or directly into an hdf5 alignment dataset.
+
+Sequences are either independent (uniformly random bases), mutated copies
+of a random reference (star phylogeny), or evolved along the branches of
+the tree (each node being a mutated copy of its parent, with a number of
+substitutions proportional to its branch length), giving the redundancy of
+real alignments.
+"""
+import os
+
+import numpy as np
+
+from codec          import NT_ENCODER, is_packed, pack_nt
+
+
+BASES = np.frombuffer(b'ACGT', dtype='uint8')
+AMBIGUOUS = np.frombuffer(b'RYSWKMN', dtype='uint8')
+GAP = ord('-')
+
+
+def _mutate(seq, rate, rng):
+    """
+    Substitutes (in place) a Poisson number of random sites of seq, a
+    sequence of base indexes (0-3), by another base.
+    """
+    num = rng.poisson(rate * len(seq))
+    if num:
+        sites = rng.integers(0, len(seq), num)
+        seq[sites] = (seq[sites] + rng.integers(1, 4, num, dtype='uint8')) % 4
+
+
+def _sprinkle(row, rate, symbols, rng):
+    num = rng.poisson(rate * len(row))
+    if num:
+        row[rng.integers(0, len(row), num)] = symbols[rng.integers(0, len(symbols), num)]
+
+
+def _light_first(tree):
+    """
+    Preorder traversal visiting the children with less leaves first, so that
+    the sequence of a node is released once its heaviest child is reached
+    (O(log(number of leaves)) sequences in memory whatever the tree shape).
+
+    :yields: (node, parent)
+    """
+    size = {}
+    for node in tree.traverse('postorder'):
+        size[id(node)] = sum(size[id(c)] for c in node.children) or 1
+    todo = [(tree, None)]
+    while todo:
+        node, parent = todo.pop()
+        yield node, parent
+        todo.extend((c, node) for c in sorted(node.children,
+                                              key=lambda c: -size[id(c)]))
+
+
+def alignment_blocks(tree, seq_len, seed=None, mutation_rate=None,
+                     tree_correlated=False, ambiguity_rate=0.0, gap_rate=0.0,
+                     block_cols=None, buffer_size=2**28):
+    """
+    Generates a random alignment by blocks of columns.
+
+    :param tree: ete4 Tree object
+    :param seq_len: length of the sequences
+    :param None seed: seed of the random generator (same seed, same
+       alignment, for a given block_cols)
+    :param None mutation_rate: expected number of substitutions per site,
+       from a random reference to each leaf, or along each unit of branch
+       length if tree_correlated. If None, sequences are independent
+    :param False tree_correlated: evolve sequences along the tree branches
+       (branches without length count as 1)
+    :param 0.0 ambiguity_rate: proportion of ambiguous bases (RYSWKMN) in
+       the leaf sequences
+    :param 0.0 gap_rate: proportion of gaps in the leaf sequences
+    :param None block_cols: number of columns of each block, defaults to
+       what fits into buffer_size
+    :param 2**28 buffer_size: maximum size in bytes of a block
+
+    :yields: first column of the block, and the block as a 2D numpy array of
+       uint8 (ASCII symbols) with a row per leaf, leaves in preorder
+    """
+    if tree_correlated and mutation_rate is None:
+        raise Exception('ERROR: tree correlated sequences need a mutation rate.')
+    rng = np.random.default_rng(seed)
+    leaf_rows = {}
+    for node in tree.traverse('preorder'):
+        if not node.children:
+            leaf_rows[id(node)] = len(leaf_rows)
+    nrows = len(leaf_rows)
+    block_cols = block_cols or max(2, buffer_size // max(1, nrows) // 2 * 2)
+    for beg in range(0, seq_len, block_cols):
+        width = min(block_cols, seq_len - beg)
+        block = np.empty((nrows, width), dtype='uint8')
+        if mutation_rate is None:
+            block[:] = BASES[rng.integers(0, 4, (nrows, width), dtype='uint8')]
+        elif not tree_correlated:
+            reference = rng.integers(0, 4, width, dtype='uint8')
+            for row in range(nrows):
+                seq = reference.copy()
+                _mutate(seq, mutation_rate, rng)
+                block[row] = BASES[seq]
+        else:
+            seqs = {}  # id(node) -> sequence, for nodes with children to visit
+            pending = {}  # id(node) -> number of children to visit
+            for node, parent in _light_first(tree):
+                if parent is None:
+                    seq = rng.integers(0, 4, width, dtype='uint8')
+                else:
+                    seq = seqs[id(parent)].copy()
+                    if pending[id(parent)] == 1:
+                        del seqs[id(parent)]
+                    pending[id(parent)] -= 1
+                    _mutate(seq, mutation_rate * (1.0 if node.dist is None
+                                                  else node.dist), rng)
+                if node.children:
+                    seqs[id(node)] = seq
+                    pending[id(node)] = len(node.children)
+                else:
+                    block[leaf_rows[id(node)]] = BASES[seq]
+        if ambiguity_rate or gap_rate:
+            for row in block:
+                _sprinkle(row, ambiguity_rate, AMBIGUOUS, rng)
+                _sprinkle(row, gap_rate, np.array([GAP], dtype='uint8'), rng)
+        yield beg, block
+
+
+def write_fasta(tree, seq_len, fname, overwrite=False, **kwargs):
+    """
+    Writes a random alignment to a FASTA file (one line per sequence,
+    leaves in preorder), blocks of columns being written in place at the
+    offset of each sequence.
+
+    :param tree: ete4 Tree object
+    :param seq_len: length of the sequences
+    :param fname: path to the FASTA file
+    :param False overwrite: overwrite fname if it exists
+    :param kwargs: passed to alignment_blocks
+    """
+    if os.path.exists(fname) and not overwrite:
+        return
+    headers = [b'>' + n.name.encode() + b'\n' for n in tree.traverse('preorder')
+               if not n.children]
+    offsets = np.cumsum([0] + [len(h) + seq_len + 1 for h in headers])
+    with open(fname, 'wb') as out:
+        out.truncate(int(offsets[-1]))
+        for header, offset in zip(headers, offsets.tolist()):
+            out.seek(offset)
+            out.write(header)
+            out.seek(offset + len(header) + seq_len)
+            out.write(b'\n')
+        for beg, block in alignment_blocks(tree, seq_len, **kwargs):
+            for header, offset, row in zip(headers, offsets.tolist(), block):
+                out.seek(offset + len(header) + beg)
+                out.write(row.tobytes())
+
+
+def write_alignment(tree, alignment, rows=None, **kwargs):
+    """
+    Writes a random alignment directly into an alignment dataset (int8 or
+    packed), by blocks of columns aligned on its chunks when they fit into
+    the buffer.
+
+    :param tree: ete4 Tree object
+    :param alignment: hdf5 alignment dataset, of one row per leaf, its
+       length giving the sequence length
+    :param None rows: dictionary mapping leaf names to rows, defaults to the
+       leaves in preorder
+    :param kwargs: passed to alignment_blocks
+    """
+    packed = is_packed(alignment)
+    seq_len = int(alignment.attrs['length']) if packed else alignment.shape[1]
+    if packed and (kwargs.get('block_cols') or 0) % 2:
+        raise Exception('ERROR: blocks of packed alignments need an even '
+                        'number of columns.')
+    if kwargs.get('block_cols') is None and alignment.chunks:
+        chunk_cols = alignment.chunks[1] * (2 if packed else 1)
+        buffer_cols = kwargs.get('buffer_size', 2**28) // max(1, len(alignment))
+        kwargs['block_cols'] = max(1, buffer_cols // chunk_cols) * chunk_cols
+    order = None
+    if rows is not None:
+        order = np.array([rows[n.name] for n in tree.traverse('preorder')
+                          if not n.children], dtype='int64')
+        if (order == np.arange(len(order))).all():
+            order = None
+    lut = NT_ENCODER[0]
+    for beg, block in alignment_blocks(tree, seq_len, **kwargs):
+        codes = lut[block].view('int8')
+        if packed:
+            codes, beg = pack_nt(codes), beg // 2
+        if order is not None:  # hdf5 wants sorted rows
+            codes[order] = codes.copy()
+        alignment[:, beg:beg + codes.shape[1]] = codes
@@ -0,0 +1,77 @@
+"""
+Pins what lazy h5trees (see lazy.py) materialize: stubs are seen as leaves
+by plain ete4 methods until they are expanded by LazyH5Tree.traverse or
+LazyH5Tree.expand.
+
+usage (from the hdf5_support directory): python -m pytest test_lazy.py
+"""
+import pytest
+
+from ete4           import Tree
+
+from h5node_prototype import dump_h5tree
+from lazy           import LazyH5Tree
+
+
+@pytest.fixture(params=['groups', 'arrays'])
+def h5tree(request, tmp_path):
+    tree = Tree('(((A,B),(C,D)),((E,F),(G,(H,I))));')
+    fname = str(tmp_path / f'lazy_{request.param}.h5')
+    dump_h5tree(tree, fname, layout=request.param, simulate=dict(seq_len=10, seed=0))
+    for node in tree.traverse():  # groups layout: releases the file
+        node.props.pop('h5node', None)
+    return tree, fname
+
+
+def _leaf_names(tree):
+    return sorted(leaf.name or '' for leaf in tree.leaves())
+
+
+def _clades(tree):
+    # children of the groups layout are loaded by name, not in their order
+    return {frozenset(leaf.name for leaf in node.leaves()) for node in tree.traverse()}
+
+
+def test_stubs_are_leaves_for_ete(h5tree):
+    tree, fname = h5tree
+    lazy = LazyH5Tree(fname)
+    # only the root and its children are materialized
+    assert len(lazy.tree.children) == 2
+    assert all(c.props.get('stub') for c in lazy.tree.children)
+    # plain ete4 iteration sees the stubs as leaves, with no error
+    assert all(leaf.props.get('stub') for leaf in lazy.tree.leaves())
+    assert _leaf_names(lazy.tree) != _leaf_names(tree)
+    assert len(list(lazy.tree.descendants())) == 2
+    lazy.close()
+
+
+def test_traverse_materializes(h5tree):
+    tree, fname = h5tree
+    lazy = LazyH5Tree(fname)
+    assert sorted(n.name for n in lazy.traverse() if not n.children) == _leaf_names(tree)
+    # the whole tree is now seen by ete4 methods
+    assert not any(n.props.get('stub') for n in lazy.tree.traverse())
+    assert _leaf_names(lazy.tree) == _leaf_names(tree)
+    assert _clades(lazy.tree) == _clades(tree)
+    lazy.close()
+
+
+def test_expand_materializes_levels(h5tree):
+    tree, fname = h5tree
+    lazy = LazyH5Tree(fname)
+    lazy.expand(lazy.tree, depth=2)
+    assert len(list(lazy.tree.descendants())) == 6
+    lazy.expand(lazy.tree, depth=5)
+    assert _leaf_names(lazy.tree) == _leaf_names(tree)
+    lazy.close()
+
+
+def test_eviction_brings_stubs_back(h5tree):
+    tree, fname = h5tree
+    lazy = LazyH5Tree(fname, max_nodes=8)
+    for _ in lazy.traverse():
+        pass
+    # collapsed subtrees are stubs (leaves for ete4) again
+    assert any(n.props.get('stub') for n in lazy.tree.leaves())
+    assert _leaf_names(lazy.tree) != _leaf_names(tree)
+    lazy.close()
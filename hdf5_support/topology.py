@@ -0,0 +1,159 @@
+"""
+Compact, array-backed, storage of tree topologies in hdf5.
+
+Instead of one hdf5 group per node, the whole topology is stored as a few
+flat datasets indexed by node id (nodes numbered in preorder, root is 0):
+
+  - parent: id of the parent node (-1 for the root)
+  - first_child: id of the first child (-1 for leaves)
+  - next_sibling: id of the next sibling (-1 for last children)
+  - dist, support: branch lengths and supports (NaN if undefined)
+  - names, name_offsets: all node names concatenated (utf-8), name of node i
+    being names[name_offsets[i]:name_offsets[i + 1]]
+  - leaf_row: row of the leaf in leaf_data datasets (-1 for internal nodes)
+  - node_row: row of the internal node in node_data datasets (-1 for leaves
+    or if there are no node_data)
+  - row_start, row_end: range of leaf_data rows spanned by the node (-1 if
+    its leaves do not span contiguous rows)
+
+Datasets can be extended and records rewritten in place when changes of a
+loaded tree are flushed (see flush.py), node ids are then not in preorder
+any more, and records of removed nodes have a parent of -2.
+"""
+import numpy as np
+
+from ete4           import Tree
+
+from node_props     import MANAGED
+
+
+def _none_to_nan(value):
+    return np.nan if value is None else value
+
+
+def dump_topology(tree, group, leaf_rows=None, node_rows=None, ranges=None):
+    """
+    Stores the topology of tree into datasets of an hdf5 group.
+
+    :param tree: ete4 Tree object
+    :param group: hdf5 group (empty)
+    :param None leaf_rows: dictionary mapping leaf names to their row in
+       leaf_data datasets
+    :param None node_rows: dictionary mapping id(node) to the row of internal
+       nodes in node_data datasets
+    :param None ranges: dictionary mapping id(node) to the range of
+       leaf_data rows it spans
+
+    :returns: list of nodes, the position in the list being the node id
+    """
+    nodes = list(tree.traverse('preorder'))
+    ids = {id(node): i for i, node in enumerate(nodes)}
+    size = len(nodes)
+    parent = np.full(size, -1, dtype='int64')
+    first_child = np.full(size, -1, dtype='int64')
+    next_sibling = np.full(size, -1, dtype='int64')
+    leaf_row = np.full(size, -1, dtype='int64')
+    node_row = np.full(size, -1, dtype='int64')
+    names = []
+    for i, node in enumerate(nodes):
+        children = node.children
+        if children:
+            first_child[i] = i + 1  # preorder
+            for child, sister in zip(children, children[1:]):
+                next_sibling[ids[id(child)]] = ids[id(sister)]
+            for child in children:
+                parent[ids[id(child)]] = i
+            if node_rows:
+                node_row[i] = node_rows[id(node)]
+        elif leaf_rows:
+            leaf_row[i] = leaf_rows[node.name]
+        names.append((node.name or '').encode())
+    name_offsets = np.zeros(size + 1, dtype='int64')
+    np.cumsum([len(n) for n in names], out=name_offsets[1:])
+
+    def _create(name, data, dtype=None):
+        # extensible, for incremental flushes
+        group.create_dataset(name, data=np.asarray(data, dtype=dtype),
+                             maxshape=(None,))
+
+    _create('parent', parent)
+    _create('first_child', first_child)
+    _create('next_sibling', next_sibling)
+    _create('dist', [_none_to_nan(n.dist) for n in nodes], 'float64')
+    _create('support', [_none_to_nan(n.support) for n in nodes], 'float64')
+    _create('names', np.frombuffer(b''.join(names), dtype='uint8'))
+    _create('name_offsets', name_offsets)
+    _create('leaf_row', leaf_row)
+    _create('node_row', node_row)
+    if ranges:
+        _create('row_start', [ranges[id(n)][0] for n in nodes], 'int64')
+        _create('row_end', [ranges[id(n)][1] for n in nodes], 'int64')
+    # store root properties as attributes
+    for k, v in tree.props.items():
+        if k not in MANAGED:
+            group.attrs[k] = v
+    return nodes
+
+
+def load_topology(group, size=None):
+    """
+    Builds an ete4 Tree from the topology datasets of an hdf5 group,
+    iterating over nodes in preorder, following first children and next
+    siblings.
+
+    Each node gets a node_id property with its id in the datasets, and
+    row_start, row_end properties with the range of rows it spans (if
+    contiguous), leaves get an alignment property with their row in
+    leaf_data, and internal nodes a property named after each node_data
+    dataset with their row in it (as in the group-per-node layout).
+
+    :param group: hdf5 group written by dump_topology
+    :param None size: number of node records to load (e.g. those seen by a
+       reader of a file being appended to, see live.py), links to later
+       records being ignored
+
+    :returns: Tree object
+    """
+    first_child = group['first_child'][:size].tolist()
+    next_sibling = group['next_sibling'][:size].tolist()
+    dist = group['dist'][:size].tolist()
+    support = group['support'][:size].tolist()
+    leaf_row = group['leaf_row'][:size].tolist()
+    offsets = group['name_offsets'][:None if size is None else size + 1].tolist()
+    names = group['names'][:offsets[-1]].tobytes()
+    node_row = group['node_row'][:size].tolist() if 'node_row' in group else []
+    node_data = list(group.file.get('node_data', ()))
+    ranges = 'row_start' in group
+    if ranges:
+        row_start = group['row_start'][:size].tolist()
+        row_end = group['row_end'][:size].tolist()
+    size = len(first_child)
+
+    tree = Tree()
+    for k, v in group.attrs.items():
+        tree.add_prop(k, v)
+    todo = [(0, tree)]
+    while todo:
+        i, node = todo.pop()
+        child = first_child[i]
+        children = []
+        while -1 < child < size:
+            children.append((child, node.add_child()))
+            child = next_sibling[child]
+        todo.extend(reversed(children))
+        if offsets[i + 1] > offsets[i]:
+            node.name = names[offsets[i]:offsets[i + 1]].decode()
+        if dist[i] == dist[i]:  # not NaN
+            node.dist = dist[i]
+        if support[i] == support[i]:
+            node.support = support[i]
+        node.add_prop('node_id', i)
+        if ranges and row_start[i] >= 0:
+            node.add_prop('row_start', row_start[i])
+            node.add_prop('row_end', row_end[i])
+        if leaf_row[i] >= 0:
+            node.add_prop('alignment', leaf_row[i])
+        elif node_data and node_row[i] >= 0:
+            for nd in node_data:
+                node.add_prop(nd, node_row[i])
+    return tree
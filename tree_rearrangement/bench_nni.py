@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+"""
+Throughput and peak memory of the enumeration of NNI neighbours:
+
+  - iter_NNIs: the tree itself, rearranged in place
+  - iter_NNIs copies: a copy of the tree per neighbour
+  - moves: NNIMove descriptors, applied and undone
+  - moves newick: NNIMove descriptors, materialized as newick strings
+
+Modes copying or writing the whole tree for each neighbour are stopped
+after a given number of neighbours, their time for all neighbours being
+extrapolated. Peak memory is measured with tracemalloc (allocations made
+during the enumeration).
+
+usage: python bench_nni.py max_materialized tree_len [tree_len ...]
+"""
+import sys
+import tracemalloc
+
+from time           import time
+from itertools      import islice
+from random         import seed
+
+from ete4           import Tree
+
+from nearest_neighbor_interchange import iter_NNIs, iter_NNI_moves
+
+
+def _moves(tree):
+    for move in iter_NNI_moves(tree):
+        move.apply()
+        yield move
+        move.undo()
+
+
+MODES = {
+    'iter_NNIs': (lambda t: iter_NNIs(t), False),
+    'iter_NNIs copies': (lambda t: iter_NNIs(t, copies=True), True),
+    'moves': (_moves, False),
+    'moves newick': (lambda t: (m.newick(t) for m in iter_NNI_moves(t)), True),
+}
+
+
+def run(tree, mode, limit):
+    """
+    :returns: number of neighbours enumerated, time, and peak memory
+    """
+    func, materialized = MODES[mode]
+    tracemalloc.start()
+    t0 = time()
+    count = 0
+    for _ in islice(func(tree), limit if materialized else None):
+        count += 1
+    elapsed = time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+limit = int(sys.argv[1])
+tree_lens = [int(v) for v in sys.argv[2:]]
+
+log = open('test_nni.log', 'w')
+log.write('tree size\tmode\tneighbours\ttime\tneighbours per second\t'
+          'time for all neighbours\tpeak memory\n')
+for tree_len in tree_lens:
+    seed(2)
+    t = Tree()
+    t.populate(tree_len, names=[str(i) for i in range(1, tree_len + 1)])
+    total = 2 * (tree_len - 3)
+    for mode in MODES:
+        count, elapsed, peak = run(t, mode, limit)
+        speed = count / elapsed if elapsed else float('inf')
+        log.write(f'{tree_len}\t{mode}\t{count}\t{elapsed}\t{speed}\t{total / speed}\t{peak}\n')
+        print(f'{tree_len:7} leaves, {mode:>16}: {speed:12.1f} neighbours/s, '
+              f'all in {total / speed:10.3f} s, peak memory {peak / 2**20:9.3f} MiB')
+log.close()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+"""
+Scoring of the NNI neighbours of a tree by Fitch parsimony (see
+parsimony.py), incrementally from the cached sets around each edge, compared
+with scoring each neighbour from scratch (a down-pass over the whole tree,
+stopped after a given number of neighbours, its time for all neighbours
+being extrapolated), and hill climbing from a random tree (stopped after a
+given number of moves).
+
+Sequences are simulated along a random tree (each site of each branch
+changed with a given probability), hill climbing starting from another
+random tree with the same leaves.
+
+The score logged is the best number of changes among the neighbours
+scored by both methods (which must agree), and the number of changes
+reached by hill climbing.
+
+usage: python bench_parsimony.py seq_len max_scratch max_moves tree_len [tree_len ...]
+"""
+import sys
+
+from time           import time
+from random         import seed, shuffle
+
+import numpy as np
+
+from ete4           import Tree
+
+from parsimony      import FitchParsimony, iter_hill_climb, _join, _BASE_CODES
+from nearest_neighbor_interchange import iter_NNI_moves
+
+MUTATION_RATE = 0.05
+
+
+def simulate(tree, seq_len, rng):
+    """
+    :returns: mapping leaf name -> numpy array of seq2num_nt codes
+    """
+    codes = np.array(_BASE_CODES, dtype='uint8')
+    states = {tree: rng.integers(4, size=seq_len)}
+    sequences = {}
+    for n in tree.traverse('preorder'):
+        for c in n.children:
+            mutated = rng.random(seq_len) < MUTATION_RATE
+            states[c] = np.where(mutated, rng.integers(4, size=seq_len), states[n])
+        if not n.children:
+            sequences[n.name] = codes[states.pop(n)].view('int8')
+    return sequences
+
+
+def scratch_score(tree, parsimony):
+    """
+    Down-pass over the whole tree, from the sets of the leaves.
+    """
+    sets = {}
+    changes = 0
+    for n in tree.traverse('postorder'):
+        if n.children:
+            sets[n], c = _join(*(sets.pop(c) for c in n.children))
+            changes += c
+        else:
+            sets[n] = parsimony.down[parsimony._rows[n]]
+    return changes
+
+
+seq_len, max_scratch, max_moves = map(int, sys.argv[1:4])
+tree_lens = [int(v) for v in sys.argv[4:]]
+
+log = open('test_parsimony.log', 'w')
+log.write('tree size\tseq length\tmethod\tneighbours\tmoves\ttime\tneighbours per second\t'
+          'time for all neighbours\tscore\n')
+for tree_len in tree_lens:
+    seed(tree_len)
+    rng = np.random.default_rng(tree_len)
+    names = list(map(str, range(1, tree_len + 1)))
+    t = Tree()
+    t.populate(tree_len, names=names)
+    sequences = simulate(t, seq_len, rng)
+    shuffle(names)
+    t = Tree()
+    t.populate(tree_len, names=names)
+    total = 2 * (tree_len - 3)
+
+    t0 = time()
+    parsimony = FitchParsimony(t, sequences)
+    elapsed = time() - t0
+    print(f'{tree_len:7} leaves: caches of {(parsimony.down.nbytes + parsimony.up.nbytes) / 2**20:.1f} '
+          f'MiB computed in {elapsed:.3f} s')
+
+    t0 = time()
+    expected = [score for _, score in parsimony.iter_scores()]
+    elapsed = time() - t0
+    count = len(expected)
+    speed = count / elapsed
+    log.write(f'{tree_len}\t{seq_len}\tincremental\t{count}\t\t{elapsed}\t{speed}\t'
+              f'{total / speed}\t{min(expected[:max_scratch])}\n')
+    print(f'{tree_len:7} leaves, {"incremental":>11}: {speed:10.1f} neighbours/s, '
+          f'all in {total / speed:10.3f} s')
+
+    t0 = time()
+    scores = []
+    for move in iter_NNI_moves(t):
+        if len(scores) == max_scratch:
+            break
+        move.apply()
+        scores.append(scratch_score(t, parsimony))
+        move.undo()
+    elapsed = time() - t0
+    count = len(scores)
+    speed = count / elapsed
+    if scores != expected[:count]:
+        raise Exception('ERROR: incremental scores differ from scores from scratch.')
+    log.write(f'{tree_len}\t{seq_len}\tfrom scratch\t{count}\t\t{elapsed}\t{speed}\t'
+              f'{total / speed}\t{min(scores)}\n')
+    print(f'{tree_len:7} leaves, {"from scratch":>11}: {speed:10.1f} neighbours/s, '
+          f'all in {total / speed:10.3f} s')
+
+    t0 = time()
+    start = score = parsimony.score
+    moves = 0
+    for move, score in iter_hill_climb(t, sequences, max_moves=max_moves):
+        moves += 1
+    elapsed = time() - t0
+    log.write(f'{tree_len}\t{seq_len}\thill climbing\t\t{moves}\t{elapsed}\t\t\t{score}\n')
+    print(f'{tree_len:7} leaves, hill climbing: {start} -> {score} changes '
+          f'in {moves} moves, {elapsed:.3f} s')
+log.close()
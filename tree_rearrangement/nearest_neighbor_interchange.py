@@ -12,8 +12,8 @@ def iter_NNIs(tree, copies=False):
        yields alwaysthe same object in different configurations (if stacked in a 
        list, this will finally result in a list of all identical trees)
     """
-    for n in tree.iter_descendants():
-        if n.is_leaf():
+    for n in tree.descendants():
+        if n.is_leaf:
             continue
         # yielder function out of the loop for preformance
         if copies:
@@ -23,9 +23,11 @@ def iter_NNIs(tree, copies=False):
         # we only need to play with 3 nodes to get all combinations, the fourth can be forgotten
         # find the 3 nodes
         a, b = n.get_children()
-        if n.up.is_root():
+        if n.up.is_root:
             if n is tree.get_children()[1]:  # root does not exist here:it's just one edge
                 continue
+            if n.get_sisters()[0].is_leaf:  # ... ending at a leaf
+                continue
             c = n.get_sisters()[0].get_children()[0]
         else:
             c = n.get_sisters()[0]
@@ -55,19 +57,132 @@ def iter_NNIs(tree, copies=False):
         cu.add_child(c)
         bu.add_child(b)
 
-seed(2)
-t = Tree()
-t.populate(5, names_library=map(str, range(1, 11)))
-print(t)
 
-for tt in iter_NNIs(t):
-    print(tt)
+class NNIMove:
+    """
+    Nearest Neighbor Interchange around the edge between a node and its
+    parent: one of the children of the node is swapped with its sister (or,
+    below the root, with the first child of its sister), in place, keeping
+    the order of the children. Moves are descriptors of the edge, the tree
+    being changed only by apply (and restored by undo), which relink the
+    two nodes swapped.
+
+    WARNING: only works with binary trees.
+
+    :param edge: internal node (not the root), the edge being the one to its
+       parent
+    :param variant: child of edge swapped (0 or 1)
+    """
+    __slots__ = ('edge', 'variant')
+
+    def __init__(self, edge, variant):
+        self.edge = edge
+        self.variant = variant
+
+    def __repr__(self):
+        return f'NNIMove({self.edge.name or id(self.edge)}, {self.variant})'
+
+    def _holder(self):
+        """
+        :returns: the node holding the other node swapped, and its position
+           among its children
+        """
+        parent = self.edge.up
+        sister = parent.children[1] if parent.children[0] is self.edge else parent.children[0]
+        if parent.up is None:  # root: the edge continues to the sister
+            return sister, 0
+        return parent, parent.children.index(sister)
+
+    @property
+    def touched(self):
+        """
+        Nodes changed by the move (the two nodes swapped and their parents),
+        e.g. to be updated incrementally.
+        """
+        holder, i = self._holder()
+        return [self.edge, holder, self.edge.children[self.variant], holder.children[i]]
+
+    def apply(self):
+        """
+        Changes the tree into the neighbour tree.
+        """
+        holder, i = self._holder()
+        a = self.edge.children[self.variant]
+        c = holder.children[i]
+        self.edge.children[self.variant], holder.children[i] = c, a
+        a.up, c.up = holder, self.edge
+
+    # swapping again restores the tree
+    undo = apply
+
+    def newick(self, tree, **kwargs):
+        """
+        :param tree: root of the tree of the move
+        :param kwargs: arguments of tree.write
+
+        :returns: the neighbour tree, in newick format
+        """
+        self.apply()
+        try:
+            return tree.write(**kwargs)
+        finally:
+            self.undo()
+
+    def copy(self, tree):
+        """
+        :param tree: root of the tree of the move
+
+        :returns: a copy of the neighbour tree
+        """
+        self.apply()
+        try:
+            return tree.copy()
+        finally:
+            self.undo()
+
+
+def iter_NNI_moves(tree):
+    """
+    Generator yielding the moves to all neighbor trees using Nearest
+    Neighbor Interchange search (2 per internal edge of the unrooted tree,
+    the edges below the root counting as one), without changing the tree.
+
+    Moves can be applied and undone in any order, the nodes of an edge
+    staying the same whatever the moves applied.
+
+    WARNING: only works with binary trees.
+    """
+    root_children = tree.children
+    if len(root_children) != 2:
+        raise Exception('ERROR: NNIs only work with binary trees.')
+    for n in tree.traverse():
+        if n is tree or not n.children:
+            continue
+        if len(n.children) != 2:
+            raise Exception('ERROR: NNIs only work with binary trees.')
+        if n.up is tree:
+            # root does not exist here: it's just one edge, with two ends
+            if n is root_children[1] or not root_children[1].children:
+                continue
+        yield NNIMove(n, 0)
+        yield NNIMove(n, 1)
+
+
+if __name__ == '__main__':
+    seed(2)
+    t = Tree()
+    t.populate(5, names=[str(i) for i in range(1, 6)])
+    print(t)
+
+    for tt in iter_NNIs(t):
+        print(tt)
 
-seed(2)
-t = Tree()
-tlen = 10000
-t.populate(tlen, names_library=map(str, range(1, tlen + 1)))
+    seed(2)
+    t = Tree()
+    tlen = 10000
+    t.populate(tlen, names=[str(i) for i in range(1, tlen + 1)])
 
-print('Test if the number of neighbor trees found is equal to 2x(N-3), with N the number of leaves:')
-print(f'{len(list(iter_NNIs(t)))} == {2 * (tlen - 3)}')
-print(len(list(iter_NNIs(t))) == 2 * (tlen - 3))
\ No newline at end of file
+    print('Test if the number of neighbor trees found is equal to 2x(N-3), with N the number of leaves:')
+    print(f'{len(list(iter_NNIs(t)))} == {2 * (tlen - 3)}')
+    print(len(list(iter_NNIs(t))) == 2 * (tlen - 3))
+    print(len(list(iter_NNI_moves(t))) == 2 * (tlen - 3))
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""
+Fitch parsimony of nucleotide alignments, scoring the NNI neighbours of a
+tree incrementally.
+
+Sequences are given as seq2num_nt codes (see hdf5_support/codec.py), whose
+bitwise AND gives the code of the ambiguity of two bases: a base is thus
+possible for a code if the AND of both is the code itself. Each site is
+converted once to the set of its possible bases (4 bits, A, C, G, T from the
+lowest bit, N and gaps allowing any base), Fitch sets of whole sequences
+being then intersected (AND) and united (OR) with single numpy operations.
+
+The sets of the subtree below each node (down-pass) and of the rest of the
+tree (up-pass) are cached, so that an NNI around an edge, which only
+rearranges the four subtrees around it, is scored by joining these four
+sets, in O(L) instead of O(N x L) for a whole new down-pass.
+"""
+import numpy as np
+
+from nearest_neighbor_interchange import iter_NNI_moves
+
+# seq2num_nt codes of A, C, G, T
+_BASE_CODES = (0b00100101, 0b01101010, 0b10010110, 0b11011001)
+_ANY = 0b1111
+
+# seq2num_nt code -> set of possible bases
+FITCH_STATES = np.zeros(256, dtype='uint8')
+for _i, _base in enumerate(_BASE_CODES):
+    FITCH_STATES[(np.arange(256) & _base) == np.arange(256)] |= 1 << _i
+# gaps are missing data
+FITCH_STATES[FITCH_STATES == 0] = _ANY
+
+
+def fitch_states(codes):
+    """
+    :param codes: numpy array of seq2num_nt codes (int8)
+
+    :returns: numpy array of uint8 sets of possible bases
+    """
+    return np.take(FITCH_STATES, np.asarray(codes).view('uint8'))
+
+
+def _join(x, y):
+    """
+    Fitch join of the sets of two sibling subtrees.
+
+    :returns: the sets of their parent, and the number of changes needed
+    """
+    inter = x & y
+    empty = inter == 0
+    inter[empty] = (x | y)[empty]
+    return inter, int(np.count_nonzero(empty))
+
+
+def _changes(x, y):
+    """
+    :returns: number of changes needed to join two sets (without the sets)
+    """
+    return int(np.count_nonzero((x & y) == 0))
+
+
+class FitchParsimony:
+    """
+    Parsimony score of a binary tree, with the Fitch sets of both sides of
+    each edge cached to score NNI neighbours (see iter_NNI_moves) in
+    O(alignment length). Moves are scored on the tree as it is: after
+    applying one, update() must be called before scoring again.
+
+    :param tree: binary tree, changed in place by the moves applied
+    :param sequences: mapping leaf name -> numpy array of seq2num_nt codes
+       (all of the same length)
+    """
+
+    def __init__(self, tree, sequences):
+        if len(tree.children) != 2:
+            raise Exception('ERROR: parsimony of NNIs only works with binary trees.')
+        self.tree = tree
+        self._rows = {}
+        leaves = []
+        for n in tree.traverse():
+            if n.children and len(n.children) != 2:
+                raise Exception('ERROR: parsimony of NNIs only works with binary trees.')
+            self._rows[n] = len(self._rows)
+            if not n.children:
+                leaves.append(n)
+        length = len(sequences[leaves[0].name])
+        # down-pass sets and number of changes in the subtree of each node
+        self.down = np.empty((len(self._rows), length), dtype='uint8')
+        self.down_cost = np.zeros(len(self._rows), dtype='int64')
+        # same for the rest of the tree (seen from the edge to the parent)
+        self.up = np.empty_like(self.down)
+        self.up_cost = np.zeros_like(self.down_cost)
+        for leaf in leaves:
+            try:
+                codes = sequences[leaf.name]
+            except KeyError:
+                raise Exception(f'ERROR: no sequence for leaf {leaf.name}.')
+            if len(codes) != length:
+                raise Exception(f'ERROR: sequence of leaf {leaf.name} has '
+                                f'{len(codes)} sites instead of {length}.')
+            self.down[self._rows[leaf]] = fitch_states(codes)
+        self.update()
+
+    def _sets(self, node):
+        row = self._rows[node]
+        return self.down[row], self.down_cost[row]
+
+    def update(self):
+        """
+        Recomputes the cached sets (down-pass then up-pass), e.g. after
+        applying a move.
+        """
+        rows = self._rows
+        down, down_cost = self.down, self.down_cost
+        up, up_cost = self.up, self.up_cost
+        for n in self.tree.traverse('postorder'):
+            if n.children:
+                a, b = (rows[c] for c in n.children)
+                down[rows[n]], changes = _join(down[a], down[b])
+                down_cost[rows[n]] = down_cost[a] + down_cost[b] + changes
+        for n in self.tree.traverse('preorder'):
+            if not n.children:
+                continue
+            a, b = (rows[c] for c in n.children)
+            if n.up is None:
+                # the root is not a node of the unrooted tree: each side is
+                # the rest of the tree of the other one
+                up[a], up_cost[a] = down[b], down_cost[b]
+                up[b], up_cost[b] = down[a], down_cost[a]
+                continue
+            row = rows[n]
+            for x, y in ((a, b), (b, a)):
+                up[x], changes = _join(up[row], down[y])
+                up_cost[x] = up_cost[row] + down_cost[y] + changes
+
+    @property
+    def score(self):
+        """
+        Number of changes of the tree.
+        """
+        return int(self.down_cost[self._rows[self.tree]])
+
+    def _quartet(self, move):
+        """
+        :returns: the sets and number of changes of the subtrees around the
+           edge of the move: the one swapped and the other one on each side
+        """
+        edge = move.edge
+        parent = edge.up
+        a = self._sets(edge.children[move.variant])
+        b = self._sets(edge.children[1 - move.variant])
+        sister = parent.children[1] if parent.children[0] is edge else parent.children[0]
+        if parent.up is None:  # the edge continues to the sister
+            x, y = (self._sets(c) for c in sister.children)
+        else:
+            row = self._rows[parent]
+            x, y = self._sets(sister), (self.up[row], self.up_cost[row])
+        return a, b, x, y
+
+    def score_move(self, move):
+        """
+        :param move: NNIMove on the tree, not applied
+
+        :returns: the number of changes of the neighbour tree
+        """
+        (a, ca), (b, cb), (x, cx), (y, cy) = self._quartet(move)
+        # a and x are swapped
+        left, c1 = _join(x, b)
+        right, c2 = _join(a, y)
+        return int(ca + cb + cx + cy) + c1 + c2 + _changes(left, right)
+
+    def iter_scores(self):
+        """
+        Generator yielding all the NNI moves of the tree with the number of
+        changes of their neighbour tree.
+        """
+        for move in iter_NNI_moves(self.tree):
+            yield move, self.score_move(move)
+
+    def best_move(self):
+        """
+        :returns: the NNI move giving the most parsimonious neighbour tree
+           (the first one found in case of ties) and its number of changes,
+           or (None, None) if the tree has no neighbours
+        """
+        return min(self.iter_scores(), key=lambda ms: ms[1], default=(None, None))
+
+
+def iter_hill_climb(tree, sequences, max_moves=None):
+    """
+    Generator improving the parsimony of a tree in place, applying the best
+    NNI move until no neighbour is more parsimonious.
+
+    WARNING: only works with binary trees.
+
+    :param tree: binary tree, changed in place
+    :param sequences: mapping leaf name -> numpy array of seq2num_nt codes
+    :param None max_moves: stop after this number of moves
+
+    :returns: the move applied and the new number of changes of the tree,
+       after each move
+    """
+    parsimony = FitchParsimony(tree, sequences)
+    moves = 0
+    while max_moves is None or moves < max_moves:
+        move, score = parsimony.best_move()
+        if move is None or score >= parsimony.score:
+            break
+        move.apply()
+        parsimony.update()
+        moves += 1
+        yield move, parsimony.score